@@ -11,118 +11,174 @@
 # • MODIFIED (2025-07-03): Added heat-map time-window slider (1–60 min).
 # • FIXED (2025-07-03): moving_avg now uses a DatetimeIndex so
 #   Pandas understands string offsets like "30min".
+# • MODIFIED (2026-10-17): Heat-map triangulates the whole window in one
+#   vectorized call (triangulate.triangulate_window).
+# • MODIFIED (2026-10-17): read_data syncs a local SQLite mirror of the
+#   sheet and only parses rows appended since the last refresh.
+# • NEW (2026-10-17): Crowd counts come from incrementally updated 1 min /
+#   10 min / 1 h rollups, picked by the length of the selected span.
+# • NEW (2026-10-17): “Unique (across devices)” uses mergeable HyperLogLog
+#   sketches and also shows the unique visitors over the whole period.
+# • NEW (2026-10-17): Triangulation results are kept in an LRU cache, so
+#   reruns that change nothing relevant re-render the map instantly.
+# • NEW (2026-10-17): The heat-map is binned into a zoom-dependent grid on
+#   the server, only the non-empty cells (at most 2,000) go to the browser.
+# • NEW (2026-10-17): Time-lapse mode triangulates the whole period once
+#   into a memory-mapped density cube that can be scrubbed or played.
+# • NEW (2026-10-17): Weighted multilateration from any number of sensors;
+#   visitors seen by 3 or more of the placed markers are located.
+# • MODIFIED (2026-10-17): Crowd data is held in long format (timestamp,
+#   categorical device, int32 mac id, int8 RSSI) instead of dicts in cells.
+# • NEW (2026-10-17): “Visitor flow” view with dwell times, repeat visits
+#   and sensor transitions from an inverted index of mac hash → sightings.
+# • NEW (2026-10-17): Reads from a collector on the festival LAN instead of
+#   the Google Sheet when utils.COLLECTOR_URL is set.
+# • NEW (2026-10-17): “Diagnostics” panel with the time of every stage
+#   (fetch, parse, rollups, triangulation, render), also exported for
+#   Prometheus to dashboard_metrics.prom.
+# • NEW (2026-10-17): “Events” view with the crowd build-up per stage around
+#   the shows of the festival schedule (scraped concurrently, cached on disk).
+# • MODIFIED (2026-10-17): The festival map is a pre-cut tile pyramid served
+#   statically from ./static instead of an ImageOverlay embedded every rerun.
+# • NEW (2026-10-17): The heat-map can show positions of a dataset written by
+#   batch_triangulate.py instead of triangulating the placed markers.
+# • MODIFIED (2026-10-17): Crowd-count charts are drawn in the browser with
+#   Altair (instead of mpld3), from series decimated with LTTB.
 # ---------------------------------------------------------------------------
 
 from __future__ import annotations
 
 import ast
+import os
 from datetime import datetime, timedelta, time
+from time import perf_counter
 
+import altair as alt
 import folium
-import matplotlib.pyplot as plt
-import mpld3
 import numpy as np
 import pandas as pd
 import streamlit as st
-import streamlit.components.v1 as components
 from folium.plugins import HeatMap
-from folium.raster_layers import ImageOverlay
 from streamlit_autorefresh import st_autorefresh
 from streamlit_folium import st_folium
 
-from triangulate import triangulate_positions
+from batch_triangulate import list_datasets, load_positions
+from decimate import PIXEL_BUDGET, lttb
+from heatmap import cell_size_for_zoom, grid_positions
+from metrics import Metrics, serve_metrics
+from tiles import MAP_CORNERS, MAX_ZOOM, MIN_ZOOM, TILE_DIR, build_pyramid, pyramid_is_current
+from timelapse import CUBE_DIR, MAX_CUBES, DensityCube, cube_key, prune_cubes
+from triangulate import (
+    MIN_SENSORS,
+    TriangulationCache,
+    triangulate_window,
+    triangulate_xy,
+    window_fingerprint,
+)
+from postings import VISIT_GAP
+from schedule import crowd_around_events, scrape_schedule
+from processing import TIME_BIN
+from rollups import Rollups, choose_resolution
+from sheet_mirror import SheetMirror
+from sketches import STANDARD_ERROR
 from utils import (
-    COLUMNS,
-    get_sheet,
+    get_sink,
     ll_to_xy,
-    rssi_to_distance,
     xy_to_ll,
 )
 
 # ---------------------------------------------------------------------------
-# Streamlit page setup and Matplotlib defaults
+# Streamlit page setup
 # ---------------------------------------------------------------------------
 st.set_page_config(page_title="Crowd Monitoring Dashboard", layout="wide")
 st.title("Crowd Monitoring Dashboard")
-plt.style.use("default")
-# (custom Matplotlib rcParams go here if needed)
+
+rerun_start = perf_counter()
 
 # ---------------------------------------------------------------------------
-# Data loading (cached for 10 min)
+# Data loading (incremental sync every 250 s)
 # ---------------------------------------------------------------------------
 
-def parse_dict_string(dict_string: str) -> dict:
-    result_dict = {}
-    content = dict_string.strip().strip('{}')
-
-    if not content:
-        return result_dict
-
-    parts = content.split(', ')
-
-    for part in parts:
-        try:
-            key_str, value_str = part.split(': ', 1)
-        except ValueError:
-            continue
-
-        key = key_str.strip().strip("'")
-
-        try:
-            value = int(value_str.strip())
-        except ValueError:
-            continue
-
-        result_dict[key] = value
-
-    return result_dict
-
-@st.cache_data(ttl=250, show_spinner="Fetching latest data…")
-def read_data() -> pd.DataFrame:
-    """Fetch Google-Sheet records and prepare a tidy DataFrame."""
-    sheet = get_sheet()
-    data = sheet.get_all_records()
-    
-    if not data:
-        return pd.DataFrame(columns=COLUMNS)
-
-
-    df = pd.DataFrame(data, columns=COLUMNS)
-
-    def parse_crowd(x):
-        if pd.isna(x) or not isinstance(x, str) or x.strip() == "":
-            return {}
-        try:
-            return parse_dict_string(x)
-        except (ValueError, SyntaxError):
-            return {}
-
-    print("Parsing crowd data…")
-    df["crowd_data"] = df["crowd_data"].apply(parse_crowd)
-
-    print("Converting timestamps to datetime objects…")
-    df["timestamp"] = pd.to_datetime(df["timestamp"], errors="coerce")
-    
-    def merge_dicts(dicts):
-        merged = {}
-        for d in dicts:
-            merged.update(d)
-        return merged
-
-    df['time_bin'] = df['timestamp'].dt.floor('10T')
-
-    df = (
-        df.groupby(['device_name', 'time_bin'], as_index=False)
-        .agg({'crowd_data': merge_dicts})
-    )
-
-    # Optional: Rename 'time_bin' back to 'timestamp' if desired
-    df.rename(columns={'time_bin': 'timestamp'}, inplace=True)
-    df['crowd_count'] = df['crowd_data'].apply(len)
-    
-    return df
-
-data = read_data()
+# Prometheus text file with the metrics of the dashboard, rewritten on every rerun
+METRICS_PATH = "dashboard_metrics.prom"
+# port to also serve the metrics at /metrics, None to only write the file
+METRICS_PORT = None
+
+@st.cache_resource
+def get_metrics() -> Metrics:
+    """Stage timings and counters, shared across sessions and reruns."""
+    metrics = Metrics("crowd_dashboard")
+    if METRICS_PORT is not None:
+        serve_metrics(metrics, METRICS_PORT)
+    return metrics
+
+metrics = get_metrics()
+
+@st.cache_resource
+def get_mirror() -> SheetMirror:
+    """Local mirror of the Google Sheet or the collector, shared across sessions and reruns."""
+    sink = get_sink()
+    return SheetMirror(sink, f"mirror_{sink.name}.sqlite", metrics)
+
+@st.cache_resource
+def get_triangulation_cache() -> TriangulationCache:
+    """Triangulation results, shared across sessions and reruns."""
+    return TriangulationCache()
+
+@st.cache_resource(max_entries=MAX_CUBES, show_spinner="Triangulating the whole period…")
+def get_density_cube(
+    key: str,
+    _df: pd.DataFrame,
+    _device_xy: dict[str, tuple[float, float]],
+    _origin_ll: tuple[float, float],
+    _bounds: list[list[float]],
+    _start: datetime,
+    _end: datetime,
+    _N: float,
+    _measured_power: float,
+) -> DensityCube:
+    """Time-lapse cube of the whole period, only built if it is not on disk yet (`key` names the cube)."""
+    path = os.path.join(CUBE_DIR, key)
+    if not os.path.exists(path + ".json"):
+        os.makedirs(CUBE_DIR, exist_ok=True)
+        with metrics.time("cube_build_seconds"):
+            timestamps, xy = triangulate_xy(_df, _device_xy, N=_N, measured_power=_measured_power)
+            lats, lons = xy_to_ll(xy[:, 0], xy[:, 1], _origin_ll[0], _origin_ll[1])
+            DensityCube.build(path, timestamps, lats, lons, _bounds, _start, _end, TIME_BIN)
+        prune_cubes()
+    return DensityCube(path)
+
+@st.cache_resource(show_spinner="Cutting the festival map into tiles…")
+def get_map_tiles() -> str:
+    """URL template of the festival map tiles, built once if the map or its corners changed."""
+    if not pyramid_is_current():
+        build_pyramid()
+    base = st.get_option("server.baseUrlPath").strip("/")
+    # served from ./static by Streamlit (server.enableStaticServing in .streamlit/config.toml)
+    return f"{'/' + base if base else ''}/app/{TILE_DIR.replace(os.sep, '/')}/{{z}}/{{x}}/{{y}}.webp"
+
+@st.cache_data(max_entries=16)
+def read_batch_positions(path: str, start: datetime, end: datetime, _version: float) -> np.ndarray:
+    """[lat, lon] of a dataset of batch_triangulate.py in a span; `_version` changes when the job adds windows."""
+    return load_positions(path, start, end, columns=["timestamp", "lat", "lon"])[["lat", "lon"]].to_numpy()
+
+# cache_resource hands out the rollups without copying them on every rerun
+@st.cache_resource(ttl=250, show_spinner="Fetching latest data…")
+def read_data() -> Rollups:
+    """Fetch the rows appended since the last sync and return the updated rollups."""
+    return get_mirror().sync()
+
+@st.cache_data(ttl=3600, show_spinner="Fetching the festival schedule…")
+def read_schedule() -> pd.DataFrame:
+    """Event table of the festival; unchanged pages come from the on-disk cache."""
+    try:
+        return scrape_schedule()
+    except Exception as e:
+        st.toast(f"Could not fetch the schedule ({e}), using the cached pages.")
+        return scrape_schedule(offline=True)
+
+rollups = read_data()
+data = rollups.devices[TIME_BIN]
 if data.empty:
     st.info("No data available.")
     st.stop()
@@ -145,7 +201,7 @@ if start_dt > end_dt:
     st.sidebar.error("⚠️ Start must be before end.")
     st.stop()
 
-plot_type = st.sidebar.radio("Visualization", ["Crowd Count", "Triangulated Positions"])
+plot_type = st.sidebar.radio("Visualization", ["Crowd Count", "Visitor flow", "Events", "Triangulated Positions"])
 
 st.sidebar.markdown("### RSSI calibration")
 N = st.sidebar.slider("Path-loss exponent (N)", 2.0, 4.0, 3.0, 0.1)
@@ -159,24 +215,46 @@ window_minutes = st.sidebar.slider(
     value=10,
     step=1,
 )
+timelapse = st.sidebar.toggle(
+    "Time-lapse over the whole period",
+    help="Triangulate the selected period once and scrub or play through it.",
+)
 
 # ---------------------------------------------------------------------------
 # Data subset for the chosen period
 # ---------------------------------------------------------------------------
-df = data[
-    (data["device_name"].isin(selected_devices))
-    & (data["timestamp"] >= start_dt)
-    & (data["timestamp"] <= end_dt)
-]
+def select(frame: pd.DataFrame) -> pd.DataFrame:
+    """Rows of a rollup or observation frame for the selected devices and period."""
+    return frame[
+        (frame["device_name"].isin(selected_devices))
+        & (frame["timestamp"] >= start_dt)
+        & (frame["timestamp"] <= end_dt)
+    ]
+
+# observations (long format) for triangulation; they are sorted, so the period is a slice
+df = select(rollups.between(start_dt, end_dt))
 
 if df.empty:
     st.warning("No data in the selected interval for the chosen devices.")
     st.stop()
 
+# the plots use the coarsest resolution that still resolves the selected span
+resolution = choose_resolution(start_dt, end_dt)
+plot_df = select(rollups.devices[resolution])
+all_devices_selected = set(selected_devices) == set(devices)
+totals = rollups.totals[resolution]
+totals = totals[(totals["timestamp"] >= start_dt) & (totals["timestamp"] <= end_dt)]
+# gaps longer than this are not filled in the plots
+max_gap = max(timedelta(minutes=15), 1.5 * pd.Timedelta(resolution))
+# the moving average spans at least 3 bins, so coarse resolutions are smoothed as well
+smoothing = max(timedelta(minutes=30), 3 * pd.Timedelta(resolution))
+# the counts are devices seen per bin, so they grow with the resolution of the span
+count_title = f"Devices per {resolution} bin"
+
 # ---------------------------------------------------------------------------
 # Helper – time-aware rolling mean
 # ---------------------------------------------------------------------------
-def moving_avg(series: pd.Series, window: str = "30min") -> pd.Series:
+def moving_avg(series: pd.Series, window: str | timedelta = "30min") -> pd.Series:
     """
     Return the rolling mean over the given *time* window.
 
@@ -187,6 +265,66 @@ def moving_avg(series: pd.Series, window: str = "30min") -> pd.Series:
         raise ValueError("moving_avg expects the Series index to be a DatetimeIndex")
     return series.sort_index().rolling(window=window, min_periods=1).mean()
 
+def chart_rows(series: pd.Series, label: str, smoothing: timedelta, max_gap: timedelta) -> pd.DataFrame:
+    """
+    Moving average over `smoothing` of `series` as rows of the crowd-count chart, decimated with LTTB
+    to `PIXEL_BUDGET` points. A new `segment` starts after every gap longer than `max_gap`,
+    so the chart does not bridge gaps.
+    """
+    ys = moving_avg(series, smoothing).round()
+    segment = (ys.index.to_series().diff() >= max_gap).cumsum().to_numpy()
+    kept = lttb(ys.index.asi8, ys.to_numpy(), PIXEL_BUDGET)
+    return pd.DataFrame({
+        "timestamp": ys.index[kept],
+        "series": label,
+        "crowd_count": ys.to_numpy()[kept],
+        "segment": segment[kept],
+    })
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def crowd_count_rows(
+    _rollups: Rollups,
+    mode: str,
+    devices: tuple[str, ...],
+    all_devices: bool,
+    start: datetime,
+    end: datetime,
+    resolution: str,
+    smoothing: timedelta,
+    max_gap: timedelta,
+    data_version: int,
+) -> pd.DataFrame:
+    """
+    Rows of the crowd-count chart for a selection, computed once per selection and
+    `data_version` (the number of observations, which grows with every sync).
+    Everything the rows depend on is an argument; `_rollups` is not hashed, `data_version` stands in for it.
+    """
+    counts = _rollups.devices[resolution]
+    counts = counts[
+        counts["device_name"].isin(devices) & (counts["timestamp"] >= start) & (counts["timestamp"] <= end)
+    ]
+    if mode == "Individual":
+        frames = [
+            chart_rows(counts[counts["device_name"] == dev].set_index("timestamp")["crowd_count"], dev, smoothing, max_gap)
+            for dev in devices
+            if (counts["device_name"] == dev).any()
+        ]
+    elif mode == "Total":
+        if all_devices:
+            totals = _rollups.totals[resolution]
+            summed = totals[(totals["timestamp"] >= start) & (totals["timestamp"] <= end)].set_index("timestamp")["total"]
+        else:
+            summed = counts.groupby("timestamp")["crowd_count"].sum().sort_index()
+        frames = [chart_rows(summed, "Total", smoothing, max_gap)]
+    else:  # Unique across devices
+        unique_series = _rollups.sketches[resolution].unique_series(list(devices), start, end)
+        frames = [chart_rows(unique_series, "Unique", smoothing, max_gap)]
+    if not frames:
+        return pd.DataFrame(columns=["timestamp", "series", "crowd_count", "segment"])
+    return pd.concat(frames, ignore_index=True)
+
+render_start = perf_counter()
+
 # ---------------------------------------------------------------------------
 # Branch 1 – crowd-count time-series
 # ---------------------------------------------------------------------------
@@ -199,57 +337,127 @@ if plot_type == "Crowd Count":
         horizontal=True,
     )
 
-    fig, ax = plt.subplots()
-
-    if mode == "Individual":
-        for dev in selected_devices:
-            dev_df = df[df["device_name"] == dev]
-            if dev_df.empty:
-                continue
-            series = dev_df.set_index("timestamp")["crowd_count"]
-            ys = moving_avg(series, "30min").round()
-            xs = ys.index
-            mask = dev_df["timestamp"].diff() < timedelta(minutes=15)
-            ax.fill_between(xs, ys, alpha=0.6, label=dev, where=mask)
-
-    elif mode == "Total":
-        summed = (
-            df.groupby("timestamp")["crowd_count"]
-            .sum()
-            .sort_index()
+    if mode == "Unique (across devices)":
+        unique_total = rollups.sketches[resolution].unique_count(selected_devices, start_dt, end_dt)
+        st.metric(
+            "Unique visitors in the selected period",
+            f"{unique_total:,.0f}",
+            help=f"HyperLogLog estimate, standard error ±{STANDARD_ERROR:.1%}",
         )
-        ys = moving_avg(summed, "30min").round()
-        xs = ys.index
-        mask = xs.to_series().diff() < timedelta(minutes=15)
-        ax.fill_between(xs, ys, alpha=0.6, label="Total", where=mask)
 
-    else:  # Unique across devices
-        unique_series = (
-            df.groupby("timestamp")["crowd_data"]
-            .apply(lambda s: len({mac for d in s for mac in d.keys()}))
-            .sort_index()
+    rows = crowd_count_rows(
+        rollups, mode, tuple(selected_devices), all_devices_selected, start_dt, end_dt,
+        resolution, smoothing, max_gap, rollups.observation_count,
+    )
+    # the browser draws at most PIXEL_BUDGET points per series, whatever the length of the span;
+    # timestamps are wall-clock times, shown as UTC so the browser does not shift them
+    chart = (
+        alt.Chart(rows)
+        .mark_area(opacity=0.6)
+        .encode(
+            x=alt.X("timestamp:T", title="Time", scale=alt.Scale(type="utc")),
+            y=alt.Y("crowd_count:Q", title=f"{count_title} ({smoothing.total_seconds() / 60:.0f} min moving avg)", stack=None),
+            color=alt.Color("series:N", title=None, legend=alt.Legend(orient="top-right")),
+            detail="segment:O",
+            tooltip=[
+                alt.Tooltip("utcyearmonthdatehoursminutes(timestamp):T", title="Time"),
+                alt.Tooltip("series:N", title="Series"),
+                alt.Tooltip("crowd_count:Q", title=count_title),
+            ],
         )
-        ys = moving_avg(unique_series, "30min").round()
-        xs = ys.index
-        mask = xs.to_series().diff() < timedelta(minutes=15)
-        ax.fill_between(xs, ys, alpha=0.6, label="Unique", where=mask)
-
-    ax.set_xlabel("Time")
-    ax.set_ylabel("Crowd count (moving-avg)")
-    ax.set_title(f"Crowd Count\n{start_dt:%Y-%m-%d %H:%M} → {end_dt:%Y-%m-%d %H:%M}")
-    ax.legend(loc="upper right")
-    plt.tight_layout()
-    fig.subplots_adjust(bottom=0.2, left=0.1)
-    components.html(mpld3.fig_to_html(fig), height=600)
+        .properties(
+            title=[f"Crowd Count ({resolution} bins)", f"{start_dt:%Y-%m-%d %H:%M} → {end_dt:%Y-%m-%d %H:%M}"],
+            height=550,
+        )
+        .interactive(bind_y=False)
+    )
+    st.altair_chart(chart, use_container_width=True)
+    st.caption(
+        f"{count_title}: the bins get longer with the selected span, so counts are only "
+        "comparable between spans shown at the same resolution."
+    )
 
 # ---------------------------------------------------------------------------
-# Branch 2 – Interactive Triangulation & Heat-map
+# Branch 2 – visitor flow from the postings index
+# ---------------------------------------------------------------------------
+elif plot_type == "Visitor flow":
+    st.header("Visitor Flow")
+    postings = rollups.postings
+    visits = postings.visits(start_dt, end_dt, selected_devices)
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Visitors", f"{visits['mac_id'].nunique():,}")
+    col2.metric("Visits", f"{len(visits):,}")
+    col3.metric(
+        "Median dwell time",
+        f"{visits['dwell'].median().total_seconds() / 60:.0f} min" if len(visits) else "–",
+        help=f"A visit ends when a visitor is not seen for {VISIT_GAP.total_seconds() / 60:.0f} min.",
+    )
+
+    st.subheader("Dwell time distribution")
+    dwell_minutes = visits["dwell"].dt.total_seconds() // 60
+    bins = (dwell_minutes // 10 * 10).astype(int)
+    st.bar_chart(bins.value_counts().sort_index().rename_axis("dwell time (min)").rename("visits"))
+
+    st.subheader("Repeat visits")
+    st.bar_chart(postings.repeat_visits(start_dt, end_dt, selected_devices))
+
+    st.subheader("Sensor-to-sensor transitions")
+    st.caption("Visitors are placed at the device with the strongest signal; rows are where they came from.")
+    st.dataframe(postings.transitions(start_dt, end_dt, selected_devices).style.background_gradient(cmap="Blues"))
+
+    st.subheader("Look up a device")
+    mac = st.text_input("Hashed MAC (6 hex digits)", max_chars=6)
+    if mac:
+        try:
+            st.dataframe(postings.postings(int(mac, 16)), use_container_width=True, hide_index=True)
+        except ValueError:
+            st.error("Not a hexadecimal hash.")
+
+# ---------------------------------------------------------------------------
+# Branch 3 – crowd build-up around the shows of the schedule
+# ---------------------------------------------------------------------------
+elif plot_type == "Events":
+    st.header("Crowd Around Events")
+    events = read_schedule()
+    events = events[(events["time"] >= start_dt) & (events["time"] <= end_dt)]
+    if events.empty:
+        st.info("No events in the selected period.")
+        st.stop()
+
+    window_minutes_events = st.slider("Minutes around each show", 15, 120, 60, 15)
+    if all_devices_selected:
+        counts = totals.set_index("timestamp")["total"]
+    else:
+        counts = plot_df.groupby("timestamp")["crowd_count"].sum()
+    around = crowd_around_events(counts.sort_index(), events, f"{window_minutes_events}min")
+
+    st.subheader("Build-up per stage")
+    st.caption(f"Mean {count_title.lower()} by minutes from the start of the shows of each stage.")
+    build_up = around.pivot_table(
+        index="minutes", columns="location", values="crowd_count", aggfunc="mean", observed=True
+    )
+    st.line_chart(build_up)
+
+    st.subheader("Schedule")
+    st.dataframe(events, use_container_width=True, hide_index=True)
+
+    labels = [f"{e.time:%a %H:%M} · {e.title} ({e.location})" for e in events.itertuples()]
+    show = events.iloc[labels.index(st.selectbox("Show", labels))]
+    show_crowd = around[(around["location"] == show["location"]) & (around["time"] == show["time"])]
+    if show_crowd.empty:
+        st.info("No crowd counts around this show.")
+    else:
+        st.line_chart(show_crowd.set_index("minutes")["crowd_count"])
+
+# ---------------------------------------------------------------------------
+# Branch 4 – Interactive Triangulation & Heat-map
 # ---------------------------------------------------------------------------
 else:  # plot_type == "Triangulated Positions"
     st.header("Interactive Triangulation Map")
     st.markdown(
         """
-        **Step 1:** Click on the map to place up to 3 markers for your sensor locations.  
+        **Step 1:** Click on the map to place a marker at each sensor location (at least 3).  
         **Step 2:** Assign a device to each marker in the sidebar.  
         **Step 3:** Click **Triangulate** to generate the crowd heat-map.  
         The map auto-updates when you change RSSI or the time-window slider.
@@ -257,12 +465,7 @@ else:  # plot_type == "Triangulated Positions"
     )
 
     # --- Folium Map & Image Overlay setup ---
-    UL, LL, LR, UR = (
-        (55.631644, 12.053289),
-        (55.606569, 12.049529),
-        (55.605214, 12.112965),
-        (55.630122, 12.115078),
-    )
+    UL, LL, LR, UR = MAP_CORNERS
     bounds = [
         [min(LL[0], LR[0]), min(LL[1], UL[1])],
         [max(UL[0], UR[0]), max(UR[1], LR[1])],
@@ -273,18 +476,33 @@ else:  # plot_type == "Triangulated Positions"
     if "markers" not in st.session_state:
         st.session_state["markers"] = []          # [{'lat':…, 'lon':…, 'device':…}]
     if "heatmap_data" not in st.session_state:
-        st.session_state["heatmap_data"] = []
+        st.session_state["heatmap_data"] = np.empty((0, 2))   # triangulated [lat, lon]
     if "last_click" not in st.session_state:
         st.session_state["last_click"] = None
     if "run_triangulation" not in st.session_state:
         st.session_state["run_triangulation"] = False
 
+    # --- Positions of the whole history from batch_triangulate.py ---
+    sources = {"Triangulate the placed markers": None}
+    for path, params in list_datasets().items():
+        label = (
+            f"Batch: {', '.join(params['devices'])}, N={params['N']}, "
+            f"{params['measured_power']} dBm ({len(params['windows'])} windows)"
+        )
+        sources[label] = path
+    dataset = sources[st.sidebar.selectbox(
+        "Positions",
+        list(sources),
+        disabled=len(sources) == 1,
+        help="Datasets written by batch_triangulate.py",
+    )]
+
     # --- Sidebar marker controls ---
     with st.sidebar:
         st.markdown("### Marker Controls")
         if st.button("Clear All Markers", use_container_width=True):
             st.session_state["markers"].clear()
-            st.session_state["heatmap_data"].clear()
+            st.session_state["heatmap_data"] = np.empty((0, 2))
             st.session_state["last_click"] = None
             st.session_state["run_triangulation"] = False
             st.rerun()
@@ -313,9 +531,9 @@ else:  # plot_type == "Triangulated Positions"
 
     # --- Triangulation trigger ---
     can_triangulate = (
-        len(st.session_state["markers"]) == 3
+        len(st.session_state["markers"]) >= MIN_SENSORS
         and all(mk.get("device") for mk in st.session_state["markers"])
-        and len({mk["device"] for mk in st.session_state["markers"]}) == 3
+        and len({mk["device"] for mk in st.session_state["markers"]}) == len(st.session_state["markers"])
     )
     if st.sidebar.button(
         "Triangulate & Generate Heat-map",
@@ -326,79 +544,112 @@ else:  # plot_type == "Triangulated Positions"
         st.rerun()
 
     # --- Calculation logic ---
-    if can_triangulate and st.session_state["run_triangulation"]:
-        positions: list[list[float]] = []
-        with st.spinner("Calculating heat-map…"):
-            # 0. Restrict df to trailing *window_minutes*
-            window_end   = end_dt
-            window_start = window_end - timedelta(minutes=window_minutes)
-            df_window = df[
-                (df["timestamp"] >= window_start) & (df["timestamp"] <= window_end)
-            ]
-
-            # 1. Build look-ups from markers
-            marker_devices = {
-                mk["device"]: (mk["lat"], mk["lon"]) for mk in st.session_state["markers"]
-            }
-            origin_device = st.session_state["markers"][0]["device"]
-            origin_ll = marker_devices[origin_device]
-            DEVICE_POSITIONS_XY_DYNAMIC = {
-                dev: ll_to_xy(ll[0], ll[1], origin_ll[0], origin_ll[1])
-                for dev, ll in marker_devices.items()
-            }
-
-            # 2. Group by timestamp
-            grouped = df_window.groupby("timestamp").apply(
-                lambda g: dict(zip(g["device_name"], g["crowd_data"]))
+    cube = None
+    if dataset is not None:
+        window_end = end_dt
+        window_start = window_end - timedelta(minutes=window_minutes)
+        with metrics.time("batch_positions_seconds"):
+            st.session_state["heatmap_data"] = read_batch_positions(
+                dataset,
+                window_start,
+                window_end,
+                os.path.getmtime(os.path.join(dataset, "_dataset.json")),
             )
-
-            # 3. Triangulate
-            for _, dev_data in grouped.items():
-                available_devs = set(dev_data) & set(marker_devices.keys())
-                if len(available_devs) < 3:
-                    continue
-                all_macs = {mac for d in available_devs for mac in dev_data[d]}
-                for mac in all_macs:
-                    coords, dists, rssi_devs = [], [], []
-                    for dev in available_devs:
-                        if mac in dev_data[dev]:
-                            val = dev_data[dev][mac]
-                            avg_rssi = sum(val) / len(val) if isinstance(val, list) else val
-                            dist = rssi_to_distance(avg_rssi, N=N, measured_power=measured_power)
-                            coords.append(DEVICE_POSITIONS_XY_DYNAMIC[dev])
-                            dists.append(dist)
-                            rssi_devs.append(dev)
-                    if len(dists) >= 3:
-                        coords3, dists3 = [], []
-                        for d_name in marker_devices.keys():
-                            try:
-                                idx = rssi_devs.index(d_name)
-                                coords3.append(coords[idx])
-                                dists3.append(dists[idx])
-                            except ValueError:
-                                break
-                        if len(dists3) == 3:
-                            pos_xy = triangulate_positions(np.array([dists3]), *coords3)[0]
-                            lat, lon = xy_to_ll(pos_xy[0], pos_xy[1], origin_ll[0], origin_ll[1])
-                            positions.append([lat, lon])
+    elif can_triangulate and st.session_state["run_triangulation"] and timelapse:
+        marker_devices = {
+            mk["device"]: (mk["lat"], mk["lon"]) for mk in st.session_state["markers"]
+        }
+        origin_ll = marker_devices[st.session_state["markers"][0]["device"]]
+        cube = get_density_cube(
+            cube_key(
+                start_dt,
+                end_dt,
+                tuple(selected_devices),
+                tuple(marker_devices.items()),
+                N,
+                measured_power,
+                window_fingerprint(df),
+            ),
+            df,
+            {dev: ll_to_xy(ll[0], ll[1], origin_ll[0], origin_ll[1]) for dev, ll in marker_devices.items()},
+            origin_ll,
+            bounds,
+            start_dt,
+            end_dt,
+            N,
+            measured_power,
+        )
+    elif can_triangulate and st.session_state["run_triangulation"]:
+        # 0. Restrict df to trailing *window_minutes*
+        window_end   = end_dt
+        window_start = window_end - timedelta(minutes=window_minutes)
+        df_window = df[
+            (df["timestamp"] >= window_start) & (df["timestamp"] <= window_end)
+        ]
+
+        # 1. Build look-ups from markers
+        marker_devices = {
+            mk["device"]: (mk["lat"], mk["lon"]) for mk in st.session_state["markers"]
+        }
+        origin_device = st.session_state["markers"][0]["device"]
+        origin_ll = marker_devices[origin_device]
+        DEVICE_POSITIONS_XY_DYNAMIC = {
+            dev: ll_to_xy(ll[0], ll[1], origin_ll[0], origin_ll[1])
+            for dev, ll in marker_devices.items()
+        }
+
+        # 2. Triangulate every visitor in the window in one vectorized call,
+        #    unless nothing relevant changed since the last time
+        def compute_positions() -> np.ndarray:
+            with st.spinner("Calculating heat-map…"), metrics.time("triangulation_seconds"):
+                lats, lons = triangulate_window(
+                    df_window,
+                    DEVICE_POSITIONS_XY_DYNAMIC,
+                    origin_ll,
+                    N=N,
+                    measured_power=measured_power,
+                )
+            positions = np.column_stack([lats, lons])
+            if len(positions):
+                st.toast(f"Heat-map updated with {len(positions)} data points.")
+            return positions
+
+        cache = get_triangulation_cache()
+        cache_key = (
+            window_start,
+            window_end,
+            tuple(selected_devices),
+            tuple(marker_devices.items()),
+            N,
+            measured_power,
+            window_fingerprint(df_window),
+        )
+        positions = cache.get_or_compute(cache_key, compute_positions)
+        st.sidebar.caption(f"Triangulation cache: {cache.hits} hits, {cache.misses} misses")
 
         st.session_state["heatmap_data"] = positions
-        if positions:
-            st.toast(f"Heat-map updated with {len(positions)} data points.")
-        else:
+        if not len(positions):
             st.warning(
                 "Could not triangulate any positions with the current settings. "
                 "Ensure the selected devices have overlapping data."
             )
 
     # --- Folium map rendering ---
-    m = folium.Map(location=[centre_lat, centre_lon], zoom_start=15, control_scale=True)
-    ImageOverlay(
+    # keep the view of the last rerun, the heat-map grid depends on the zoom level
+    view = st.session_state.get("folium_map") or {}
+    zoom = view.get("zoom") or 15
+    centre = view.get("center") or {"lat": centre_lat, "lng": centre_lon}
+    m = folium.Map(location=[centre["lat"], centre["lng"]], zoom_start=zoom, control_scale=True)
+    # the browser only loads the tiles in view and keeps them across reruns
+    folium.TileLayer(
+        tiles=get_map_tiles(),
+        attr="Roskilde Festival",
         name="Festival Map",
-        image="festival_map.jpg",
-        bounds=bounds,
+        overlay=True,
         opacity=0.9,
-        zindex=1,
+        min_zoom=MIN_ZOOM,
+        max_native_zoom=MAX_ZOOM,
+        bounds=bounds,
     ).add_to(m)
 
     for mk in st.session_state["markers"]:
@@ -408,18 +659,81 @@ else:  # plot_type == "Triangulated Positions"
             icon=folium.Icon(color="red", icon="wifi"),
         ).add_to(m)
 
-    if st.session_state["heatmap_data"]:
-        HeatMap(st.session_state["heatmap_data"], radius=20, blur=20).add_to(m)
+    positions = st.session_state["heatmap_data"]
+    if cube is not None:
+        # every frame is a slice of the precomputed cube
+        if st.session_state.get("timelapse_frame", 0) >= len(cube.times):
+            st.session_state["timelapse_frame"] = 0
+        if st.toggle("▶ Play time-lapse", key="timelapse_play"):
+            tick = st_autorefresh(interval=1000, key="timelapse_tick")
+            if tick != st.session_state.get("timelapse_last_tick"):
+                st.session_state["timelapse_last_tick"] = tick
+                st.session_state["timelapse_frame"] = (
+                    st.session_state.get("timelapse_frame", 0) + 1
+                ) % len(cube.times)
+        frame = st.select_slider(
+            "Time-lapse",
+            options=list(range(len(cube.times))),
+            format_func=lambda t: f"{cube.times[t]:%Y-%m-%d %H:%M}",
+            key="timelapse_frame",
+        )
+        cells = cube.frame_cells(frame)
+        if cells:
+            HeatMap(cells, radius=20, blur=20).add_to(m)
+    elif len(positions):
+        # only the non-empty cells of a grid matching the zoom level are sent to the page
+        origin_ll = (positions[:, 0].min(), positions[:, 1].min())
+        cells = grid_positions(
+            positions[:, 0],
+            positions[:, 1],
+            origin_ll,
+            cell_size_for_zoom(zoom, origin_ll[0]),
+        )
+        HeatMap(cells, radius=20, blur=20).add_to(m)
 
     map_data = st_folium(m, key="folium_map", height=600, width="100%")
     if map_data and (click := map_data.get("last_clicked")):
         if click != st.session_state.get("last_click"):
             st.session_state["last_click"] = click
-            if len(st.session_state["markers"]) < 3:
+            # one marker per selected device
+            if len(st.session_state["markers"]) < len(selected_devices):
                 st.session_state["markers"].append(
                     {"lat": click["lat"], "lon": click["lng"], "device": None}
                 )
                 st.rerun()
 
-    if len(st.session_state["markers"]) >= 3:
-        st.info("ℹ️ Maximum of 3 markers placed. Clear markers to start over.")
+    if len(st.session_state["markers"]) >= len(selected_devices):
+        st.info("ℹ️ Every selected device has a marker. Clear markers to start over.")
+
+# ---------------------------------------------------------------------------
+# Diagnostics – stage timings of this dashboard
+# ---------------------------------------------------------------------------
+metrics.observe(f"render_{plot_type.lower().replace(' ', '_')}_seconds", perf_counter() - render_start)
+metrics.observe("rerun_seconds", perf_counter() - rerun_start)
+metrics.write_textfile(METRICS_PATH)
+
+with st.expander("Diagnostics"):
+    with metrics.lock:
+        timers = {name: list(values) for name, values in metrics.timers.items()}
+        counters = {**metrics.counters, **metrics.gauges}
+    st.dataframe(
+        pd.DataFrame(
+            [
+                {
+                    "stage": name.removesuffix("_seconds"),
+                    "runs": int(count),
+                    "last [ms]": 1000 * last,
+                    "mean [ms]": 1000 * total / count,
+                    "max [ms]": 1000 * maximum,
+                }
+                for name, (count, total, last, maximum) in sorted(timers.items())
+            ]
+        ),
+        hide_index=True,
+        use_container_width=True,
+    )
+    st.dataframe(
+        pd.Series(counters, name="value").rename_axis("metric").sort_index(),
+        use_container_width=True,
+    )
+    st.download_button("Prometheus metrics", metrics.to_prometheus(), file_name=METRICS_PATH)
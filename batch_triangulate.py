@@ -0,0 +1,253 @@
+import json
+import os
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from sheet_mirror import SheetMirror
+from triangulate import MIN_SENSORS, triangulate_visitors, window_fingerprint
+from utils import DEVICE_POSITIONS, get_sink, ll_to_xy, parameters_key, xy_to_ll
+
+# Offline triangulation of the whole history into a positions dataset for later analysis.
+# The observations of the mirror are split into time windows that are triangulated
+# independently across a process pool. Every window is one Parquet file in a partition per
+# day (`<dataset>/day=YYYY-MM-DD/HHMMSS.parquet`); `_dataset.json` holds the parameters and a
+# fingerprint of the observations of every finished window, so a rerun only triangulates
+# windows that are new or received rows since (e.g. uploads of a sensor catching up).
+# The directory is a hive-partitioned Parquet dataset, e.g. `pd.read_parquet(<dataset>)`.
+
+POSITIONS_DIR = "positions"
+WINDOW = "1h"
+N = 3.0
+MEASURED_POWER = -16.0
+POSITION_COLUMNS = ["timestamp", "mac_id", "lat", "lon", "x", "y", "sensors"]
+
+
+def dataset_path(
+    device_ll: dict[str, tuple[float, float]],
+    N: float = N,
+    measured_power: float = MEASURED_POWER,
+    window: str = WINDOW,
+    root: str = POSITIONS_DIR,
+) -> str:
+    """Directory of the dataset for these parameters; datasets with other parameters are kept apart."""
+    return os.path.join(root, parameters_key(tuple(device_ll.items()), N, measured_power, pd.Timedelta(window).value))
+
+
+def window_step(window: str) -> pd.Timedelta:
+    """Length of `window`. Raises ValueError unless it divides a day."""
+    step = pd.Timedelta(window)
+    if step <= pd.Timedelta(0) or step > pd.Timedelta("1D") or pd.Timedelta("1D") % step:
+        raise ValueError(f"The window must divide a day, got {window}")
+    return step
+
+
+def split_windows(observations: pd.DataFrame, window: str = WINDOW) -> list[tuple[pd.Timestamp, pd.DataFrame]]:
+    """
+    (start, observations) of every window with observations. Windows are aligned to multiples
+    of `window`, which must divide a day, so every window falls into one day partition and
+    the time bins of `triangulate.distance_matrix` are never split.
+    """
+    step = window_step(window)
+    if observations.empty:
+        return []
+
+    # observations are sorted by timestamp, so every window is a slice
+    timestamps = observations["timestamp"].to_numpy()
+    starts = np.unique(timestamps.astype("datetime64[ns]").astype(np.int64) // step.value * step.value)
+    bounds = np.searchsorted(timestamps, starts.astype("datetime64[ns]"))
+    ends = np.append(bounds[1:], len(observations))
+    return [
+        (pd.Timestamp(start), observations.iloc[first:last])
+        for start, first, last in zip(starts, bounds, ends)
+    ]
+
+
+def window_file(directory: str, start: pd.Timestamp) -> str:
+    return os.path.join(directory, f"day={start:%Y-%m-%d}", f"{start:%H%M%S}.parquet")
+
+
+def triangulate_to_file(
+    path: str,
+    observations: pd.DataFrame,
+    device_xy: dict[str, tuple[float, float]],
+    origin_ll: tuple[float, float],
+    N: float,
+    measured_power: float,
+) -> int:
+    """Triangulate the visitors of one window into the Parquet file at `path`. Returns the number of positions."""
+    visitors = triangulate_visitors(observations, device_xy, N, measured_power)
+    lat, lon = xy_to_ll(visitors["x"].to_numpy(), visitors["y"].to_numpy(), origin_ll[0], origin_ll[1])
+    positions = visitors.assign(lat=lat, lon=lon)[POSITION_COLUMNS]
+
+    # written under a hidden name first, a killed job never leaves a half-written window behind
+    directory, name = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    positions.to_parquet(os.path.join(directory, f".{name}.tmp"), index=False)
+    os.replace(os.path.join(directory, f".{name}.tmp"), path)
+    return len(positions)
+
+
+def _write_manifest(directory: str, manifest: dict) -> None:
+    path = os.path.join(directory, "_dataset.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def triangulate_history(
+    observations: pd.DataFrame,
+    device_ll: dict[str, tuple[float, float]],
+    N: float = N,
+    measured_power: float = MEASURED_POWER,
+    window: str = WINDOW,
+    root: str = POSITIONS_DIR,
+    processes: int = 1,
+) -> dict:
+    """
+    Triangulate every window of `observations` whose observations changed since the last run
+    into the dataset of these parameters (see `dataset_path`).
+
+    Parameters:
+    - observations: observations in long format sorted by timestamp, see `processing.OBSERVATION_DTYPES`
+    - device_ll: the devices used for triangulation (at least 3) and their (lat, lon);
+      positions are computed in metres around the first one
+    - N, measured_power: RSSI calibration, see `rssi_to_distance`
+    - window: length of the windows, the unit of work and of resuming
+    - processes: windows are triangulated across this many processes
+
+    Returns:
+    - dict with the dataset `path`, the number of `windows`, of `skipped` (unchanged) windows,
+      of `triangulated` windows and of `positions` in them
+    """
+    if len(device_ll) < MIN_SENSORS:
+        raise ValueError(f"At least {MIN_SENSORS} devices are needed, got {len(device_ll)}")
+    directory = dataset_path(device_ll, N, measured_power, window, root)
+    origin_ll = next(iter(device_ll.values()))
+    device_xy = {device: ll_to_xy(lat, lon, origin_ll[0], origin_ll[1]) for device, (lat, lon) in device_ll.items()}
+
+    manifest = {"devices": device_ll, "N": N, "measured_power": measured_power, "window": window, "windows": {}}
+    if os.path.exists(os.path.join(directory, "_dataset.json")):
+        with open(os.path.join(directory, "_dataset.json")) as f:
+            manifest["windows"] = json.load(f)["windows"]
+    os.makedirs(directory, exist_ok=True)
+    _write_manifest(directory, manifest)
+
+    tasks = []
+    windows = split_windows(observations, window)
+    for start, chunk in windows:
+        rows, last = window_fingerprint(chunk)
+        fingerprint = [int(rows), last.isoformat()]
+        path = window_file(directory, start)
+        if manifest["windows"].get(start.isoformat()) == fingerprint and os.path.exists(path):
+            continue
+        tasks.append((start, fingerprint, path, chunk))
+
+    stats = {"path": directory, "windows": len(windows), "skipped": len(windows) - len(tasks), "triangulated": 0, "positions": 0}
+
+    def finished(start: pd.Timestamp, fingerprint: list, positions: int) -> None:
+        # recorded as soon as the window is on disk, an interrupted run resumes from here
+        manifest["windows"][start.isoformat()] = fingerprint
+        _write_manifest(directory, manifest)
+        stats["triangulated"] += 1
+        stats["positions"] += positions
+
+    if processes > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(min(processes, len(tasks))) as pool:
+            futures = {
+                pool.submit(triangulate_to_file, path, chunk, device_xy, origin_ll, N, measured_power): (start, fingerprint)
+                for start, fingerprint, path, chunk in tasks
+            }
+            for future in as_completed(futures):
+                finished(*futures[future], future.result())
+    else:
+        for start, fingerprint, path, chunk in tasks:
+            finished(start, fingerprint, triangulate_to_file(path, chunk, device_xy, origin_ll, N, measured_power))
+    return stats
+
+
+def list_datasets(root: str = POSITIONS_DIR) -> dict[str, dict]:
+    """Dataset directory -> parameters (`_dataset.json`) of every positions dataset under `root`."""
+    datasets = {}
+    if not os.path.isdir(root):
+        return datasets
+    for name in sorted(os.listdir(root)):
+        manifest = os.path.join(root, name, "_dataset.json")
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                datasets[os.path.join(root, name)] = json.load(f)
+    return datasets
+
+
+def load_positions(directory: str, start=None, end=None, columns: list[str] | None = None) -> pd.DataFrame:
+    """
+    Positions of a dataset from `start` to `end` (both inclusive, None for no bound).
+    Only the day partitions in that span are read.
+    """
+    days = sorted(
+        name for name in os.listdir(directory)
+        if name.startswith("day=")
+        and (start is None or name[4:] >= f"{pd.Timestamp(start):%Y-%m-%d}")
+        and (end is None or name[4:] <= f"{pd.Timestamp(end):%Y-%m-%d}")
+    )
+    frames = [
+        pd.read_parquet(os.path.join(directory, day, name), columns=columns)
+        for day in days
+        for name in sorted(os.listdir(os.path.join(directory, day)))
+        if name.endswith(".parquet")
+    ]
+    if not frames:
+        return pd.DataFrame(columns=columns or POSITION_COLUMNS)
+    positions = pd.concat(frames, ignore_index=True)
+    if start is not None:
+        positions = positions[positions["timestamp"] >= pd.Timestamp(start)]
+    if end is not None:
+        positions = positions[positions["timestamp"] <= pd.Timestamp(end)]
+    return positions.reset_index(drop=True)
+
+
+def main():
+    parser = ArgumentParser(description="Triangulate the whole history into a positions dataset partitioned by day")
+    parser.add_argument("--mirror", type=str, default=None, help="SQLite mirror of the sink (default: the mirror of the website)")
+    parser.add_argument("--offline", action="store_true", help="Only use the rows already in the mirror")
+    parser.add_argument("--device", nargs=3, action="append", metavar=("NAME", "LAT", "LON"), help="Position of a device, repeat for every device (default: utils.DEVICE_POSITIONS)")
+    parser.add_argument("--N", type=float, default=N, help="Path-loss exponent")
+    parser.add_argument("--measured_power", type=float, default=MEASURED_POWER, help="Measured power at 1 m (dBm)")
+    parser.add_argument("--window", type=str, default=WINDOW, help="Length of the windows, must divide a day")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--out", type=str, default=POSITIONS_DIR)
+
+    args = parser.parse_args()
+    if args.device:
+        device_ll = {name: (float(lat), float(lon)) for name, lat, lon in args.device}
+    else:
+        device_ll = dict(DEVICE_POSITIONS)
+    if len(device_ll) < MIN_SENSORS:
+        parser.error(f"At least {MIN_SENSORS} devices are needed")
+    try:
+        window_step(args.window)
+    except ValueError as e:
+        parser.error(str(e))
+
+    sink = get_sink()
+    mirror = SheetMirror(sink, args.mirror or f"mirror_{sink.name}.sqlite")
+    if not args.offline:
+        mirror.sync()
+    observations = mirror.rollups.observations
+
+    start = time.perf_counter()
+    stats = triangulate_history(
+        observations, device_ll, args.N, args.measured_power, args.window, args.out, args.processes
+    )
+    seconds = time.perf_counter() - start
+    print(
+        f"{stats['triangulated']} of {stats['windows']} windows triangulated ({stats['skipped']} unchanged), "
+        f"{stats['positions']:,} positions in {seconds:.1f} s with {args.processes} processes, written to {stats['path']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,531 @@
+import base64
+import json
+import os
+import sqlite3
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from functools import lru_cache, partial
+
+import numpy as np
+import pandas as pd
+from scapy.all import RadioTap
+
+from device_table import DeviceTable
+from encoding import DELTA_PREFIX, ENCODING_PREFIX, KEYFRAME_PREFIX, DeltaEncoder, encode_crowd_data, encode_records
+from processing import (
+    TIME_BIN,
+    DeltaDecoder,
+    concat_frames,
+    count_observations,
+    parse_crowd,
+    parse_dict_column,
+    parse_observations,
+    unique_counts,
+)
+from raspberry import split_dict_by_max_length
+from sheet_mirror import SheetMirror
+from sniff import packet_handler, raw_packet_handler
+from synthetic import (
+    DEVICE_LL,
+    DEVICES,
+    MAX_LENGTH,
+    SCAN_DURATION,
+    SEEN_FRACTION,
+    START,
+    FakeWorksheet,
+    feed_frames,
+    synthetic_crowd_windows,
+    synthetic_frames,
+    synthetic_scan,
+    synthetic_sheet_rows,
+    synthetic_window,
+)
+from triangulate import distance_weights, multilaterate, triangulate_window
+from utils import COLUMNS, SheetsSink, ll_to_xy
+
+# Offline benchmarks for every stage of the pipeline, from the sniffer on the Pi to the dashboard.
+# Each stage is set up for a number of visitors and returns (run, items): `run` is timed and
+# `items` is the number of frames / devices / observations it processes, used for the throughput.
+
+BASELINE_PATH = "benchmark_baseline.json"
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+FRAMES_PER_VISITOR = 2
+# the str(dict) encoder is quadratic, larger scans take minutes
+LEGACY_MAX_SIZE = 20_000
+# cell length for `check_split_windows`, short enough for deltas to span several cells
+SPLIT_CELL_LENGTH = 1_000
+# legacy cells hold about 3,000 devices each
+LEGACY_CELL_DEVICES = 3_000
+# devices per cell of the historical sheets in the legacy_cells stages, whose size is the number of cells
+HISTORY_CELL_DEVICES = 30
+# sensors and fraction of missing observations in the multilateration stage
+MULTILATERATION_SENSORS = 24
+MISSING_FRACTION = 0.3
+
+
+# The dashboard before the long format kept the crowd data as dicts in DataFrame cells. This
+# pipeline is kept here as the reference for the `*_dict` and `parse*` stages.
+
+def decode_crowd_column(cells: pd.Series) -> list[dict]:
+    """
+    Vectorized decoder for cells written by `encoding.encode_crowd_data`.
+    All cells are decoded into one record array, which is then split back into one dict per cell.
+    """
+    raw = [base64.b64decode(cell[len(ENCODING_PREFIX):]) for cell in cells]
+    buffer = b"".join(raw)
+    records = np.frombuffer(buffer, dtype=">u4")
+
+    # each record is 8 hex characters, the first 6 of which are the mac hash
+    macs = np.frombuffer(buffer.hex().encode(), dtype="S8").astype("S6").astype(str).tolist()
+    rssi = (records & 0xFF).astype(np.uint8).view(np.int8).tolist()
+
+    offsets = np.cumsum([0] + [len(r) // 4 for r in raw]).tolist()
+    return [
+        dict(zip(macs[start:end], rssi[start:end]))
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+def parse_crowd_column(cells: pd.Series) -> pd.Series:
+    """Parse a column of crowd data cells, in either the encoded or the legacy str(dict) format."""
+    encoded = cells.str.startswith(ENCODING_PREFIX, na=False).to_numpy(dtype=bool)
+    parsed = pd.Series([None] * len(cells), index=cells.index, dtype=object)
+    parsed[encoded] = decode_crowd_column(cells[encoded])
+    parsed[~encoded] = cells[~encoded].apply(parse_crowd)
+    return parsed
+
+
+def explode_crowd_data(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert a DataFrame with crowd data dicts in its cells into observations in long format."""
+    lengths = df["crowd_data"].apply(len).to_numpy()
+    return pd.DataFrame({
+        "timestamp": np.repeat(df["timestamp"].to_numpy(dtype="datetime64[ns]"), lengths),
+        "device_name": pd.Categorical(np.repeat(df["device_name"].to_numpy(dtype=object), lengths)),
+        "mac_id": np.fromiter((int(mac, 16) for crowd in df["crowd_data"] for mac in crowd), dtype=np.int32, count=lengths.sum()),
+        "rssi": np.fromiter((rssi for crowd in df["crowd_data"] for rssi in crowd.values()), dtype=np.int8, count=lengths.sum()),
+    })
+
+
+def merge_dicts(dicts) -> dict:
+    merged = {}
+    for d in dicts:
+        merged.update(d)
+    return merged
+
+
+def parse_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """Parse the crowd data and timestamps of raw sheet rows (see `utils.COLUMNS`)."""
+    df = df.copy()
+    df["crowd_data"] = parse_crowd_column(df["crowd_data"])
+    df["timestamp"] = pd.to_datetime(df["timestamp"], errors="coerce")
+    return df
+
+
+def bin_data(df: pd.DataFrame, resolution: str = TIME_BIN) -> pd.DataFrame:
+    """
+    Bin parsed rows into one row per device and time bin of the given `resolution`,
+    with the crowd data of the bin merged.
+    """
+    df = df.assign(time_bin=df["timestamp"].dt.floor(resolution))
+    df = (
+        df.groupby(["device_name", "time_bin"], as_index=False)
+        .agg({"crowd_data": merge_dicts})
+        .rename(columns={"time_bin": "timestamp"})
+    )
+    df["crowd_count"] = df["crowd_data"].apply(len)
+    return df
+
+
+def setup_sniff_scapy(size: int, packet_rate: float | None = None, **kwargs):
+    frames = synthetic_frames(size * FRAMES_PER_VISITOR, size)
+    table = DeviceTable()
+
+    def handler(frame):
+        # dissection is part of the cost of the scapy backend
+        packet_handler(RadioTap(frame), table)
+
+    return partial(feed_frames, frames, handler, packet_rate), len(frames)
+
+
+def setup_sniff_raw(size: int, packet_rate: float | None = None, **kwargs):
+    frames = [memoryview(frame) for frame in synthetic_frames(size * FRAMES_PER_VISITOR, size)]
+    handler = partial(raw_packet_handler, table=DeviceTable())
+    return partial(feed_frames, frames, handler, packet_rate), len(frames)
+
+
+def setup_encode(size: int, **kwargs):
+    crowd_data = synthetic_scan(size)
+    return partial(encode_crowd_data, crowd_data, MAX_LENGTH), size
+
+
+def setup_encode_legacy(size: int, **kwargs):
+    if size > LEGACY_MAX_SIZE:
+        return None, size
+    crowd_data = synthetic_scan(size)
+
+    def run():
+        return [str(d) for d in split_dict_by_max_length(crowd_data, MAX_LENGTH)]
+
+    return run, size
+
+
+def setup_parse(size: int, **kwargs):
+    cells = pd.Series(encode_crowd_data(synthetic_scan(size), MAX_LENGTH), dtype=object)
+    return partial(parse_crowd_column, cells), size
+
+
+def setup_parse_legacy(size: int, **kwargs):
+    items = list(synthetic_scan(size).items())
+    cells = pd.Series(
+        [str(dict(items[i:i + LEGACY_CELL_DEVICES])) for i in range(0, size, LEGACY_CELL_DEVICES)],
+        dtype=object,
+    )
+    return partial(parse_crowd_column, cells), size
+
+
+@lru_cache(maxsize=1)
+def history_cells(size: int) -> pd.Series:
+    items = list(synthetic_scan(size + HISTORY_CELL_DEVICES).items())
+    rng = np.random.default_rng(0)
+    return pd.Series(
+        [str(dict(items[i:i + int(rng.integers(1, 2 * HISTORY_CELL_DEVICES))])) for i in rng.integers(0, size, size=size)],
+        dtype=object,
+    )
+
+
+def setup_legacy_cells_apply(size: int, **kwargs):
+    cells = history_cells(size)
+    return partial(cells.apply, parse_crowd), size
+
+
+def setup_legacy_cells_bulk(size: int, processes: int = 1, **kwargs):
+    cells = history_cells(size)
+    offsets, keys, values = parse_dict_column(cells, processes)
+    for i, crowd in enumerate(cells.apply(parse_crowd)):
+        entries = zip(keys[offsets[i]:offsets[i + 1]], values[offsets[i]:offsets[i + 1]].tolist())
+        if list(entries) != list(crowd.items()):
+            raise AssertionError(f"parse_dict_column differs from parse_crowd on cell {i}")
+    return partial(parse_dict_column, cells, processes), size
+
+
+def setup_legacy_cells_pool(size: int, **kwargs):
+    return setup_legacy_cells_bulk(size, processes=os.cpu_count() or 1)
+
+
+def check_malformed_cells() -> None:
+    """Raises AssertionError unless the mirror reads malformed cells as empty and mirrors the rows after them."""
+    good = encode_records([0xABCDEF], [-50], MAX_LENGTH)[0]
+    rows = [
+        [DEVICES[0], "2025-07-03 20:00", prefix + payload]
+        for prefix in (ENCODING_PREFIX, KEYFRAME_PREFIX, DELTA_PREFIX)
+        # bad base64, a payload that is not whole records, not base64 at all
+        for payload in ("AAA", "AAAAAAAA", "!!!!")
+    ] + [[DEVICES[0], "2025-07-03 20:10", good]]
+    mirror = SheetMirror(SheetsSink(FakeWorksheet(rows)))
+    mirror.sync()
+    if mirror.cursor != len(rows) or mirror.rollups.observation_count != 1:
+        raise AssertionError(
+            f"malformed cells: {mirror.cursor} of {len(rows)} rows mirrored, "
+            f"{mirror.rollups.observation_count} observations instead of 1"
+        )
+
+
+def setup_read_data(size: int, days: float = 1, **kwargs):
+    check_malformed_cells()
+    sheet = FakeWorksheet(synthetic_sheet_rows(size, days=days))
+    scans = int(days * 24 * 3600 / SCAN_DURATION)
+    observations = scans * len(DEVICES) * max(1, int(size * SEEN_FRACTION))
+
+    def run():
+        return SheetMirror(SheetsSink(sheet)).sync()
+
+    return run, observations
+
+
+def setup_triangulation(size: int, **kwargs):
+    df = synthetic_window(size)
+    origin_ll = DEVICE_LL[DEVICES[0]]
+    device_xy = {dev: ll_to_xy(*ll, *origin_ll) for dev, ll in DEVICE_LL.items()}
+    return partial(triangulate_window, df, device_xy, origin_ll, N=3.0, measured_power=-16.0), size
+
+
+@lru_cache(maxsize=1)
+def sheet_frame(size: int, days: float) -> pd.DataFrame:
+    return pd.DataFrame(list(synthetic_sheet_rows(size, days=days)), columns=COLUMNS)
+
+
+# The *_dict stages run the same operation on crowd data dicts in DataFrame cells,
+# the data model the dashboard used before observations in long format.
+
+def setup_count_dict(size: int, days: float = 1, **kwargs):
+    rows = parse_rows(sheet_frame(size, days))
+    return partial(bin_data, rows, TIME_BIN), len(parse_observations(sheet_frame(size, days)))
+
+
+def setup_count_long(size: int, days: float = 1, **kwargs):
+    observations = parse_observations(sheet_frame(size, days))
+    return partial(count_observations, observations, TIME_BIN), len(observations)
+
+
+def setup_unique_dict(size: int, days: float = 1, **kwargs):
+    binned = bin_data(parse_rows(sheet_frame(size, days)), TIME_BIN)
+
+    def run():
+        return binned.groupby("timestamp")["crowd_data"].agg(lambda dicts: len(set().union(*dicts)))
+
+    return run, len(parse_observations(sheet_frame(size, days)))
+
+
+def setup_unique_long(size: int, days: float = 1, **kwargs):
+    observations = parse_observations(sheet_frame(size, days))
+    return partial(unique_counts, observations, TIME_BIN), len(observations)
+
+
+def setup_triangulation_dict(size: int, **kwargs):
+    window = synthetic_window(size)
+    df = pd.DataFrame([
+        {
+            "device_name": dev,
+            "timestamp": group["timestamp"].iloc[0],
+            "crowd_data": dict(zip((f"{mac:06x}" for mac in group["mac_id"]), group["rssi"].tolist())),
+        }
+        for dev, group in window.groupby("device_name", observed=True)
+    ])
+    origin_ll = DEVICE_LL[DEVICES[0]]
+    device_xy = {dev: ll_to_xy(*ll, *origin_ll) for dev, ll in DEVICE_LL.items()}
+
+    def run():
+        return triangulate_window(explode_crowd_data(df), device_xy, origin_ll, N=3.0, measured_power=-16.0)
+
+    return run, size
+
+
+def dict_cells_size(crowd_data: pd.Series) -> int:
+    """Bytes held by the crowd data dicts of a column, including their keys and values."""
+    return sum(
+        sys.getsizeof(crowd) + sum(sys.getsizeof(mac) + sys.getsizeof(rssi) for mac, rssi in crowd.items())
+        for crowd in crowd_data
+    )
+
+
+def footprint(size: int, days: float) -> tuple[float, float]:
+    """Memory in MB of a day of crowd data as dicts in cells (binned) and as observations in long format."""
+    binned = bin_data(parse_rows(sheet_frame(size, days)), TIME_BIN)
+    dict_bytes = binned.drop(columns="crowd_data").memory_usage(deep=True).sum() + dict_cells_size(binned["crowd_data"])
+    long_bytes = parse_observations(sheet_frame(size, days)).memory_usage(deep=True).sum()
+    return dict_bytes / 2**20, long_bytes / 2**20
+
+
+def upload_sizes(windows: list[dict[int, int]], device_name: str = DEVICES[0]) -> tuple[list, list, int]:
+    """
+    Encode consecutive windows of one sensor in full and in delta mode.
+    Returns the rows of both modes and the largest RSSI error of the windows reconstructed from the deltas.
+    """
+    encoder = DeltaEncoder()
+    full_rows, delta_rows = [], []
+    for i, window in enumerate(windows):
+        timestamp = (START + pd.Timedelta(seconds=i * SCAN_DURATION)).strftime("%Y-%m-%d %H:%M")
+        full_rows += [[device_name, timestamp, cell] for cell in encode_records(window.keys(), window.values(), MAX_LENGTH)]
+        delta_rows += [[device_name, timestamp, cell] for cell in encoder.encode(window.keys(), window.values(), MAX_LENGTH)]
+
+    full = parse_observations(pd.DataFrame(full_rows, columns=COLUMNS))
+    reconstructed = parse_observations(pd.DataFrame(delta_rows, columns=COLUMNS))
+    keys = ["timestamp", "mac_id"]
+    merged = full[keys + ["rssi"]].merge(reconstructed[keys + ["rssi"]], on=keys, how="outer", indicator=True)
+    if (merged["_merge"] != "both").any():
+        raise AssertionError("delta reconstruction has different devices than the full windows")
+    max_error = int((merged["rssi_x"].astype(int) - merged["rssi_y"].astype(int)).abs().max())
+
+    check_split_windows(windows, device_name)
+    return full_rows, delta_rows, max_error
+
+
+def check_split_windows(windows: list[dict[int, int]], device_name: str = DEVICES[0], max_length: int = SPLIT_CELL_LENGTH) -> None:
+    """
+    Decode the delta uploads of `windows` once whole and once with every window split across
+    two syncs before its last cell, as the mirror may read them. Short cells make deltas span
+    several cells, with the gone devices in the last ones. Raises AssertionError if the
+    reconstructed windows differ.
+    """
+    encoder = DeltaEncoder()
+    rows = []
+    for i, window in enumerate(windows):
+        timestamp = (START + pd.Timedelta(seconds=i * SCAN_DURATION)).strftime("%Y-%m-%d %H:%M")
+        rows += [[device_name, timestamp, cell] for cell in encoder.encode(window.keys(), window.values(), max_length)]
+    whole = parse_observations(pd.DataFrame(rows, columns=COLUMNS))
+
+    decoder = DeltaDecoder()
+    # before the last cell of every window with several cells
+    bounds = [0] + [
+        i for i in range(1, len(rows))
+        if rows[i][:2] == rows[i - 1][:2] and (i + 1 == len(rows) or rows[i + 1][:2] != rows[i][:2])
+    ] + [len(rows)]
+    parts = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        sync = pd.DataFrame(rows[first:last], columns=COLUMNS)
+        parts.append(decoder.decode(pd.to_datetime(sync["timestamp"]), sync["device_name"], sync["crowd_data"]))
+    parts.append(decoder.flush())
+    split = concat_frames(parts)
+
+    keys = ["timestamp", "mac_id"]
+    merged = whole[keys + ["rssi"]].merge(split[keys + ["rssi"]], on=keys, how="outer", indicator=True)
+    if (merged["_merge"] != "both").any() or (merged["rssi_x"] != merged["rssi_y"]).any():
+        raise AssertionError(
+            f"delta reconstruction differs when windows are split across syncs: "
+            f"{(merged['_merge'] == 'right_only').sum()} extra, {(merged['_merge'] == 'left_only').sum()} missing observations"
+        )
+
+
+def mirror_windows(path: str) -> dict[str, list[dict[int, int]]]:
+    """Windows of every device in a dashboard mirror (see `SheetMirror`), to replay real uploads."""
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute("SELECT device_name, timestamp, crowd_data FROM rows ORDER BY row").fetchall()
+    observations = parse_observations(pd.DataFrame(rows, columns=COLUMNS))
+    return {
+        device_name: [
+            dict(zip(window["mac_id"].tolist(), window["rssi"].tolist()))
+            for _, window in device_rows.groupby("timestamp")
+        ]
+        for device_name, device_rows in observations.groupby("device_name", observed=True)
+    }
+
+
+def report_uploads(size: int, windows: int, mirror: str | None = None) -> None:
+    """Print the upload size in full and in delta mode, on synthetic windows or replayed from a mirror."""
+    if mirror:
+        sensors = mirror_windows(mirror)
+    else:
+        sensors = {DEVICES[0]: list(synthetic_crowd_windows(size, windows))}
+
+    print(f"\n{'device':<10} {'windows':>8} {'full cells':>11} {'full chars':>12} {'delta cells':>12} {'delta chars':>12} {'saving':>7} {'max error':>10}")
+    for device_name, device_windows in sensors.items():
+        full_rows, delta_rows, max_error = upload_sizes(device_windows, device_name)
+        full_chars = sum(len(row[2]) for row in full_rows)
+        delta_chars = sum(len(row[2]) for row in delta_rows)
+        print(
+            f"{device_name:<10} {len(device_windows):>8} {len(full_rows):>11} {full_chars:>12,} "
+            f"{len(delta_rows):>12} {delta_chars:>12,} {1 - delta_chars / full_chars:>7.0%} {max_error:>7} dB"
+        )
+
+
+def setup_multilateration(size: int, **kwargs):
+    rng = np.random.default_rng(0)
+    anchors = rng.uniform(0, 1_000, size=(MULTILATERATION_SENSORS, 2))
+    points = rng.uniform(0, 1_000, size=(size, 2))
+    D = np.linalg.norm(points[:, None, :] - anchors[None, :, :], axis=2)
+    D *= np.exp(rng.normal(0, 0.1, size=D.shape))
+    D[rng.random(D.shape) < MISSING_FRACTION] = np.nan
+    return partial(multilaterate, D, anchors, distance_weights(D)), size
+
+
+STAGES = {
+    "sniff_scapy": setup_sniff_scapy,
+    "sniff_raw": setup_sniff_raw,
+    "encode": setup_encode,
+    "encode_legacy": setup_encode_legacy,
+    "parse": setup_parse,
+    "parse_legacy": setup_parse_legacy,
+    "legacy_cells_apply": setup_legacy_cells_apply,
+    "legacy_cells_bulk": setup_legacy_cells_bulk,
+    "legacy_cells_pool": setup_legacy_cells_pool,
+    "read_data": setup_read_data,
+    "triangulation": setup_triangulation,
+    "triangulation_dict": setup_triangulation_dict,
+    "multilateration": setup_multilateration,
+    "count_dict": setup_count_dict,
+    "count_long": setup_count_long,
+    "unique_dict": setup_unique_dict,
+    "unique_long": setup_unique_long,
+}
+
+
+def measure(run, repeats: int) -> tuple[float, float]:
+    """Return the best time in seconds over `repeats` runs and the peak memory in MB of one traced run."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(timings), peak / 2**20
+
+
+def main():
+    parser = ArgumentParser(description="Benchmarks for the crowd monitoring pipeline")
+    parser.add_argument("stages", nargs="*", default=list(STAGES), help=f"Any of {', '.join(STAGES)} (default: all)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Number of visitors")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--days", type=float, default=1, help="Days of sheet rows for read_data and the count/unique stages")
+    parser.add_argument("--packet_rate", type=float, default=None, help="Pace the sniff stages at this many frames per second")
+    parser.add_argument("--baseline", type=str, default=BASELINE_PATH)
+    parser.add_argument("--save_baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative throughput drop against the baseline")
+    parser.add_argument("--footprint", action="store_true", help="Also compare the memory of the dict and long data models")
+    parser.add_argument("--uploads", action="store_true", help="Also compare the upload size in full and in delta mode")
+    parser.add_argument("--windows", type=int, default=288, help="Synthetic windows for --uploads")
+    parser.add_argument("--mirror", type=str, default=None, help="Replay the uploads of a dashboard mirror for --uploads")
+
+    args = parser.parse_args()
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = 0
+    print(f"{'stage':<18} {'visitors':>9} {'best [s]':>9} {'items/s':>13} {'peak [MB]':>10} {'vs baseline':>12}")
+    for stage in args.stages:
+        for size in args.sizes:
+            run, items = STAGES[stage](size, packet_rate=args.packet_rate, days=args.days)
+            if run is None:
+                print(f"{stage:<18} {size:>9} {'skipped':>9}")
+                continue
+
+            seconds, peak = measure(run, args.repeats)
+            throughput = items / seconds
+            results.setdefault(stage, {})[str(size)] = throughput
+
+            comparison = ""
+            reference = baseline.get(stage, {}).get(str(size))
+            if reference:
+                ratio = throughput / reference
+                comparison = f"{ratio:.2f}x"
+                if ratio < 1 - args.tolerance:
+                    comparison += " REGRESSION"
+                    regressions += 1
+
+            print(f"{stage:<18} {size:>9} {seconds:>9.3f} {throughput:>13,.0f} {peak:>10.1f} {comparison:>12}")
+
+    if args.footprint:
+        print(f"\n{'visitors':>9} {'dicts [MB]':>11} {'long [MB]':>10}")
+        for size in args.sizes:
+            dict_mb, long_mb = footprint(size, args.days)
+            print(f"{size:>9} {dict_mb:>11.1f} {long_mb:>10.1f}")
+
+    if args.uploads:
+        for size in ([None] if args.mirror else args.sizes):
+            report_uploads(size, args.windows, args.mirror)
+
+    if args.save_baseline:
+        for stage, sizes in results.items():
+            baseline.setdefault(stage, {}).update(sizes)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import json
+import os
+import threading
+from argparse import ArgumentParser
+from array import array
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from encoding import pack_batch, unpack_batch
+
+# Collector for the uploads of the sensors, an alternative to the Google Sheet that runs on a
+# laptop on the festival LAN (see `utils.CollectorSink`). Only the standard library is needed.
+#
+#   POST /windows                 append a batch of rows (see `encoding.pack_batch`)
+#   GET  /rows?start=N&limit=M    the rows after the first N rows, as a batch
+
+STORE_DIR = "collector_store"
+PORT = 8000
+MAX_READ_ROWS = 10_000
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class ColumnStore:
+    """
+    Append-only columnar store of uploaded rows, one file per column in `directory`:
+    `device` (uint16 index into devices.json), `timestamp` (int64 seconds since the epoch),
+    `kind` (uint8, see `encoding.cell_to_payload`), `offset` (uint64 end of the row in
+    `payload`) and `payload` (the payloads back to back). Columns are in native byte order.
+
+    `offset` is written last, so its length is the number of complete rows; anything beyond
+    that in the other files is left over from a crash and cut off when the store is opened.
+    """
+
+    _COLUMNS = {"device": "H", "timestamp": "q", "kind": "B", "offset": "Q"}
+
+    def __init__(self, directory: str = STORE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock = threading.Lock()
+
+        self.devices_path = os.path.join(directory, "devices.json")
+        self.devices: list[str] = []
+        if os.path.exists(self.devices_path):
+            with open(self.devices_path) as f:
+                self.devices = json.load(f)
+        self.device_codes = {name: code for code, name in enumerate(self.devices)}
+
+        self.rows = os.path.getsize(self._path("offset")) // 8 if os.path.exists(self._path("offset")) else 0
+        self.payload_size = self._read_column("offset", self.rows - 1, self.rows)[0] if self.rows else 0
+        for column, typecode in self._COLUMNS.items():
+            self._truncate(column, self.rows * array(typecode).itemsize)
+        self._truncate("payload", self.payload_size)
+
+        self.files = {column: open(self._path(column), "ab") for column in (*self._COLUMNS, "payload")}
+
+    def _path(self, column: str) -> str:
+        return os.path.join(self.directory, column)
+
+    def _truncate(self, column: str, size: int) -> None:
+        with open(self._path(column), "ab") as f:
+            if f.tell() > size:
+                f.truncate(size)
+
+    def _read_column(self, column: str, start: int, end: int) -> array:
+        values = array(self._COLUMNS[column])
+        with open(self._path(column), "rb") as f:
+            f.seek(start * values.itemsize)
+            values.fromfile(f, end - start)
+        return values
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def append(self, rows: list[tuple[str, str, int, bytes]]) -> None:
+        """Append (device_name, timestamp, kind, payload) rows. Raises ValueError on an invalid timestamp."""
+        timestamps = array("q", (int((datetime.fromisoformat(row[1]) - _EPOCH).total_seconds()) for row in rows))
+        with self.lock:
+            new_devices = [row[0] for row in rows if row[0] not in self.device_codes]
+            if new_devices:
+                for name in dict.fromkeys(new_devices):
+                    self.device_codes[name] = len(self.devices)
+                    self.devices.append(name)
+                with open(self.devices_path + ".tmp", "w") as f:
+                    json.dump(self.devices, f)
+                os.replace(self.devices_path + ".tmp", self.devices_path)
+
+            offsets = array("Q")
+            for _, _, _, payload in rows:
+                self.files["payload"].write(payload)
+                self.payload_size += len(payload)
+                offsets.append(self.payload_size)
+            self.files["payload"].flush()
+
+            columns = {
+                "device": array("H", (self.device_codes[row[0]] for row in rows)),
+                "timestamp": timestamps,
+                "kind": array("B", (row[2] for row in rows)),
+                "offset": offsets,
+            }
+            # dict order: `offset` goes last, it commits the rows
+            for column, values in columns.items():
+                values.tofile(self.files[column])
+                self.files[column].flush()
+            self.rows += len(rows)
+
+    def read(self, start: int, limit: int) -> list[tuple[str, str, int, bytes]]:
+        """Up to `limit` (device_name, timestamp, kind, payload) rows after the first `start` rows."""
+        with self.lock:
+            end = min(self.rows, start + limit)
+            devices = list(self.devices)
+        if end <= start:
+            return []
+
+        columns = {column: self._read_column(column, start, end) for column in ("device", "timestamp", "kind")}
+        ends = self._read_column("offset", start, end)
+        first = self._read_column("offset", start - 1, start)[0] if start else 0
+        with open(self._path("payload"), "rb") as f:
+            f.seek(first)
+            payloads = f.read(ends[-1] - first)
+
+        rows = []
+        for i in range(end - start):
+            begin = (ends[i - 1] if i else first) - first
+            timestamp = _EPOCH + timedelta(seconds=columns["timestamp"][i])
+            rows.append((
+                devices[columns["device"][i]],
+                timestamp.isoformat(sep=" "),
+                columns["kind"][i],
+                payloads[begin:ends[i] - first],
+            ))
+        return rows
+
+
+class CollectorHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection of every sensor open between uploads
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/octet-stream", headers: dict | None = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str) -> None:
+        self._send(status, json.dumps({"error": message}).encode(), "application/json")
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlsplit(self.path).path != "/windows":
+            self._send_error(404, f"Unknown path {self.path}")
+            return
+
+        try:
+            rows = unpack_batch(body)
+            self.server.store.append(rows)
+        except ValueError as e:
+            self._send_error(400, str(e))
+            return
+        self._send(200, json.dumps({"rows": len(self.server.store)}).encode(), "application/json")
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != "/rows":
+            self._send_error(404, f"Unknown path {self.path}")
+            return
+
+        query = parse_qs(url.query)
+        try:
+            start = int(query.get("start", ["0"])[0])
+            limit = min(int(query.get("limit", [str(MAX_READ_ROWS)])[0]), MAX_READ_ROWS)
+        except ValueError as e:
+            self._send_error(400, str(e))
+            return
+        rows = self.server.store.read(max(start, 0), max(limit, 0))
+        self._send(200, pack_batch(rows), headers={"X-Total-Rows": str(len(self.server.store))})
+
+
+def main():
+    parser = ArgumentParser(description="Collect the uploads of the sensors on the local network")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--store", type=str, default=STORE_DIR, help="Directory of the columnar store")
+
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), CollectorHandler)
+    server.store = ColumnStore(args.store)
+    print(f"Collecting into {args.store} ({len(server.store)} rows) on {args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
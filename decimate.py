@@ -0,0 +1,46 @@
+import numpy as np
+
+# Downsampling of time series to a fixed number of points before they are sent to a chart,
+# so drawing a week of 10 min bins costs the browser the same as drawing an hour.
+# Largest-Triangle-Three-Buckets keeps the points that shape the curve (peaks, dips and
+# steps) instead of every n-th point, so the decimated chart looks like the full one.
+
+# points per series, about one per horizontal pixel of a chart on a wide screen
+PIXEL_BUDGET = 1_000
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int = PIXEL_BUDGET) -> np.ndarray:
+    """
+    Indices of the points of (x, y) kept by Largest-Triangle-Three-Buckets downsampling.
+
+    The first and last point are always kept. The points in between are split into
+    `threshold - 2` buckets of equal size; of every bucket the point is kept that spans the
+    largest triangle with the point kept from the previous bucket and the mean of the next one.
+    `x` must be sorted. Series with at most `threshold` points are returned whole.
+    """
+    n = len(x)
+    if n <= threshold or threshold < 3:
+        return np.arange(n)
+
+    # relative to the first point, epoch nanoseconds would lose precision in the products
+    x = np.asarray(x, dtype=np.float64) - float(x[0])
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    # mean of every bucket; the bucket after the last one is the last point
+    counts = np.diff(edges)
+    mean_x = np.append(np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / counts, x[-1])
+    mean_y = np.append(np.add.reduceat(y[1:n - 1], edges[:-1] - 1) / counts, y[-1])
+
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # twice the area of the triangle (a, point, mean of the next bucket), up to the sign
+        areas = np.abs(
+            (x[a] - mean_x[bucket + 1]) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (mean_y[bucket + 1] - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        kept[bucket + 1] = a
+    return kept
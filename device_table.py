@@ -0,0 +1,107 @@
+import time
+from array import array
+
+import numpy as np
+
+# Per-window device state of the sniffer in a direct-addressed table.
+# The hash from `sniff.hash_mac` is exactly 24 bits, so every device has a fixed slot in
+# arrays of 2**24 entries: memory is allocated once (about 200 MB of address space) and
+# recording a frame allocates nothing. Only the slots touched in a window are read out and reset.
+
+HASH_BITS = 24
+TABLE_SIZE = 1 << HASH_BITS
+MAX_FRAMES = 0xFFFF
+
+
+def _zeros(typecode: str, size: int) -> memoryview:
+    """
+    `size` zeros of the `array` type `typecode`. NumPy allocates them zeroed by the kernel, so
+    only the pages of slots that are written take memory; the memoryview reads and writes
+    plain ints per slot, as fast as an array.
+    """
+    return memoryview(np.zeros(size, dtype=typecode)).cast("B").cast(typecode)
+
+
+class WindowStats:
+    """
+    Statistics of the devices seen in one window, one entry per device in first-seen order.
+    `first_seen` and `last_seen` are milliseconds after the start of the window.
+    """
+
+    def __init__(self):
+        self.hashes = array("I")
+        self.last_rssi = array("b")
+        self.min_rssi = array("b")
+        self.max_rssi = array("b")
+        self.frames = array("H")
+        self.first_seen = array("I")
+        self.last_seen = array("I")
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def total_frames(self) -> int:
+        return sum(self.frames)
+
+    def to_dict(self) -> dict[str, int]:
+        """Device -> last RSSI, with the devices as 6 hex character hashes (the format of `hash_mac`)."""
+        return {f"{mac_hash:06x}": rssi for mac_hash, rssi in zip(self.hashes, self.last_rssi)}
+
+
+class DeviceTable:
+    """
+    Direct-addressed device state of the current window, indexed by the integer mac hash:
+    int8 last/min/max RSSI, uint16 frame count (saturating) and uint32 first/last seen
+    in milliseconds after the window start.
+
+    A slot is in use if its frame count is non-zero; `touched` lists the slots in use, so
+    `snapshot` and `reset` take time proportional to the devices seen, not to the table size.
+    """
+
+    def __init__(self, size: int = TABLE_SIZE):
+        self.last_rssi = _zeros("b", size)
+        self.min_rssi = _zeros("b", size)
+        self.max_rssi = _zeros("b", size)
+        self.frames = _zeros("H", size)
+        self.first_seen = _zeros("I", size)
+        self.last_seen = _zeros("I", size)
+        self.touched = array("I")
+        self.window_start = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.touched)
+
+    def record(self, mac_hash: int, rssi: int) -> None:
+        offset = int((time.monotonic() - self.window_start) * 1000)
+        frames = self.frames[mac_hash]
+        if frames == 0:
+            self.touched.append(mac_hash)
+            self.min_rssi[mac_hash] = rssi
+            self.max_rssi[mac_hash] = rssi
+            self.first_seen[mac_hash] = offset
+        else:
+            if rssi < self.min_rssi[mac_hash]:
+                self.min_rssi[mac_hash] = rssi
+            if rssi > self.max_rssi[mac_hash]:
+                self.max_rssi[mac_hash] = rssi
+        self.last_rssi[mac_hash] = rssi
+        self.last_seen[mac_hash] = offset
+        if frames < MAX_FRAMES:
+            self.frames[mac_hash] = frames + 1
+
+    def snapshot(self) -> WindowStats:
+        """Copy out the state of the touched slots."""
+        stats = WindowStats()
+        stats.hashes = array("I", self.touched)
+        for column in ("last_rssi", "min_rssi", "max_rssi", "frames", "first_seen", "last_seen"):
+            values = getattr(self, column)
+            getattr(stats, column).extend(values[mac_hash] for mac_hash in self.touched)
+        return stats
+
+    def reset(self) -> None:
+        """Start a new window. Other columns are overwritten when a slot is first touched again."""
+        frames = self.frames
+        for mac_hash in self.touched:
+            frames[mac_hash] = 0
+        self.touched = array("I")
+        self.window_start = time.monotonic()
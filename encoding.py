@@ -0,0 +1,174 @@
+import base64
+import struct
+import sys
+from array import array
+
+# Compact encoding of crowd data for the Google Sheet.
+# Every (mac_hash, rssi) pair is packed into one big-endian 4 byte record:
+# the 24 bit hash from `hash_mac` followed by the RSSI as a signed byte.
+# The records are base64 encoded, so a cell holds "b1:" followed by 16 characters per 3 devices,
+# where the old str(dict) format used about 15 characters per device.
+
+ENCODING_PREFIX = "b1:"
+RECORD_SIZE = 4
+
+# Delta uploads (see `DeltaEncoder`) use the same records behind their own prefixes:
+# keyframes hold every device of a window, deltas only the changes since the previous window.
+KEYFRAME_PREFIX = "k1:"
+DELTA_PREFIX = "d1:"
+# RSSI of a device that is gone since the previous window, real signals are never positive
+GONE_RSSI = 127
+KEYFRAME_INTERVAL = 12
+DELTA_THRESHOLD = 3
+
+# Batches of rows for the collector (see `collector.py`) are one binary message instead of text
+# cells: the magic, the number of rows, then per row the device name and the timestamp (a length
+# byte and UTF-8 each), a kind byte and the length-prefixed payload. Cells in the compact encoding
+# travel as their raw records (kind = 1 + index of the prefix in `_RECORD_PREFIXES`), any other
+# cell as UTF-8 text (kind 0).
+BATCH_MAGIC = b"CB1"
+TEXT_KIND = 0
+_RECORD_PREFIXES = (ENCODING_PREFIX, KEYFRAME_PREFIX, DELTA_PREFIX)
+_BATCH_HEADER = struct.Struct(">3sI")
+_PAYLOAD_HEADER = struct.Struct(">BI")
+
+# 3 records are 12 bytes, which base64 encodes to exactly 16 characters (no padding)
+_RECORDS_PER_BLOCK = 3
+_CHARS_PER_BLOCK = 16
+
+
+def encode_crowd_data(crowd_data: dict[str, int], max_length: int) -> list[str]:
+    """
+    Encode crowd data into a list of strings, each at most `max_length` characters long.
+    Runs in a single linear pass over the devices.
+    """
+    return encode_records(
+        (int(mac, 16) for mac in crowd_data), crowd_data.values(), max_length
+    )
+
+
+def encode_records(mac_hashes, rssi, max_length: int, prefix: str = ENCODING_PREFIX) -> list[str]:
+    """`encode_crowd_data` for integer mac hashes and RSSI values, e.g. from a `WindowStats`."""
+    records = array("I", ((mac_hash << 8) | (value & 0xFF) for mac_hash, value in zip(mac_hashes, rssi)))
+    if sys.byteorder == "little":
+        records.byteswap()
+    raw = records.tobytes()
+
+    blocks_per_chunk = (max_length - len(prefix)) // _CHARS_PER_BLOCK
+    chunk_size = blocks_per_chunk * _RECORDS_PER_BLOCK * RECORD_SIZE
+
+    return [
+        prefix + base64.b64encode(raw[i:i + chunk_size]).decode("ascii")
+        for i in range(0, len(raw), chunk_size)
+    ]
+
+
+class DeltaEncoder:
+    """
+    Encodes windows as the changes since the previous window, with a full keyframe every
+    `keyframe_interval` windows.
+
+    A delta holds the devices that appeared, the devices whose RSSI moved at least `threshold` dB
+    away from the value last sent, and the devices that are gone (with RSSI `GONE_RSSI`).
+    A keyframe is also sent whenever it would be smaller than the delta.
+    The encoder tracks the state the dashboard reconstructs from the uploads, so the RSSI
+    there is never more than `threshold` dB off. Every window gets at least one cell, an
+    empty delta is just the prefix.
+    """
+
+    def __init__(self, keyframe_interval: int = KEYFRAME_INTERVAL, threshold: int = DELTA_THRESHOLD):
+        self.keyframe_interval = keyframe_interval
+        self.threshold = threshold
+        self.sent: dict[int, int] = {}
+        self.windows_since_keyframe: int | None = None
+
+    def encode(self, mac_hashes, rssi, max_length: int) -> list[str]:
+        current = dict(zip(mac_hashes, rssi))
+        if self.windows_since_keyframe is None or self.windows_since_keyframe + 1 >= self.keyframe_interval:
+            return self._keyframe(current, max_length)
+
+        sent = self.sent
+        changed = {
+            mac_hash: value for mac_hash, value in current.items()
+            if mac_hash not in sent or abs(value - sent[mac_hash]) >= self.threshold
+        }
+        gone = [mac_hash for mac_hash in sent if mac_hash not in current]
+        # when most of the crowd changed, a keyframe is smaller than the delta
+        if len(changed) + len(gone) >= len(current):
+            return self._keyframe(current, max_length)
+
+        for mac_hash in gone:
+            del sent[mac_hash]
+        sent.update(changed)
+        self.windows_since_keyframe += 1
+
+        mac_hashes = list(changed) + gone
+        values = list(changed.values()) + [GONE_RSSI] * len(gone)
+        return encode_records(mac_hashes, values, max_length, DELTA_PREFIX) or [DELTA_PREFIX]
+
+    def reset(self) -> None:
+        """Send a keyframe next, after windows were lost on the way to the dashboard."""
+        self.windows_since_keyframe = None
+
+    def _keyframe(self, current: dict[int, int], max_length: int) -> list[str]:
+        self.sent = current
+        self.windows_since_keyframe = 0
+        return encode_records(current.keys(), current.values(), max_length, KEYFRAME_PREFIX) or [KEYFRAME_PREFIX]
+
+
+def cell_to_payload(cell: str) -> tuple[int, bytes]:
+    """(kind, payload) of a cell for `pack_batch`."""
+    for kind, prefix in enumerate(_RECORD_PREFIXES, start=1):
+        if cell.startswith(prefix):
+            return kind, base64.b64decode(cell[len(prefix):])
+    return TEXT_KIND, cell.encode()
+
+
+def payload_to_cell(kind: int, payload: bytes) -> str:
+    """Inverse of `cell_to_payload`."""
+    if kind == TEXT_KIND:
+        return payload.decode()
+    return _RECORD_PREFIXES[kind - 1] + base64.b64encode(payload).decode("ascii")
+
+
+def pack_batch(rows) -> bytes:
+    """Pack (device_name, timestamp, kind, payload) rows into one batch message."""
+    parts = [b""]
+    count = 0
+    for device_name, timestamp, kind, payload in rows:
+        for field in (device_name.encode(), timestamp.encode()):
+            if len(field) > 0xFF:
+                raise ValueError(f"Field too long for a batch: {field[:32]!r}...")
+            parts.append(bytes([len(field)]) + field)
+        parts.append(_PAYLOAD_HEADER.pack(kind, len(payload)))
+        parts.append(payload)
+        count += 1
+    parts[0] = _BATCH_HEADER.pack(BATCH_MAGIC, count)
+    return b"".join(parts)
+
+
+def unpack_batch(data: bytes) -> list[tuple[str, str, int, bytes]]:
+    """Inverse of `pack_batch`. Raises ValueError on a malformed batch."""
+    try:
+        magic, count = _BATCH_HEADER.unpack_from(data)
+        if magic != BATCH_MAGIC:
+            raise ValueError(f"Not a batch: {magic!r}")
+        rows = []
+        position = _BATCH_HEADER.size
+        for _ in range(count):
+            fields = []
+            for _ in range(2):
+                length = data[position]
+                fields.append(data[position + 1:position + 1 + length].decode())
+                position += 1 + length
+            kind, length = _PAYLOAD_HEADER.unpack_from(data, position)
+            position += _PAYLOAD_HEADER.size
+            if kind > len(_RECORD_PREFIXES) or position + length > len(data):
+                raise ValueError("Truncated or invalid row in batch")
+            rows.append((fields[0], fields[1], kind, data[position:position + length]))
+            position += length
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed batch: {e}") from e
+    if position != len(data):
+        raise ValueError("Trailing bytes after batch")
+    return rows
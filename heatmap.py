@@ -0,0 +1,61 @@
+import math
+
+import numpy as np
+
+from utils import ll_to_xy, xy_to_ll
+
+# Positions are binned into a weighted grid before they are sent to the map, so the page
+# only holds the non-empty cells instead of one point per visitor.
+
+# width of a grid cell on screen
+CELL_PIXELS = 10
+# upper bound on the number of cells sent to the map, whatever the number of visitors
+MAX_CELLS = 2_000
+# metres per pixel at zoom level 0 on the equator (Web Mercator tiles of 256 pixels)
+_METRES_PER_PIXEL_Z0 = 156_543.03392
+
+
+def cell_size_for_zoom(zoom: float, lat: float, cell_pixels: int = CELL_PIXELS) -> float:
+    """Cell size in metres that shows as `cell_pixels` pixels at `zoom` around latitude `lat`."""
+    return cell_pixels * _METRES_PER_PIXEL_Z0 * math.cos(math.radians(lat)) / 2**zoom
+
+
+def grid_positions(
+    lats: np.ndarray,
+    lons: np.ndarray,
+    origin_ll: tuple[float, float],
+    cell_size: float,
+    max_cells: int = MAX_CELLS,
+) -> list[list[float]]:
+    """
+    Bin positions into a weighted 2D histogram in local metres around `origin_ll`.
+
+    The cell size is doubled until there are at most `max_cells` non-empty cells.
+
+    Returns:
+    - [lat, lon, weight] of the centre of every non-empty cell, as expected by
+      `folium.plugins.HeatMap`. Weights are counts scaled so that the fullest cell has weight 1.
+    """
+    if len(lats) == 0:
+        return []
+
+    x, y = ll_to_xy(np.asarray(lats), np.asarray(lons), origin_ll[0], origin_ll[1])
+    x_min, y_min = x.min(), y.min()
+    # sparse histogram: only occupied cells are materialised, so outliers far
+    # away from the crowd do not blow up the size of the grid
+    while True:
+        ix = ((x - x_min) // cell_size).astype(np.int64)
+        iy = ((y - y_min) // cell_size).astype(np.int64)
+        rows = iy.max() + 1
+        cells, weights = np.unique(ix * rows + iy, return_counts=True)
+        if len(cells) <= max_cells:
+            break
+        cell_size *= 2
+
+    cell_lat, cell_lon = xy_to_ll(
+        x_min + (cells // rows + 0.5) * cell_size,
+        y_min + (cells % rows + 0.5) * cell_size,
+        origin_ll[0],
+        origin_ll[1],
+    )
+    return np.column_stack([cell_lat, cell_lon, weights / weights.max()]).tolist()
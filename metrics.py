@@ -0,0 +1,124 @@
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Counters, gauges and timers for the sensor and the dashboard, exported in the Prometheus
+# text format, as a file (e.g. for the textfile collector of node_exporter) or over HTTP.
+# Only the standard library is used, so the same module runs on the Pi.
+
+
+class Metrics:
+    """
+    Metrics of one process, every name prefixed with `namespace`.
+
+    Counters only go up (names end in `_total`), gauges hold the last value set and timers
+    are summaries in seconds with their count, sum, last and maximum value. Thread-safe.
+    """
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.counters: dict[str, float] = {}
+        self.gauges: dict[str, float] = {}
+        # name -> [count, sum, last, max]
+        self.timers: dict[str, list[float]] = {}
+        self.help: dict[str, str] = {}
+
+    def describe(self, name: str, text: str) -> None:
+        self.help[name] = text
+
+    def inc(self, name: str, amount: float = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name: str, value: float) -> None:
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = seconds
+            timer[3] = max(timer[3], seconds)
+
+    @contextmanager
+    def time(self, name: str):
+        """Observe the duration of the `with` block under `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def to_prometheus(self) -> str:
+        with self.lock:
+            counters, gauges = dict(self.counters), dict(self.gauges)
+            timers = {name: list(values) for name, values in self.timers.items()}
+
+        lines = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name, value in sorted(values.items()):
+                lines += self._header(name, kind)
+                lines.append(f"{self.namespace}_{name} {value:.15g}")
+        for name, (count, total, last, maximum) in sorted(timers.items()):
+            lines += self._header(name, "summary")
+            lines.append(f"{self.namespace}_{name}_count {count:.15g}")
+            lines.append(f"{self.namespace}_{name}_sum {total:.9g}")
+            lines += self._header(f"{name}_last", "gauge")
+            lines.append(f"{self.namespace}_{name}_last {last:.9g}")
+            lines += self._header(f"{name}_max", "gauge")
+            lines.append(f"{self.namespace}_{name}_max {maximum:.9g}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name: str, kind: str) -> list[str]:
+        lines = [f"# TYPE {self.namespace}_{name} {kind}"]
+        if name in self.help:
+            lines.insert(0, f"# HELP {self.namespace}_{name} {self.help[name]}")
+        return lines
+
+    def write_textfile(self, path: str) -> None:
+        """
+        Write the metrics to `path`, atomically, so a scraper never reads half a file.
+        Every call writes its own temporary file, so processes and threads can write concurrently.
+        """
+        directory, name = os.path.split(os.path.abspath(path))
+        # not ending in .prom, which the textfile collector would read
+        descriptor, temporary = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(descriptor, "w") as f:
+                f.write(self.to_prometheus())
+            # mkstemp creates files only readable by their owner
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+
+def serve_metrics(metrics: Metrics, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve `metrics` at http://<host>:<port>/metrics from a background thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) -> None:
+            # scrapes every few seconds would drown the log of the sniffer
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+
+# Inverted index from mac hash to the (timestamp, device, rssi) postings of that visitor.
+# Postings are partitioned by time and sorted by (mac, timestamp) within a partition, so a
+# query only touches the partitions of its time range and ingest only re-sorts the
+# partitions that receive new observations.
+
+PARTITION = "1h"
+# sightings of a visitor further apart than this belong to different visits
+VISIT_GAP = pd.Timedelta("30min")
+
+_COLUMNS = ("mac_id", "timestamp", "device", "rssi")
+
+
+def _sort_postings(columns: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    order = np.lexsort((columns["timestamp"], columns["mac_id"]))
+    return {name: values[order] for name, values in columns.items()}
+
+
+class PostingsIndex:
+    """
+    Postings of every visitor, built incrementally from observations in long format
+    (see `processing.OBSERVATION_DTYPES`).
+
+    `segments[p]` holds the postings of time partition `p` (timestamps in ns divided by the
+    partition length) as arrays `mac_id`, `timestamp` (ns), `device` (index into `devices`)
+    and `rssi`, sorted by (mac_id, timestamp).
+    """
+
+    def __init__(self, partition: str = PARTITION):
+        self.step = pd.Timedelta(partition).value
+        self.devices: list[str] = []
+        self.segments: dict[int, dict[str, np.ndarray]] = {}
+
+    def add(self, observations: pd.DataFrame) -> None:
+        """Add observations; only the partitions they fall into are re-sorted."""
+        if observations.empty:
+            return
+
+        categories = observations["device_name"].cat.categories
+        for name in categories:
+            if name not in self.devices:
+                self.devices.append(name)
+        device_of_code = np.array([self.devices.index(name) for name in categories], dtype=np.int16)
+
+        timestamps = observations["timestamp"].to_numpy().astype(np.int64)
+        new = {
+            "mac_id": observations["mac_id"].to_numpy(),
+            "timestamp": timestamps,
+            "device": device_of_code[observations["device_name"].cat.codes.to_numpy()],
+            "rssi": observations["rssi"].to_numpy(),
+        }
+
+        partitions = timestamps // self.step
+        order = np.argsort(partitions, kind="stable")
+        keys, starts = np.unique(partitions[order], return_index=True)
+        for key, rows in zip(keys.tolist(), np.split(order, starts[1:])):
+            added = {name: values[rows] for name, values in new.items()}
+            if key in self.segments:
+                segment = self.segments[key]
+                added = {name: np.concatenate([segment[name], added[name]]) for name in _COLUMNS}
+            self.segments[key] = _sort_postings(added)
+
+    def __len__(self) -> int:
+        return sum(len(segment["mac_id"]) for segment in self.segments.values())
+
+    def postings(self, mac_id: int) -> pd.DataFrame:
+        """Where and when the visitor with `mac_id` was seen, sorted by timestamp."""
+        parts = []
+        for key in sorted(self.segments):
+            segment = self.segments[key]
+            first, last = np.searchsorted(segment["mac_id"], [mac_id, mac_id + 1])
+            if last > first:
+                parts.append({name: segment[name][first:last] for name in _COLUMNS})
+        return self._frame(parts)
+
+    def _gather(self, start, end, devices: list[str] | None = None) -> dict[str, np.ndarray]:
+        """Postings between `start` and `end` (of `devices` only, if given), sorted by (mac_id, timestamp)."""
+        start, end = pd.Timestamp(start).value, pd.Timestamp(end).value
+        wanted = None
+        if devices is not None:
+            wanted = np.isin(np.arange(len(self.devices)), [self.devices.index(d) for d in devices if d in self.devices])
+
+        parts = []
+        for key in range(start // self.step, end // self.step + 1):
+            segment = self.segments.get(key)
+            if segment is None:
+                continue
+            keep = (segment["timestamp"] >= start) & (segment["timestamp"] <= end)
+            if wanted is not None:
+                keep &= wanted[segment["device"]]
+            parts.append({name: segment[name][keep] for name in _COLUMNS})
+
+        if not parts:
+            return {name: np.empty(0, dtype=np.int64) for name in _COLUMNS}
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in _COLUMNS}
+        # partitions are in time order, so a stable sort by mac keeps every visitor's postings sorted
+        order = np.argsort(columns["mac_id"], kind="stable")
+        return {name: values[order] for name, values in columns.items()}
+
+    def _frame(self, parts: list[dict[str, np.ndarray]]) -> pd.DataFrame:
+        columns = (
+            {name: np.concatenate([part[name] for part in parts]) for name in _COLUMNS}
+            if parts else {name: np.empty(0, dtype=np.int64) for name in _COLUMNS}
+        )
+        return pd.DataFrame({
+            "timestamp": pd.to_datetime(columns["timestamp"]),
+            "device_name": pd.Categorical.from_codes(columns["device"].astype(np.int16), self.devices),
+            "rssi": columns["rssi"],
+        })
+
+    def visits(self, start, end, devices: list[str] | None = None) -> pd.DataFrame:
+        """
+        Visits between `start` and `end`: runs of sightings of a visitor at most `VISIT_GAP` apart.
+
+        Returns:
+        - DataFrame with columns `mac_id`, `start`, `end`, `dwell` and `sightings`, one row per visit
+        """
+        postings = self._gather(start, end, devices)
+        mac_id, timestamp = postings["mac_id"], postings["timestamp"]
+        if len(mac_id) == 0:
+            return pd.DataFrame({
+                "mac_id": pd.Series(dtype=np.int32),
+                "start": pd.Series(dtype="datetime64[ns]"),
+                "end": pd.Series(dtype="datetime64[ns]"),
+                "dwell": pd.Series(dtype="timedelta64[ns]"),
+                "sightings": pd.Series(dtype=np.int64),
+            })
+
+        new_visit = np.ones(len(mac_id), dtype=bool)
+        new_visit[1:] = (mac_id[1:] != mac_id[:-1]) | (np.diff(timestamp) > VISIT_GAP.value)
+        first = np.flatnonzero(new_visit)
+        last = np.append(first[1:], len(mac_id)) - 1
+        return pd.DataFrame({
+            "mac_id": mac_id[first],
+            "start": pd.to_datetime(timestamp[first]),
+            "end": pd.to_datetime(timestamp[last]),
+            "dwell": pd.to_timedelta(timestamp[last] - timestamp[first]),
+            "sightings": last - first + 1,
+        })
+
+    def repeat_visits(self, start, end, devices: list[str] | None = None) -> pd.Series:
+        """Number of visitors by their number of visits between `start` and `end`."""
+        visits_per_visitor = self.visits(start, end, devices)["mac_id"].value_counts()
+        return visits_per_visitor.value_counts().sort_index().rename_axis("visits").rename("visitors")
+
+    def transitions(self, start, end, devices: list[str] | None = None) -> pd.DataFrame:
+        """
+        Sensor-to-sensor transition counts between `start` and `end`.
+
+        A visitor is placed at the device with the strongest RSSI at every timestamp;
+        a transition is a change of device between consecutive placements of the same visit.
+
+        Returns:
+        - DataFrame with the counts of transitions from the device in the index to the device in the columns
+        """
+        postings = self._gather(start, end, devices)
+        mac_id, timestamp, device = postings["mac_id"], postings["timestamp"], postings["device"]
+
+        # strongest device per (mac, timestamp)
+        order = np.lexsort((-postings["rssi"].astype(np.int16), timestamp, mac_id))
+        mac_id, timestamp, device = mac_id[order], timestamp[order], device[order]
+        placed = np.ones(len(mac_id), dtype=bool)
+        placed[1:] = (mac_id[1:] != mac_id[:-1]) | (timestamp[1:] != timestamp[:-1])
+        mac_id, timestamp, device = mac_id[placed], timestamp[placed], device[placed]
+
+        moved = (
+            (mac_id[1:] == mac_id[:-1])
+            & (np.diff(timestamp) <= VISIT_GAP.value)
+            & (device[1:] != device[:-1])
+        )
+        k = len(self.devices)
+        counts = np.bincount(
+            device[:-1][moved].astype(np.int64) * k + device[1:][moved], minlength=k * k
+        ).reshape(k, k)
+
+        matrix = pd.DataFrame(counts, index=self.devices, columns=self.devices)
+        matrix = matrix.rename_axis(index="from", columns="to")
+        if devices is not None:
+            matrix = matrix.reindex(index=devices, columns=devices, fill_value=0)
+        return matrix
@@ -0,0 +1,390 @@
+import base64
+import binascii
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from encoding import DELTA_PREFIX, ENCODING_PREFIX, GONE_RSSI, KEYFRAME_PREFIX, RECORD_SIZE
+
+TIME_BIN = "10min"
+
+# Crowd data is kept in long format: one row per observation of a visitor by a device.
+# `mac_id` is the 24 bit mac hash as an integer, so the ids are the same across sessions.
+OBSERVATION_DTYPES = {
+    "timestamp": "datetime64[ns]",
+    "device_name": "category",
+    "mac_id": np.int32,
+    "rssi": np.int8,
+}
+
+
+def parse_dict_string(dict_string: str) -> dict:
+    result_dict = {}
+    content = dict_string.strip().strip('{}')
+
+    if not content:
+        return result_dict
+
+    parts = content.split(', ')
+
+    for part in parts:
+        try:
+            key_str, value_str = part.split(': ', 1)
+        except ValueError:
+            continue
+
+        key = key_str.strip().strip("'")
+
+        try:
+            value = int(value_str.strip())
+        except ValueError:
+            continue
+
+        result_dict[key] = value
+
+    return result_dict
+
+
+def parse_crowd(x) -> dict:
+    if pd.isna(x) or not isinstance(x, str) or x.strip() == "":
+        return {}
+    try:
+        return parse_dict_string(x)
+    except (ValueError, SyntaxError):
+        return {}
+
+
+# Bulk parser for legacy str(dict) cells. Cells in the exact format of `str(dict)`, with keys
+# without quotes, whitespace or separators and integer values, are checked with one regex per
+# cell, joined into one byte buffer and split into keys and values with NumPy by the positions
+# of the quotes and separators. Any other cell (NaN, extra whitespace, duplicate keys, …) goes
+# through `parse_crowd`, so the results are the same.
+_WELL_FORMED_CELL = re.compile(
+    r"\{(?:'[^'\s:,{}\x00]+': -?[0-9]{1,18}(?:, '[^'\s:,{}\x00]+': -?[0-9]{1,18})*)?\}", re.ASCII
+)
+# below this many cells per process a pool costs more than it saves
+MIN_CELLS_PER_PROCESS = 20_000
+
+_INT64 = np.iinfo(np.int64)
+
+_HEX_DIGITS = np.full(256, -1, dtype=np.int32)
+for _digit, _char in enumerate("0123456789abcdef"):
+    _HEX_DIGITS[ord(_char)] = _HEX_DIGITS[ord(_char.upper())] = _digit
+
+
+def _hex_ids(keys: np.ndarray) -> np.ndarray | None:
+    """int32 values of 6 character hex keys (the format of `sniff.hash_mac`), None if a key is not one."""
+    keys = np.asarray(keys, dtype=str)
+    if keys.dtype != np.dtype("U6"):
+        return None
+    # the code points of NumPy strings, shorter keys are padded with 0 (not a hex digit)
+    code_points = keys.view(np.uint32).reshape(-1, 6)
+    digits = _HEX_DIGITS[np.minimum(code_points, 255)]
+    if (digits < 0).any():
+        return None
+    return (digits << np.arange(20, -1, -4, dtype=np.int32)).sum(axis=1, dtype=np.int32)
+
+
+def _hex_id(key: str) -> int:
+    """Mac id of a hex mac hash key, -1 if the key is not a 24 bit hex number."""
+    try:
+        mac_id = int(key, 16)
+    except ValueError:
+        return -1
+    return mac_id if 0 <= mac_id < 2**24 else -1
+
+
+def _mac_ids(keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """int32 mac ids of hex mac hash keys, and whether every key is one (ids of other keys are 0)."""
+    ids = _hex_ids(keys)
+    if ids is not None:
+        return ids, np.ones(len(ids), dtype=bool)
+    ids = np.fromiter((_hex_id(key) for key in keys), dtype=np.int32, count=len(keys))
+    valid = ids >= 0
+    return np.where(valid, ids, 0), valid
+
+
+def _buffer_ints(buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Decimal integers at buffer[starts[i]:ends[i]], one digit column at a time."""
+    negative = buffer[starts] == ord("-")
+    starts = starts + negative
+    widths = ends - starts
+    values = np.zeros(len(starts), dtype=np.int64)
+    for digit in range(int(widths.max()) if len(widths) else 0):
+        has = widths > digit
+        values[has] = values[has] * 10 + (buffer[starts[has] + digit] - ord("0"))
+    return np.where(negative, -values, values)
+
+
+def _buffer_strings(buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """UTF-8 strings at buffer[starts[i]:ends[i]], as one fixed-width gather if they are all ASCII of one length."""
+    widths = ends - starts
+    if len(widths) and (widths == widths[0]).all():
+        chars = buffer[starts[:, None] + np.arange(widths[0])]
+        if (chars < 0x80).all():
+            return chars.astype(np.uint32).view(f"U{widths[0]}").ravel()
+    raw = buffer.tobytes()
+    return np.array([raw[start:end].decode() for start, end in zip(starts.tolist(), ends.tolist())], dtype=str)
+
+
+def _parse_dict_cells(cells: list) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """`parse_dict_column` in this process, with the number of entries per cell instead of offsets."""
+    fast = np.fromiter(
+        (isinstance(cell, str) and _WELL_FORMED_CELL.fullmatch(cell) is not None for cell in cells),
+        dtype=bool, count=len(cells),
+    )
+    buffer = np.frombuffer("".join(cell for cell, ok in zip(cells, fast) if ok).encode(), dtype=np.uint8)
+
+    # in a well-formed cell, every key is quoted and followed by ": " and its value, which
+    # ends at the next ", " or at the "}" that closes the cell
+    quotes = np.flatnonzero(buffer == ord("'"))
+    key_starts, key_ends = quotes[0::2] + 1, quotes[1::2]
+    separators = np.flatnonzero((buffer == ord(",")) | (buffer == ord("}")))
+    value_ends = separators[np.searchsorted(separators, key_ends + 3)]
+    keys = _buffer_strings(buffer, key_starts, key_ends)
+    values = _buffer_ints(buffer, key_ends + 3, value_ends)
+
+    cell_ends = np.flatnonzero(buffer == ord("}"))
+    lengths = np.zeros(len(cells), dtype=np.int64)
+    lengths[fast] = np.bincount(np.searchsorted(cell_ends, key_starts), minlength=len(cell_ends))
+    cell_of_entry = np.repeat(np.arange(len(cells)), lengths)
+
+    # a key repeated in a cell keeps its first position and its last value in a dict
+    key_ids = _hex_ids(keys)
+    if key_ids is None:
+        key_ids = pd.factorize(keys)[0]
+    base = int(key_ids.max()) + 1 if len(key_ids) else 1
+    packed = np.sort(cell_of_entry * base + key_ids)
+    repeated_cells = np.unique(packed[1:][packed[1:] == packed[:-1]] // base)
+    if len(repeated_cells):
+        keep = ~np.isin(cell_of_entry, repeated_cells)
+        keys, values, cell_of_entry = keys[keep], values[keep], cell_of_entry[keep]
+        fast[repeated_cells] = False
+
+    slow = np.flatnonzero(~fast)
+    if len(slow):
+        dicts = [parse_crowd(cells[i]) for i in slow]
+        lengths[slow] = [len(crowd) for crowd in dicts]
+        keys = np.concatenate([keys, np.array([key for crowd in dicts for key in crowd], dtype=str)])
+        # values beyond int64 are clipped to it
+        slow_values = [min(max(v, _INT64.min), _INT64.max) for crowd in dicts for v in crowd.values()]
+        values = np.concatenate([values, np.array(slow_values, dtype=np.int64)])
+        cell_of_entry = np.concatenate([cell_of_entry, np.repeat(slow, lengths[slow])])
+        order = np.argsort(cell_of_entry, kind="stable")
+        keys, values = keys[order], values[order]
+    return lengths, keys, values
+
+
+def parse_dict_column(cells: pd.Series, processes: int = 1) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Parse a column of legacy str(dict) cells at once, with the same results as `parse_crowd`
+    on every cell (values beyond int64 are clipped to it). With `processes` > 1, large
+    columns are split over a process pool.
+
+    Returns:
+    - offsets: the entries of cell i are at offsets[i]:offsets[i + 1]
+    - keys, values: the entries of all cells, concatenated (NumPy str and int64)
+    """
+    cells = list(cells)
+    processes = min(processes, len(cells) // MIN_CELLS_PER_PROCESS)
+    if processes > 1:
+        bounds = np.linspace(0, len(cells), processes + 1).astype(int)
+        with ProcessPoolExecutor(processes) as pool:
+            parts = list(pool.map(_parse_dict_cells, [cells[a:b] for a, b in zip(bounds[:-1], bounds[1:])]))
+        lengths, keys, values = (np.concatenate(arrays) for arrays in zip(*parts))
+    else:
+        lengths, keys, values = _parse_dict_cells(cells)
+    return np.concatenate([[0], np.cumsum(lengths)]), keys, values
+
+
+def _decode_records(cell: str) -> bytes:
+    """The records of a cell in the compact encoding, empty if it is malformed."""
+    try:
+        raw = base64.b64decode(cell[len(ENCODING_PREFIX):], validate=True)
+    except (binascii.Error, ValueError):
+        return b""
+    return raw if len(raw) % RECORD_SIZE == 0 else b""
+
+
+def decode_observations(cells: pd.Series) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Vectorized decoder for cells written by `encoding.encode_crowd_data`, without building dicts.
+    Also decodes the records of keyframe and delta cells, which have prefixes of the same length.
+
+    Cells that are not valid base64 or not whole records are read as empty, like `parse_crowd`
+    reads cells it cannot parse.
+
+    Returns:
+    - lengths: number of observations in every cell
+    - mac_ids, rssi: the observations of all cells, concatenated
+    """
+    raw = [_decode_records(cell) for cell in cells]
+    records = np.frombuffer(b"".join(raw), dtype=">u4")
+    lengths = np.fromiter((len(r) // RECORD_SIZE for r in raw), dtype=np.int64, count=len(raw))
+    mac_ids = (records >> 8).astype(np.int32)
+    rssi = (records & 0xFF).astype(np.uint8).view(np.int8)
+    return lengths, mac_ids, rssi
+
+
+def _flatten_column(cells: pd.Series) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    `decode_observations` for legacy str(dict) cells. Entries whose key is not a mac hash or
+    whose RSSI is out of range of int8 are dropped, like the cells `parse_crowd` cannot parse.
+    """
+    offsets, keys, values = parse_dict_column(cells)
+    mac_ids, valid = _mac_ids(keys)
+    valid &= (values >= -128) & (values <= 127)
+    lengths = np.diff(offsets)
+    if not valid.all():
+        cell_of_entry = np.repeat(np.arange(len(lengths)), lengths)
+        lengths = np.bincount(cell_of_entry[valid], minlength=len(lengths))
+    return lengths, mac_ids[valid], values[valid].astype(np.int8)
+
+
+def _observations(timestamps, device_names, lengths, mac_ids, rssi) -> pd.DataFrame:
+    return pd.DataFrame({
+        "timestamp": np.repeat(np.asarray(timestamps, dtype="datetime64[ns]"), lengths),
+        "device_name": pd.Categorical(np.repeat(np.asarray(device_names, dtype=object), lengths)),
+        "mac_id": mac_ids,
+        "rssi": rssi,
+    })
+
+
+def empty_observations() -> pd.DataFrame:
+    return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in OBSERVATION_DTYPES.items()})
+
+
+def concat_frames(frames: list[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate frames with a categorical `device_name` column, keeping it categorical."""
+    non_empty = [frame for frame in frames if not frame.empty]
+    if not non_empty:
+        return frames[0]
+    categories = pd.api.types.union_categoricals([frame["device_name"] for frame in non_empty]).categories
+    return pd.concat(
+        [frame.assign(device_name=frame["device_name"].cat.set_categories(categories)) for frame in non_empty],
+        ignore_index=True,
+    )
+
+
+class DeltaDecoder:
+    """
+    Reconstructs the full windows of devices uploading in delta mode (see `encoding.DeltaEncoder`).
+
+    Keeps the last window of every such device, so deltas can be applied across syncs.
+    Rows must be passed in upload order. The cells of a window may arrive in several syncs and
+    a later cell may mark devices of the earlier ones as gone, so the last window of every
+    device is held back until a newer window of the device arrives, or `flush` is called.
+    A sensor sends a keyframe after windows were lost on the way (see `encoding.DeltaEncoder.reset`).
+    """
+
+    def __init__(self):
+        # device name -> (timestamp, mac id -> rssi) of its last window
+        self.windows: dict[str, tuple[pd.Timestamp, dict[int, int]]] = {}
+        # devices whose last window is not returned yet
+        self.pending: set[str] = set()
+
+    def _window(self, device_name: str) -> pd.DataFrame:
+        timestamp, state = self.windows[device_name]
+        mac_ids = np.fromiter(state.keys(), dtype=np.int32, count=len(state))
+        rssi = np.fromiter(state.values(), dtype=np.int8, count=len(state))
+        return _observations([timestamp], [device_name], [len(state)], mac_ids, rssi)
+
+    def decode(self, timestamps: pd.Series, device_names: pd.Series, cells: pd.Series) -> pd.DataFrame:
+        """Observations of the windows completed by the given delta mode rows, every window in full."""
+        rows = pd.DataFrame({"timestamp": timestamps, "device_name": device_names, "cell": cells})
+        parts = []
+        # rows of a window are consecutive per device
+        window_ids = (
+            (rows["timestamp"] != rows.groupby("device_name", sort=False)["timestamp"].shift())
+            .groupby(rows["device_name"], sort=False).cumsum()
+        )
+        for (device_name, _), window in rows.groupby([rows["device_name"], window_ids], sort=False):
+            timestamp = window["timestamp"].iloc[0]
+            last_timestamp, state = self.windows.get(device_name, (None, {}))
+            continued = last_timestamp == timestamp
+            if not continued and device_name in self.pending:
+                # a newer window started, the previous one is complete
+                parts.append(self._window(device_name))
+            if window["cell"].iloc[0].startswith(KEYFRAME_PREFIX) and not continued:
+                state = {}
+
+            _, mac_ids, rssi = decode_observations(window["cell"])
+            gone = rssi == GONE_RSSI
+            for mac_id in mac_ids[gone].tolist():
+                state.pop(mac_id, None)
+            state.update(zip(mac_ids[~gone].tolist(), rssi[~gone].tolist()))
+            self.windows[device_name] = (timestamp, state)
+            self.pending.add(device_name)
+
+        return self._concat(parts)
+
+    def flush(self, before: pd.Timestamp | None = None) -> pd.DataFrame:
+        """
+        Observations of the held back windows, for when no more rows will arrive.
+        With `before`, only the windows that started before it are returned.
+        """
+        flushed = {
+            device_name for device_name in self.pending
+            if before is None or self.windows[device_name][0] < before
+        }
+        self.pending -= flushed
+        return self._concat([self._window(device_name) for device_name in flushed])
+
+    @staticmethod
+    def _concat(parts: list[pd.DataFrame]) -> pd.DataFrame:
+        if not parts:
+            return _observations([], [], np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int8))
+        return concat_frames(parts)
+
+
+def parse_observations(df: pd.DataFrame, deltas: DeltaDecoder | None = None) -> pd.DataFrame:
+    """
+    Parse raw sheet rows (see `utils.COLUMNS`) into long format, one row per observation
+    (see `OBSERVATION_DTYPES`). Rows with an invalid timestamp are dropped.
+    Rows uploaded in delta mode are reconstructed with `deltas`, which has to be kept
+    across calls when rows are parsed incrementally; the last window of every such device
+    is then only returned by a later call (see `DeltaDecoder`). Without `deltas`, the rows
+    are taken to be complete and all windows are returned.
+    """
+    timestamps = pd.to_datetime(df["timestamp"], errors="coerce")
+    valid = timestamps.notna().to_numpy()
+    df, timestamps = df[valid], timestamps[valid]
+
+    cells = df["crowd_data"]
+    encoded = cells.str.startswith(ENCODING_PREFIX, na=False).to_numpy(dtype=bool)
+    delta = cells.str.startswith((KEYFRAME_PREFIX, DELTA_PREFIX), na=False).to_numpy(dtype=bool)
+    legacy = ~(encoded | delta)
+    complete = deltas is None
+    if complete:
+        deltas = DeltaDecoder()
+
+    return concat_frames([
+        _observations(timestamps[encoded], df["device_name"][encoded], *decode_observations(cells[encoded])),
+        deltas.decode(timestamps[delta], df["device_name"][delta], cells[delta]),
+        deltas.flush() if complete else empty_observations(),
+        _observations(timestamps[legacy], df["device_name"][legacy], *_flatten_column(cells[legacy])),
+    ])
+
+
+def count_observations(observations: pd.DataFrame, resolution: str = TIME_BIN) -> pd.DataFrame:
+    """Number of distinct visitors per device and time bin of the given `resolution`."""
+    step = pd.Timedelta(resolution).value
+    categories = observations["device_name"].cat.categories
+    bins = observations["timestamp"].to_numpy().astype(np.int64) // step
+    codes = observations["device_name"].cat.codes.to_numpy().astype(np.int64)
+
+    # one integer key per (time bin, device, mac): the mac id takes the lowest 24 bits
+    keys = np.unique(((bins * len(categories) + codes) << 24) | observations["mac_id"].to_numpy())
+    groups, counts = np.unique(keys >> 24, return_counts=True)
+    return pd.DataFrame({
+        "device_name": pd.Categorical.from_codes(groups % len(categories), categories),
+        "timestamp": pd.to_datetime(groups // len(categories) * step),
+        "crowd_count": counts,
+    })
+
+
+def unique_counts(observations: pd.DataFrame, resolution: str = TIME_BIN) -> pd.Series:
+    """Exact number of distinct visitors across all devices per time bin, indexed by timestamp."""
+    return observations.groupby(observations["timestamp"].dt.floor(resolution))["mac_id"].nunique()
@@ -1,17 +1,27 @@
 import time
-from utils import write_data
+import threading
+from utils import Sink, get_sink, is_config_error, is_transient_error
 from argparse import ArgumentParser
-from datetime import datetime
-from sniff import sniff_packets
-import sys
+from sniff import ContinuousSniffer, BACKENDS
+from encoding import DeltaEncoder, encode_records
+from spool import Spool
+from metrics import Metrics, serve_metrics
+from supervisor import CaptureSupervisor
 
-DUMMY_TIME = 15
+INTERFACE = 'alfa'
 SCAN_DURATION = 300
 MAX_LENGTH = 49_000
-
-def get_crowd_data(scan_duration : int) -> dict[str, int]:
-    interface = 'alfa' 
-    return sniff_packets(interface, scan_duration) 
+# the collector has no cell limit, a window is one row unless it has millions of devices
+MAX_COLLECTOR_LENGTH = 16_000_000
+MAX_PENDING_WINDOWS = 12
+SPOOL_PATH = 'spool.sqlite'
+UPLOAD_BATCH_ROWS = 50
+MIN_RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+# rejections of a window by the sink before it is moved to the quarantine of the spool
+MAX_UPLOAD_ATTEMPTS = 5
+# Prometheus text file with the metrics of the sensor, rewritten after every window
+METRICS_PATH = 'metrics.prom'
 
 def split_dict_by_max_length(input_dict : dict, max_length : int) -> list[dict]:
     result = []
@@ -31,64 +41,149 @@ def split_dict_by_max_length(input_dict : dict, max_length : int) -> list[dict]:
     
     return result   
 
+def upload_worker(spool : Spool, sink : Sink, metrics : Metrics) -> None:
+    """
+    Drain the spool forever. All pending rows (up to UPLOAD_BATCH_ROWS) are coalesced into one upload,
+    so catching up after an outage takes a few bulk writes instead of one round trip per window.
+    Failed uploads are retried with exponential backoff. After the sink rejected a batch (an error
+    that is not transient, see `is_transient_error`), its windows are uploaded one at a time, and a
+    window rejected MAX_UPLOAD_ATTEMPTS times is moved to the quarantine of the spool, so it does
+    not hold back the windows behind it. An error of the setup of the sink (see `is_config_error`)
+    would reject every window, so uploads are paused and retried instead, until the sink is fixed.
+    """
+    retry_delay = MIN_RETRY_DELAY
+    # last id of the rejected batch, until which windows are uploaded one at a time
+    single_until = None
+    # first id of the last rejected upload and how often it was rejected
+    rejected_id, rejections = None, 0
+    while True:
+        ids, rows = spool.peek(1 if single_until is not None else UPLOAD_BATCH_ROWS)
+        if not rows:
+            continue
+        
+        start = time.perf_counter()
+        try:
+            sink.write(rows)
+        except Exception as e:
+            metrics.inc("upload_failures_total")
+            if is_transient_error(e):
+                print(f"Error writing data: {e}, retrying in {retry_delay} seconds ({spool.pending()} rows pending)", flush=True)
+            elif is_config_error(e):
+                metrics.set("upload_paused", 1)
+                print(f"Uploads paused, the sink is set up wrong: {e}, retrying in {retry_delay} seconds ({spool.pending()} rows pending)", flush=True)
+            else:
+                metrics.inc("upload_rejections_total")
+                rejections = rejections + 1 if ids[0] == rejected_id else 1
+                rejected_id = ids[0]
+                single_until = max(single_until or 0, ids[-1])
+                if rejections >= MAX_UPLOAD_ATTEMPTS:
+                    spool.quarantine(ids, repr(e))
+                    metrics.inc("quarantined_rows_total", len(rows))
+                    metrics.set("spool_pending_rows", spool.pending())
+                    print(f"Upload of the window at {rows[0]['timestamp']} rejected {rejections} times ({e}), moved {len(rows)} rows to the quarantine", flush=True)
+                    rejected_id, rejections = None, 0
+                    continue
+                print(f"Upload rejected: {e} (attempt {rejections} of {MAX_UPLOAD_ATTEMPTS}), retrying in {retry_delay} seconds", flush=True)
+            metrics.set("spool_pending_rows", spool.pending())
+            time.sleep(retry_delay)
+            retry_delay = min(2 * retry_delay, MAX_RETRY_DELAY)
+            continue
+        metrics.observe("upload_seconds", time.perf_counter() - start)
+        metrics.set("upload_paused", 0)
+        
+        spool.remove(ids)
+        retry_delay = MIN_RETRY_DELAY
+        rejected_id, rejections = None, 0
+        if single_until is not None and ids[-1] >= single_until:
+            single_until = None
+        metrics.inc("uploaded_rows_total", len(rows))
+        metrics.set("spool_pending_rows", spool.pending())
+        print(f"Uploaded {len(rows)} rows, {spool.pending()} rows pending", flush=True)
+
 def main():
     parser = ArgumentParser()
     parser.add_argument("--device_name", type=str, required=True)
+    parser.add_argument("--legacy_format", action="store_true", help="Upload crowd data as str(dict) instead of the compact encoding")
+    parser.add_argument("--backend", type=str, choices=BACKENDS, default="scapy", help="Capture backend, 'raw' skips scapy dissection")
+    parser.add_argument("--delta", action="store_true", help="Only upload the devices that changed since the previous window, with periodic keyframes")
+    parser.add_argument("--collector", type=str, default=None, help="Upload to the collector at this URL (e.g. http://192.168.1.10:8000) instead of the Google Sheet")
+    parser.add_argument("--requeue_quarantine", action="store_true", help="Move the quarantined rows of the spool back into the upload queue, e.g. after fixing the sink")
+    parser.add_argument("--metrics_port", type=int, default=None, help="Also serve the metrics for Prometheus at http://<pi>:<port>/metrics")
     
     args = parser.parse_args()
     device_name : str = args.device_name
     
-    print("Testing sniffer...", flush = True)
-    dummy_crowd_data = get_crowd_data(DUMMY_TIME)
-    if len(dummy_crowd_data) == 0:
-        print("Sniffer did not return any data on test, exiting...", flush=True)
-        sys.exit(1)
+    print(f"Starting continuous sniffing on {device_name} in windows of {SCAN_DURATION} seconds...", flush=True)
     
-    print("Sniffer test successful", flush=True)
-    print(f"Starting sniffing on {device_name} for {SCAN_DURATION} seconds...", flush=True)
+    metrics = Metrics("crowd_sensor")
+    metrics.describe("frame_handling_seconds", "Time to parse, hash and record one frame, sampled every 64th frame")
+    metrics.describe("kernel_dropped_frames_total", "Frames dropped by the kernel because the capture socket was full (raw backend)")
+    metrics.describe("dropped_frames_total", "Frames of windows dropped because the upload fell behind")
+    metrics.describe("encode_seconds", "Time to encode a window into cells")
+    metrics.describe("upload_seconds", "Time of a successful upload")
+    metrics.describe("upload_rejections_total", "Uploads the sink rejected with an error that retrying does not fix")
+    metrics.describe("quarantined_rows_total", "Rows moved to the quarantine of the spool after repeated rejections")
+    metrics.describe("upload_paused", "1 while uploads are paused because the sink is set up wrong (e.g. a header mismatch)")
+    if args.metrics_port is not None:
+        serve_metrics(metrics, args.metrics_port)
+    
+    # every completed window is persisted in the spool before the upload worker drains it
+    spool = Spool(SPOOL_PATH)
+    if args.requeue_quarantine:
+        print(f"Moved {spool.requeue()} quarantined rows back into the spool", flush=True)
+    print(f"Found {spool.pending()} rows in the spool from an earlier run ({spool.quarantined()} in quarantine)", flush=True)
+    threading.Thread(target=upload_worker, args=(spool, get_sink(args.collector), metrics), daemon=True).start()
+    
+    # the sniffer captures on its own thread, this loop spools the completed windows
+    # capture faults are recovered in this process by the supervisor, instead of a restart of the service
+    sniffer = ContinuousSniffer(INTERFACE, SCAN_DURATION, max_pending=MAX_PENDING_WINDOWS, backend=args.backend, metrics=metrics)
+    sniffer.start()
+    supervisor = CaptureSupervisor(sniffer, metrics)
+    delta_encoder = DeltaEncoder() if args.delta else None
+    # the deltas after a quarantined window would be applied to the wrong state on the dashboard
+    quarantined = spool.quarantined()
+    max_length = MAX_LENGTH if args.collector is None else MAX_COLLECTOR_LENGTH
     
     while True:    
-        try:
-            crowd_data = get_crowd_data(SCAN_DURATION)
-                    
-        except OSError as e:
-            print(f"Error sniffing packets: {e}", flush=True)
-            sys.exit(1)
-            
-        except Exception as e:
-            print(f"Unexpected error: {e}", flush=True)
-            sys.exit(1)
-            
-        if len(crowd_data) == 0:
-            # if no data is found, it is most likely because the interface is not in monitor mode
-            # exiting the script allows the raspberry to set the interface to monitor mode again
-            print("No data found, trying a restart...", flush=True)
-            sys.exit(1)
+        # windows without devices are not returned, the interface is put back into monitor mode instead
+        window_start, crowd_data = supervisor.get_window()
         
         # format the timestamp as 'YYYY-MM-DD HH:MM'
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M')
+        timestamp = window_start.strftime('%Y-%m-%d %H:%M')
         
         # this is a list of strings to be logged
         # due to google sheets limitations, only 50,000 characters can be written at once
-        crowd_data_splitted = split_dict_by_max_length(crowd_data, MAX_LENGTH)
+        # (the collector takes whole windows in the compact encoding)
+        with metrics.time("encode_seconds"):
+            if args.legacy_format:
+                crowd_data_splitted = [str(d) for d in split_dict_by_max_length(crowd_data.to_dict(), MAX_LENGTH)]
+            elif delta_encoder is not None:
+                if spool.quarantined() != quarantined:
+                    quarantined = spool.quarantined()
+                    delta_encoder.reset()
+                crowd_data_splitted = delta_encoder.encode(crowd_data.hashes, crowd_data.last_rssi, max_length)
+            else:
+                crowd_data_splitted = encode_records(crowd_data.hashes, crowd_data.last_rssi, max_length)
         
         data = [
             {
             "device_name": device_name,
             "timestamp": timestamp,
-            "crowd_data": str(d),
+            "crowd_data": d,
             } 
             for d in crowd_data_splitted
             ]
         
-        try:
-            write_data(data)
-        except Exception as e:
-            print(f"Error writing data: {e}", flush=True)
-            sys.exit(1)
+        spool.append(data)
+        metrics.inc("windows_total")
+        metrics.inc("cells_total", len(data))
+        metrics.set("spool_pending_rows", spool.pending())
+        metrics.write_textfile(METRICS_PATH)
         
         num_people = len(crowd_data)
-        print(f"Data written at {timestamp} with number of people: {num_people}", flush=True)
+        print(f"Data spooled at {timestamp} with number of people: {num_people} ({crowd_data.total_frames()} frames)", flush=True)
+        if sniffer.dropped_windows:
+            print(f"Upload is falling behind, dropped {sniffer.dropped_windows} windows ({sniffer.dropped_packets} packets) so far", flush=True)
         
         
 if __name__ == "__main__":
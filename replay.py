@@ -0,0 +1,85 @@
+import struct
+import sys
+from argparse import ArgumentParser
+from functools import partial
+from typing import Iterator
+
+from scapy.all import sniff
+
+from device_table import DeviceTable, WindowStats
+from sniff import packet_handler, raw_packet_handler
+
+LINKTYPE_IEEE802_11_RADIOTAP = 127
+
+
+def read_pcap(path: str) -> Iterator[memoryview]:
+    """Yield every frame of a classic pcap file with radiotap link type."""
+    with open(path, "rb") as f:
+        data = memoryview(f.read())
+
+    magic = data[:4].tobytes()
+    if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+        endian = "<"
+    elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+        endian = ">"
+    else:
+        raise ValueError(f"{path} is not a pcap file")
+
+    linktype = struct.unpack_from(endian + "I", data, 20)[0]
+    if linktype != LINKTYPE_IEEE802_11_RADIOTAP:
+        raise ValueError(f"Expected radiotap frames (link type 127), got link type {linktype}")
+
+    offset = 24
+    while offset + 16 <= len(data):
+        captured = struct.unpack_from(endian + "I", data, offset + 8)[0]
+        offset += 16
+        yield data[offset:offset + captured]
+        offset += captured
+
+
+def replay_raw(path: str) -> WindowStats:
+    """Feed a pcap file through the raw capture backend."""
+    table = DeviceTable()
+    for frame in read_pcap(path):
+        raw_packet_handler(frame, table)
+    return table.snapshot()
+
+
+def replay_scapy(path: str) -> WindowStats:
+    """Feed a pcap file through the scapy capture backend."""
+    table = DeviceTable()
+    sniff(offline=path, prn=partial(packet_handler, table=table), store=0)
+    return table.snapshot()
+
+
+def by_device(stats: WindowStats) -> dict[str, tuple[int, int, int, int]]:
+    """Device -> (last, min, max RSSI, frames). Seen times differ between replays and are left out."""
+    return {
+        f"{mac_hash:06x}": tuple(values)
+        for mac_hash, *values in zip(stats.hashes, stats.last_rssi, stats.min_rssi, stats.max_rssi, stats.frames)
+    }
+
+
+def main():
+    parser = ArgumentParser(description="Check the raw capture backend against scapy on a recorded pcap file")
+    parser.add_argument("pcap", type=str)
+
+    args = parser.parse_args()
+
+    raw = by_device(replay_raw(args.pcap))
+    scapy = by_device(replay_scapy(args.pcap))
+
+    mismatches = {
+        mac: (raw.get(mac), scapy.get(mac))
+        for mac in raw.keys() | scapy.keys()
+        if raw.get(mac) != scapy.get(mac)
+    }
+    print(f"raw: {len(raw)} devices, scapy: {len(scapy)} devices, mismatches: {len(mismatches)}")
+    for mac, (raw_stats, scapy_stats) in list(mismatches.items())[:20]:
+        print(f"  {mac}: raw={raw_stats} scapy={scapy_stats}")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
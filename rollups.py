@@ -0,0 +1,150 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from postings import PostingsIndex
+from processing import concat_frames, count_observations, empty_observations
+from sketches import SketchStore
+
+# resolutions from fine to coarse
+RESOLUTIONS = ["1min", "10min", "1h"]
+# the finest resolution is only used if the selected span has at most this many bins
+MAX_POINTS = 600
+
+
+def empty_counts() -> pd.DataFrame:
+    return pd.DataFrame({
+        "device_name": pd.Series(dtype="category"),
+        "timestamp": pd.Series(dtype="datetime64[ns]"),
+        "crowd_count": pd.Series(dtype=np.int64),
+    })
+
+
+def empty_totals() -> pd.DataFrame:
+    return pd.DataFrame(columns=["timestamp", "total"])
+
+
+def cross_device_totals(data: pd.DataFrame) -> pd.DataFrame:
+    """Sum of the per-device counts per time bin."""
+    return data.groupby("timestamp")["crowd_count"].sum().rename("total").reset_index()
+
+
+class Rollups:
+    """
+    Observations in long format plus per-device and cross-device aggregates at every
+    resolution in `RESOLUTIONS`.
+
+    `observations` holds one row per observation, sorted by timestamp (see
+    `processing.OBSERVATION_DTYPES`), `devices[resolution]` the number of distinct visitors
+    per device and time bin (see `processing.count_observations`), `totals[resolution]` the
+    summed counts over all devices and `sketches[resolution]` the HyperLogLog sketches used
+    for unique counts over any device subset and time range. `postings` indexes the
+    observations by visitor (see `postings.PostingsIndex`).
+    All are updated incrementally: new rows only touch the time bins they fall into.
+
+    The observations are kept in sorted chunks that follow each other in time. A new chunk is
+    merged into the one before it once that one is less than twice its size, so there are only
+    logarithmically many chunks and every observation is copied a logarithmic number of times.
+    The chunks are only concatenated when `observations` is read; `between` slices them.
+    """
+
+    def __init__(self):
+        self._chunks: list[pd.DataFrame] = []
+        self.observation_count = 0
+        self.devices = {resolution: empty_counts() for resolution in RESOLUTIONS}
+        self.totals = {resolution: empty_totals() for resolution in RESOLUTIONS}
+        self.sketches = {resolution: SketchStore(resolution) for resolution in RESOLUTIONS}
+        self.postings = PostingsIndex()
+
+    @property
+    def observations(self) -> pd.DataFrame:
+        """All observations, concatenated into one chunk on the first read after an update."""
+        if not self._chunks:
+            return empty_observations()
+        if len(self._chunks) > 1:
+            self._chunks = [concat_frames(self._chunks)]
+        return self._chunks[0]
+
+    def between(self, start, end) -> pd.DataFrame:
+        """Observations from `start` to `end` (both inclusive), sorted by timestamp."""
+        parts = []
+        for chunk in self._chunks:
+            first = chunk["timestamp"].searchsorted(pd.Timestamp(start), side="left")
+            last = chunk["timestamp"].searchsorted(pd.Timestamp(end), side="right")
+            if first < last:
+                parts.append(chunk.iloc[first:last])
+        return concat_frames(parts) if parts else empty_observations()
+
+    def _since(self, start) -> pd.DataFrame:
+        """Observations from `start` on; only the chunks at the end are touched."""
+        parts = []
+        for chunk in reversed(self._chunks):
+            first = chunk["timestamp"].searchsorted(start, side="left")
+            if first < len(chunk):
+                parts.append(chunk.iloc[first:])
+            if first > 0:
+                break
+        return concat_frames(parts[::-1])
+
+    def _append(self, new: pd.DataFrame) -> None:
+        """Add sorted observations to the chunks, keeping them sorted across chunks."""
+        chunks = self._chunks
+        # observations older than the end of a chunk (e.g. uploads of a sensor catching up)
+        # are sorted into that chunk and the ones after it
+        first = len(chunks)
+        while first > 0 and chunks[first - 1]["timestamp"].iloc[-1] > new["timestamp"].iloc[0]:
+            first -= 1
+        if first < len(chunks):
+            new = concat_frames(chunks[first:] + [new]).sort_values("timestamp", kind="stable", ignore_index=True)
+            del chunks[first:]
+        chunks.append(new)
+        while len(chunks) > 1 and len(chunks[-2]) < 2 * len(chunks[-1]):
+            chunks[-2:] = [concat_frames(chunks[-2:])]
+
+    def update(self, new: pd.DataFrame) -> None:
+        """Add observations parsed with `processing.parse_observations`."""
+        if new.empty:
+            return
+
+        new = new.sort_values("timestamp", kind="stable", ignore_index=True)
+        self._append(new)
+        self.observation_count += len(new)
+        self.postings.add(new)
+
+        for resolution in RESOLUTIONS:
+            self.sketches[resolution].add(
+                new["device_name"].array,
+                new["timestamp"].to_numpy(),
+                new["mac_id"].to_numpy(),
+            )
+
+            # only the time bins that received new rows are recounted; observations are sorted,
+            # so the rows of those bins are found from the first one on
+            new_bins = new["timestamp"].dt.floor(resolution).unique()
+            touched = self._since(new_bins.min())
+            touched = touched[touched["timestamp"].dt.floor(resolution).isin(new_bins)]
+            recounted = count_observations(touched, resolution)
+
+            counts = self.devices[resolution]
+            kept = counts[~counts["timestamp"].isin(new_bins)]
+            self.devices[resolution] = (
+                concat_frames([kept, recounted])
+                .sort_values(["device_name", "timestamp"], ignore_index=True)
+            )
+
+            totals = self.totals[resolution]
+            kept = totals[~totals["timestamp"].isin(new_bins)]
+            recomputed = cross_device_totals(recounted)
+            if not kept.empty:
+                recomputed = pd.concat([kept, recomputed], ignore_index=True).sort_values("timestamp", ignore_index=True)
+            self.totals[resolution] = recomputed
+
+
+def choose_resolution(start: datetime, end: datetime) -> str:
+    """The finest resolution that shows the span from `start` to `end` in at most `MAX_POINTS` bins."""
+    span = pd.Timestamp(end) - pd.Timestamp(start)
+    for resolution in RESOLUTIONS:
+        if span / pd.Timedelta(resolution) <= MAX_POINTS:
+            return resolution
+    return RESOLUTIONS[-1]
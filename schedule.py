@@ -0,0 +1,193 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pandas as pd
+import requests
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+
+# Schedule of the festival, scraped from the line-up pages of the festival website.
+# The pages of all days are fetched concurrently over one session and kept in an on-disk
+# cache with their ETag / Last-Modified headers and the events parsed from them, so a page
+# that did not change since the last scrape is neither downloaded nor parsed again.
+# With `offline=True` the cached pages are parsed without any request, e.g. from saved fixtures.
+
+SCHEDULE_URL = "https://www.roskilde-festival.dk/en/lineup/schedule?filter={day}"
+CACHE_DIR = "schedule_cache"
+TIMEOUT = 20
+# class of the <a> tag of every event on a schedule page
+EVENT_CLASS = "schedule-item_component__3xy_9"
+
+day_to_datetime = {
+    'Sunday':       datetime(2025, 6, 29),
+    'Monday':       datetime(2025, 6, 30),
+    'Tuesday':      datetime(2025, 7, 1),
+    'Wednesday':    datetime(2025, 7, 2),
+    'Thursday':     datetime(2025, 7, 3),
+    'Friday':       datetime(2025, 7, 4),
+    'Saturday':     datetime(2025, 7, 5)
+}
+
+
+def parse_schedule_page(html: bytes | str, day: datetime) -> list[dict]:
+    """Events on the schedule page of `day`, as dicts with the title, time and location of each event."""
+    # only the event links are built into a tree, the rest of the page is skipped
+    soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer('a', class_=EVENT_CLASS))
+    schedule = []
+
+    # each timeslot have the following:
+    # <h2 class="typography_component__Z0rR8 typography_headlineXSmallHeavy__rAHbS schedule-item_title__Ifafr">Hatha yoga</h2>
+    # <p class="typography_component__Z0rR8 typography_bodySmall__p_2To schedule-item_timeSlot__tuJvO">09.00, Stadion</p>
+    # extract the title, time and location
+    for time_slot in soup.find_all('a', class_=EVENT_CLASS):
+        title = time_slot.find('h2').text.strip()
+        time_location = time_slot.find('p').text.strip().split(',')
+        time = time_location[0].strip()
+        location = time_location[1].strip() if len(time_location) > 1 else "Unknown Location"
+        hour, minute = map(int, time.split('.'))
+
+        schedule.append({
+            'title': title,
+            'time': day + timedelta(hours=hour, minutes=minute),
+            'location': location,
+        })
+    return schedule
+
+
+class ScheduleCache:
+    """
+    On-disk cache of the schedule pages in `directory`: `<day>.html` holds the page and
+    `<day>.json` its ETag, Last-Modified and the events parsed from it.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR):
+        self.directory = directory
+
+    def _path(self, day: str, suffix: str) -> str:
+        return os.path.join(self.directory, day + suffix)
+
+    def validators(self, day: str) -> dict:
+        """Conditional request headers for the cached page of `day`."""
+        meta = self.meta(day)
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def meta(self, day: str) -> dict:
+        path = self._path(day, ".json")
+        if not os.path.exists(path) or not os.path.exists(self._path(day, ".html")):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def page(self, day: str) -> bytes | None:
+        path = self._path(day, ".html")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def events(self, day: str) -> list[dict]:
+        """Events of the cached page of `day`, parsed only if the page is newer than its parsed events."""
+        meta = self.meta(day)
+        if "events" in meta:
+            return [{**event, "time": datetime.fromisoformat(event["time"])} for event in meta["events"]]
+
+        html = self.page(day)
+        if html is None:
+            return []
+        events = parse_schedule_page(html, day_to_datetime[day])
+        self.store(day, html, meta.get("etag"), meta.get("last_modified"), events)
+        return events
+
+    def store(self, day: str, html: bytes, etag: str | None, last_modified: str | None, events: list[dict] | None = None) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(day, ".html"), "wb") as f:
+            f.write(html)
+        meta = {"etag": etag, "last_modified": last_modified}
+        if events is not None:
+            meta["events"] = [{**event, "time": event["time"].isoformat()} for event in events]
+        with open(self._path(day, ".json"), "w") as f:
+            json.dump(meta, f)
+
+
+def fetch_day(session: requests.Session, cache: ScheduleCache, day: str) -> list[dict]:
+    """
+    Events of `day`, with a conditional request against the cached page.
+    If the site cannot be reached, the cached page is used.
+    """
+    try:
+        response = session.get(SCHEDULE_URL.format(day=day), headers=cache.validators(day), timeout=TIMEOUT)
+        if response.status_code != 304:
+            response.raise_for_status()
+            events = parse_schedule_page(response.content, day_to_datetime[day])
+            cache.store(
+                day, response.content, response.headers.get("ETag"), response.headers.get("Last-Modified"), events
+            )
+            return events
+    except requests.RequestException as e:
+        if cache.page(day) is None:
+            raise
+        print(f"Could not fetch the schedule of {day} ({e}), using the cached page", flush=True)
+    return cache.events(day)
+
+
+def events_frame(events: list[dict]) -> pd.DataFrame:
+    """Event table sorted by time and location, with the location as a categorical."""
+    frame = pd.DataFrame(events, columns=["title", "time", "location"])
+    frame["time"] = pd.to_datetime(frame["time"])
+    frame["location"] = frame["location"].astype("category")
+    return frame.sort_values(["time", "location"], ignore_index=True)
+
+
+def scrape_schedule(offline: bool = False, cache_dir: str = CACHE_DIR) -> pd.DataFrame:
+    """
+    Scrapes the schedule for the festival and returns it as an event table
+    with the title, time and location of every event, sorted by time (see `events_frame`).
+    With `offline`, the pages in `cache_dir` are parsed without fetching them.
+    """
+    cache = ScheduleCache(cache_dir)
+    days = list(day_to_datetime)
+    if offline:
+        return events_frame([event for day in days for event in cache.events(day)])
+
+    with requests.Session() as session:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=len(days))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        with ThreadPoolExecutor(max_workers=len(days)) as pool:
+            pages = pool.map(lambda day: fetch_day(session, cache, day), days)
+            return events_frame([event for events in pages for event in events])
+
+
+def crowd_around_events(counts: pd.Series, events: pd.DataFrame, window: str = "1h") -> pd.DataFrame:
+    """
+    Crowd counts around the shows of every stage: every time bin of `counts` (a Series indexed
+    by timestamp) is matched to the nearest show of each stage at most `window` away.
+
+    Returns:
+    - DataFrame with the columns `location`, `title`, `time` (start of the show), `timestamp`,
+      `minutes` (from the start of the show) and `crowd_count`, one row per time bin and stage
+    """
+    crowd = counts.rename("crowd_count").rename_axis("timestamp").reset_index()
+    crowd["timestamp"] = pd.to_datetime(crowd["timestamp"])
+    stages = pd.DataFrame({"location": events["location"].cat.categories}).astype(events["location"].dtype)
+    left = crowd.merge(stages, how="cross").sort_values("timestamp", kind="stable", ignore_index=True)
+
+    merged = pd.merge_asof(
+        left,
+        events,
+        left_on="timestamp",
+        right_on="time",
+        by="location",
+        direction="nearest",
+        tolerance=pd.Timedelta(window),
+    )
+    merged = merged.dropna(subset=["time"])
+    merged["minutes"] = (merged["timestamp"] - merged["time"]) / pd.Timedelta("1min")
+    return merged[["location", "title", "time", "timestamp", "minutes", "crowd_count"]].reset_index(drop=True)
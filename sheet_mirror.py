@@ -0,0 +1,136 @@
+import copy
+import sqlite3
+import threading
+
+import pandas as pd
+
+from metrics import Metrics
+from processing import DeltaDecoder, concat_frames, empty_observations, parse_observations
+from rollups import Rollups
+from utils import COLUMNS, Sink
+
+# the window length of the sensors (SCAN_DURATION in raspberry.py)
+WINDOW_PERIOD = pd.Timedelta(minutes=5)
+
+
+class SheetMirror:
+    """
+    Local SQLite mirror of the Google Sheet or the collector (see `utils.Sink`).
+
+    The mirror keeps a row cursor and only fetches the rows appended to the sink since the
+    last sync. Only those rows are parsed and added to the rollups (see `rollups.Rollups`),
+    so a refresh costs the same on day 7 as on day 1.
+
+    The last delta mode window of a sensor is held back until its next window arrives (see
+    `processing.DeltaDecoder`); windows that ended more than a window period ago are complete
+    and flushed on every sync, so the newest window of a stopped sensor is not lost.
+
+    Rows that cannot be parsed are moved to the `quarantine` table with their error, so one
+    bad row never stops the rows behind it from being mirrored.
+
+    The time to fetch, parse and aggregate the rows is recorded in `metrics`.
+    """
+
+    def __init__(self, sink: Sink, path: str = ":memory:", metrics: Metrics | None = None):
+        self.sink = sink
+        self.metrics = metrics or Metrics("crowd_dashboard")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS rows ("
+            "row INTEGER PRIMARY KEY, device_name TEXT, timestamp TEXT, crowd_data TEXT)"
+        )
+        # rows of the sink that could not be parsed, kept out of the rollups with the error
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS quarantine ("
+            "row INTEGER PRIMARY KEY, device_name TEXT, timestamp TEXT, crowd_data TEXT, error TEXT)"
+        )
+        self.metrics.describe("quarantined_rows_total", "Rows of the sink that could not be parsed")
+        self.rollups = Rollups()
+        self.deltas = DeltaDecoder()
+
+        # rows mirrored in an earlier session are parsed once from disk
+        local_rows = self.conn.execute(
+            "SELECT row, device_name, timestamp, crowd_data FROM rows ORDER BY row"
+        ).fetchall()
+        self.cursor = self.conn.execute(
+            "SELECT COALESCE(MAX(row) + 1, 0) FROM (SELECT row FROM rows UNION ALL SELECT row FROM quarantine)"
+        ).fetchone()[0]
+        if local_rows:
+            observations, bad = self._parse_rows([row[1:] for row in local_rows])
+            # rows stored before they were checked
+            self._quarantine([(local_rows[i][0], *local_rows[i][1:], error) for i, error in bad])
+            self._aggregate(observations)
+        self._aggregate(self._flush())
+
+    def fetch_new_rows(self) -> list[list[str]]:
+        """Fetch the rows appended to the sink after the cursor."""
+        return self.sink.read(self.cursor)
+
+    def sync(self) -> Rollups:
+        """Fetch, store and aggregate the new rows. Returns the updated rollups."""
+        with self.lock:
+            with self.metrics.time("fetch_seconds"):
+                rows = self.fetch_new_rows()
+            self.metrics.inc("rows_fetched_total", len(rows))
+            if rows:
+                # rows that cannot be parsed are quarantined, the cursor moves past them either way
+                observations, bad = self._parse_rows(rows)
+                errors = dict(bad)
+                with self.conn:
+                    self.conn.executemany(
+                        "INSERT INTO rows VALUES (?, ?, ?, ?)",
+                        [(self.cursor + i, *row[:len(COLUMNS)]) for i, row in enumerate(rows) if i not in errors],
+                    )
+                self._quarantine([(self.cursor + i, *rows[i][:len(COLUMNS)], error) for i, error in bad])
+                self.cursor += len(rows)
+                self._aggregate(observations)
+            self._aggregate(self._flush())
+            return self.rollups
+
+    def _parse_rows(self, rows: list) -> tuple[pd.DataFrame, list[tuple[int, str]]]:
+        """
+        Observations of `rows` and the (index, error) of every row that could not be parsed.
+        Rows are parsed together, and one at a time only if that fails, to find the bad ones.
+        """
+        try:
+            return self._parse(rows), []
+        except Exception:
+            pass
+        parts, bad = [], []
+        for i, row in enumerate(rows):
+            try:
+                parts.append(self._parse([row]))
+            except Exception as e:
+                bad.append((i, repr(e)))
+        return concat_frames(parts or [empty_observations()]), bad
+
+    def _parse(self, rows: list) -> pd.DataFrame:
+        """Observations of `rows`. The delta decoder only advances if all of them parse."""
+        deltas = copy.deepcopy(self.deltas)
+        with self.metrics.time("parse_seconds"):
+            observations = parse_observations(
+                pd.DataFrame([list(row[:len(COLUMNS)]) for row in rows], columns=COLUMNS), deltas
+            )
+        self.deltas = deltas
+        return observations
+
+    def _flush(self) -> pd.DataFrame:
+        """Observations of the held back windows that ended more than a window period ago."""
+        return self.deltas.flush(pd.Timestamp.now() - 2 * WINDOW_PERIOD)
+
+    def _quarantine(self, rows: list[tuple]) -> None:
+        """Move (row, device_name, timestamp, crowd_data, error) rows into the quarantine table."""
+        if not rows:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO quarantine VALUES (?, ?, ?, ?, ?)", rows)
+            self.conn.executemany("DELETE FROM rows WHERE row = ?", [(row[0],) for row in rows])
+        self.metrics.inc("quarantined_rows_total", len(rows))
+        print(f"Quarantined {len(rows)} rows that could not be parsed, e.g. row {rows[0][0]}: {rows[0][-1]}", flush=True)
+
+    def _aggregate(self, observations: pd.DataFrame) -> None:
+        with self.metrics.time("rollup_seconds"):
+            self.rollups.update(observations)
+        self.metrics.inc("observations_total", len(observations))
+        self.metrics.set("mirrored_rows", self.cursor)
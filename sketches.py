@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+
+# HyperLogLog sketches of the visitors seen per device and time bin.
+# Sketches of different devices and bins are merged by taking the element-wise maximum,
+# so the number of unique visitors for any device subset and time range is a cheap union.
+
+PRECISION = 12
+NUM_REGISTERS = 2**PRECISION
+# relative standard error of the estimate
+STANDARD_ERROR = 1.04 / np.sqrt(NUM_REGISTERS)
+
+# rows allocated for the first sketches of a store
+MIN_CAPACITY = 64
+
+_ALPHA = 0.7213 / (1 + 1.079 / NUM_REGISTERS)
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer, spreads the 24 bit mac hashes over 64 bits."""
+    z = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def register_updates(mac_hashes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the register index and rank of every mac hash (as integers)."""
+    hashed = _mix(mac_hashes)
+    index = (hashed >> np.uint64(64 - PRECISION)).astype(np.int64)
+    # rank = position of the first set bit in the lower 32 bits, exact in float64
+    low = (hashed & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    _, bit_length = np.frexp(low)
+    rank = (33 - bit_length).astype(np.uint8)
+    return index, rank
+
+
+def estimate(registers: np.ndarray) -> np.ndarray:
+    """Cardinality estimate for every sketch in the last axis of `registers`."""
+    registers = np.atleast_2d(registers)
+    raw = _ALPHA * NUM_REGISTERS**2 / np.sum(np.ldexp(1.0, -registers.astype(np.int64)), axis=-1)
+    zeros = np.count_nonzero(registers == 0, axis=-1)
+
+    # linear counting for small cardinalities
+    with np.errstate(divide="ignore"):
+        linear = NUM_REGISTERS * np.log(NUM_REGISTERS / zeros)
+    return np.where((raw <= 2.5 * NUM_REGISTERS) & (zeros > 0), linear, raw)
+
+
+class SketchStore:
+    """
+    HyperLogLog sketches per (device, time bin) at a single resolution.
+    Sketches are built once when rows are added and merged with existing sketches of the same bin.
+
+    `index` maps (device, bin start in ns) to the row of its sketch in `registers`, whose
+    capacity doubles when it is full, so adding rows costs the same however long the history is.
+    """
+
+    def __init__(self, resolution: str):
+        self.resolution = resolution
+        self.index: dict[tuple[str, int], int] = {}
+        self.size = 0
+        self.registers = np.zeros((0, NUM_REGISTERS), dtype=np.uint8)
+        self.device_names = np.empty(0, dtype=object)
+        self.timestamps = np.empty(0, dtype="datetime64[ns]")
+
+    def _reserve(self, size: int) -> None:
+        capacity = len(self.registers)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, MIN_CAPACITY)
+        for name in ("registers", "device_names", "timestamps"):
+            old = getattr(self, name)
+            grown = np.zeros((capacity, *old.shape[1:]), dtype=old.dtype)
+            grown[:self.size] = old[:self.size]
+            setattr(self, name, grown)
+
+    def add(self, device_names: np.ndarray, timestamps: np.ndarray, mac_hashes: np.ndarray) -> None:
+        """Add one observation per element of the (equally long) arrays."""
+        if len(mac_hashes) == 0:
+            return
+
+        # the distinct (device, bin) pairs of the new observations
+        device_codes, devices = pd.factorize(np.asarray(device_names, dtype=object))
+        bin_codes, bins = pd.factorize(pd.DatetimeIndex(timestamps).floor(self.resolution).asi8)
+        pair_codes, pairs = pd.factorize(device_codes * len(bins) + bin_codes)
+
+        # row of every pair's sketch, new pairs get the rows after the last one
+        pair_rows = np.empty(len(pairs), dtype=np.int64)
+        new_keys = []
+        for i, pair in enumerate(pairs.tolist()):
+            key = (devices[pair // len(bins)], int(bins[pair % len(bins)]))
+            row = self.index.get(key)
+            if row is None:
+                row = self.index[key] = self.size + len(new_keys)
+                new_keys.append(key)
+            pair_rows[i] = row
+
+        if new_keys:
+            self._reserve(self.size + len(new_keys))
+            new_rows = slice(self.size, self.size + len(new_keys))
+            self.device_names[new_rows] = [device for device, _ in new_keys]
+            self.timestamps[new_rows] = np.array([start for _, start in new_keys], dtype="datetime64[ns]")
+            self.size += len(new_keys)
+
+        rows = pair_rows[pair_codes]
+        index, rank = register_updates(mac_hashes)
+        np.maximum.at(self.registers.reshape(-1), rows * NUM_REGISTERS + index, rank)
+
+    def _select(self, devices: list[str], start, end) -> np.ndarray:
+        timestamps = self.timestamps[:self.size]
+        return (
+            pd.Series(self.device_names[:self.size]).isin(devices).to_numpy()
+            & (timestamps >= pd.Timestamp(start).to_datetime64())
+            & (timestamps <= pd.Timestamp(end).to_datetime64())
+        )
+
+    def unique_count(self, devices: list[str], start, end) -> float:
+        """Estimated number of unique visitors seen by any of `devices` between `start` and `end`."""
+        mask = self._select(devices, start, end)
+        if not mask.any():
+            return 0.0
+        return float(estimate(self.registers[:self.size][mask].max(axis=0))[0])
+
+    def unique_series(self, devices: list[str], start, end) -> pd.Series:
+        """Estimated number of unique visitors across `devices` per time bin, indexed by timestamp."""
+        mask = self._select(devices, start, end)
+        timestamps = self.timestamps[:self.size][mask]
+        bins, inverse = np.unique(timestamps, return_inverse=True)
+
+        merged = np.zeros((len(bins), NUM_REGISTERS), dtype=np.uint8)
+        np.maximum.at(merged, inverse, self.registers[:self.size][mask])
+        return pd.Series(estimate(merged) if len(bins) else [], index=pd.DatetimeIndex(bins), dtype=float)
@@ -1,7 +1,15 @@
+import ctypes
 import hashlib
-from scapy.all import sniff, Dot11
+import queue
+import socket
+import struct
+import threading
+import time
+from datetime import datetime
+from scapy.all import AsyncSniffer, Dot11
 from scapy.packet import Packet
-from functools import partial
+from device_table import DeviceTable, WindowStats
+from metrics import Metrics
 
 def hash_mac(mac : str) -> str:    
     hashed = hashlib.sha256(mac.encode()).hexdigest()
@@ -10,23 +18,310 @@ def hash_mac(mac : str) -> str:
     
     return hashed
 
-def packet_handler(pkt : Packet, device_rssi : dict) -> None:
+def hash_mac_int(mac : str) -> int:
+    """`hash_mac` as a 24 bit integer, without building the hex string."""
+    return int.from_bytes(hashlib.sha256(mac.encode()).digest()[:3], "big")
+
+def packet_handler(pkt : Packet, table : DeviceTable) -> None:
     if pkt.haslayer(Dot11) and pkt.type == 0:  # management frame
         mac = pkt.addr2
         if mac:
-            mac_hash = hash_mac(mac)
-
             try:
                 rssi = pkt.dBm_AntSignal
             except:
                 rssi = None
 
             if rssi is not None:
-                device_rssi[mac_hash] = rssi
+                table.record(hash_mac_int(mac), rssi)
             
-def sniff_packets(interface : str, duration : int):
-    device_rssi = {}
-    prn = partial(packet_handler, device_rssi=device_rssi)
-    sniff(iface=interface, prn=prn, timeout=duration, store=0)
-    return device_rssi
+# ---------------------------------------------------------------------------
+# Raw capture backend: reads frames from an AF_PACKET socket and parses only
+# the radiotap header and the 802.11 addr2 field, without scapy dissection
+# ---------------------------------------------------------------------------
+
+BACKENDS = ("scapy", "raw")
+
+ETH_P_ALL = 0x0003
+SO_ATTACH_FILTER = 26
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+MAX_FRAME_SIZE = 65535
+
+# classic BPF program accepting only 802.11 management frames behind a radiotap header:
+# X = radiotap length (little-endian u16 at offset 2), accept if (frame_control & 0x0c) == 0
+MANAGEMENT_FILTER = [
+    (0x30, 0, 0, 3),        # ldb [3]
+    (0x64, 0, 0, 8),        # lsh #8
+    (0x07, 0, 0, 0),        # tax
+    (0x30, 0, 0, 2),        # ldb [2]
+    (0x0c, 0, 0, 0),        # add x
+    (0x07, 0, 0, 0),        # tax
+    (0x50, 0, 0, 0),        # ldb [x + 0]
+    (0x54, 0, 0, 0x0c),     # and #0x0c
+    (0x15, 0, 1, 0),        # jeq #0, accept, drop
+    (0x06, 0, 0, 0x40000),  # accept: ret #262144
+    (0x06, 0, 0, 0),        # drop: ret #0
+]
+
+# (alignment, size) of the radiotap fields preceding dBm_AntSignal (present bit 5):
+# TSFT, Flags, Rate, Channel, FHSS
+_RADIOTAP_FIELDS = [(8, 8), (1, 1), (1, 1), (2, 4), (1, 2)]
+_ANTENNA_SIGNAL_BIT = 5
+
+
+def parse_frame(frame : memoryview) -> tuple[str, int] | None:
+    """
+    Parse a radiotap + 802.11 frame without copying it.
+    Returns (addr2, dBm_AntSignal) for management frames carrying a signal strength, otherwise None.
+    """
+    if len(frame) < 8:
+        return None
+    it_len = frame[2] | (frame[3] << 8)
+    # the 802.11 header must at least reach the end of addr2
+    if len(frame) < it_len + 16 or (frame[it_len] >> 2) & 0x3 != 0:
+        return None
+
+    present = int.from_bytes(frame[4:8], "little")
+    if not present & (1 << _ANTENNA_SIGNAL_BIT):
+        return None
+
+    # skip extended present bitmasks, the fields start after the last one
+    offset = 8
+    word = present
+    while word & (1 << 31):
+        if offset + 4 > it_len:
+            return None
+        word = int.from_bytes(frame[offset:offset + 4], "little")
+        offset += 4
+
+    for bit, (align, size) in enumerate(_RADIOTAP_FIELDS):
+        if present & (1 << bit):
+            offset += -offset % align
+            offset += size
+    if offset >= it_len:
+        return None
+
+    rssi = frame[offset]
+    rssi = rssi - 256 if rssi > 127 else rssi
+    mac = frame[it_len + 10:it_len + 16].hex(":")
+    return mac, rssi
+
+
+def raw_packet_handler(frame : memoryview, table : DeviceTable) -> None:
+    parsed = parse_frame(frame)
+    if parsed is not None:
+        mac, rssi = parsed
+        table.record(hash_mac_int(mac), rssi)
+
+
+def open_raw_socket(interface : str) -> socket.socket:
+    """Open an AF_PACKET socket on a monitor mode interface with the management frame filter attached."""
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    sock.bind((interface, 0))
+
+    program = b"".join(struct.pack("HBBI", *instruction) for instruction in MANAGEMENT_FILTER)
+    program_buffer = ctypes.create_string_buffer(program)
+    fprog = struct.pack("HL", len(MANAGEMENT_FILTER), ctypes.addressof(program_buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+    return sock
+
+
+class RawSniffer:
+    """
+    Capture thread on top of `open_raw_socket`, with the parts of scapy's `AsyncSniffer`
+    interface used in this project (start, stop, running, thread and exception).
+    `prn` is called with a memoryview of every frame, which is only valid during the call.
+    """
+
+    def __init__(self, iface : str, prn):
+        self.iface = iface
+        self.prn = prn
+        self.running = False
+        self.exception = None
+        self._sock = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self.running = True
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+        self.thread.join()
+
+    def kernel_drops(self) -> int:
+        """Frames the kernel dropped because the socket buffer was full, since the last call."""
+        sock = self._sock
+        if sock is None:
+            return 0
+        try:
+            # tpacket_stats, reset by every read
+            _, drops = struct.unpack("II", sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 8))
+        except OSError:
+            return 0
+        return drops
+
+    def _run(self) -> None:
+        buffer = bytearray(MAX_FRAME_SIZE)
+        view = memoryview(buffer)
+        try:
+            with open_raw_socket(self.iface) as sock:
+                self._sock = sock
+                sock.settimeout(0.5)
+                while self.running:
+                    try:
+                        size = sock.recv_into(buffer)
+                    except socket.timeout:
+                        continue
+                    self.prn(view[:size])
+        except Exception as e:
+            self.exception = e
+        finally:
+            self._sock = None
+            self.running = False
+
+
+class ContinuousSniffer:
+    """
+    Sniffs continuously on a background thread, so no packets are missed while data is uploaded.
+
+    At every window boundary (aligned to multiples of `window_duration` seconds) the statistics of
+    the devices seen are copied out of the device table, the touched slots are reset and the
+    completed window is put on a bounded queue (`windows`, drained by `supervisor.CaptureSupervisor`).
+    If the consumer falls behind and the queue is full, the completed window is dropped and
+    counted in `dropped_windows` and `dropped_packets`.
+
+    Frame rates, drops and the time to handle a frame (sampled every
+    `handler_sample_interval` frames) are recorded in `metrics`.
+
+    The capture thread can be replaced with `restart_capture` (see `supervisor.CaptureSupervisor`)
+    without losing the device table, the current window or the completed windows.
+    `capture_started`, `first_frame_at` and `last_frame_at` are `time.monotonic()` times of the
+    current capture.
+    """
+
+    def __init__(
+        self,
+        interface: str,
+        window_duration: int,
+        max_pending: int = 12,
+        backend: str = "scapy",
+        metrics: Metrics | None = None,
+        handler_sample_interval: int = 64,
+    ):
+        self.interface = interface
+        self.window_duration = window_duration
+        self.windows = queue.Queue(maxsize=max_pending)
+        self.dropped_windows = 0
+        self.dropped_packets = 0
+        self.metrics = metrics or Metrics("crowd_sensor")
+        self.handler_sample_interval = handler_sample_interval
+        self.backend = backend
+        self.capture_started = time.monotonic()
+        self.first_frame_at: float | None = None
+        self.last_frame_at: float | None = None
+
+        self._lock = threading.Lock()
+        self._table = DeviceTable()
+        self._packets = 0
+        self._window_start = time.time()
+        self._stop = threading.Event()
+        self._packet_handler = raw_packet_handler if backend == "raw" else packet_handler
+        self._sniffer = self._new_capture()
+        self._rotator = threading.Thread(target=self._rotate_windows, daemon=True)
+
+    def _new_capture(self) -> RawSniffer | AsyncSniffer:
+        if self.backend == "raw":
+            return RawSniffer(self.interface, prn=self._handle)
+        return AsyncSniffer(iface=self.interface, prn=self._handle, store=False)
+
+    def start(self) -> None:
+        self._window_start = time.time()
+        self.capture_started = time.monotonic()
+        self._sniffer.start()
+        self._rotator.start()
+
+    def restart_capture(self) -> None:
+        """
+        Replace the capture thread, e.g. after the interface was put back into monitor mode.
+        Frames captured so far stay in the current window.
+        """
+        old = self._sniffer
+        try:
+            if old.running:
+                old.stop()
+        except Exception:
+            # the socket of a failed capture may already be gone, it is abandoned either way
+            pass
+        with self._lock:
+            self._sniffer = self._new_capture()
+            self.capture_started = time.monotonic()
+            self.first_frame_at = None
+            self.last_frame_at = None
+        self._sniffer.start()
+
+    def capture_error(self) -> Exception | None:
+        """The exception of the capture thread, or an OSError if it stopped without one. None while it runs."""
+        sniffer = self._sniffer
+        if sniffer.exception is not None:
+            return sniffer.exception
+        thread = getattr(sniffer, "thread", None)
+        if thread is not None and not thread.is_alive():
+            return OSError(f"Capture on {self.interface} stopped")
+        return None
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._rotator.join()
+        if self._sniffer.running:
+            self._sniffer.stop()
+
+    def _handle(self, pkt: Packet | memoryview) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self.last_frame_at = now
+            if self.first_frame_at is None:
+                self.first_frame_at = now
+                self.metrics.observe("time_to_first_frame_seconds", now - self.capture_started)
+            self._packets += 1
+            if self._packets % self.handler_sample_interval:
+                self._packet_handler(pkt, self._table)
+            else:
+                start = time.perf_counter()
+                self._packet_handler(pkt, self._table)
+                self.metrics.observe("frame_handling_seconds", time.perf_counter() - start)
+
+    def _rotate_windows(self) -> None:
+        while True:
+            now = time.time()
+            window_end = (now // self.window_duration + 1) * self.window_duration
+            if self._stop.wait(window_end - now):
+                return
+
+            with self._lock:
+                stats = self._table.snapshot()
+                self._table.reset()
+                packets, self._packets = self._packets, 0
+                window_start, self._window_start = self._window_start, window_end
+
+            self._record_window(stats, packets, window_end - window_start)
+            try:
+                self.windows.put_nowait((datetime.fromtimestamp(window_start), stats))
+            except queue.Full:
+                self.dropped_windows += 1
+                self.dropped_packets += packets
+                self.metrics.inc("dropped_windows_total")
+                self.metrics.inc("dropped_frames_total", packets)
+            self.metrics.set("window_queue_depth", self.windows.qsize())
 
+    def _record_window(self, stats: WindowStats, packets: int, duration: float) -> None:
+        metrics = self.metrics
+        accepted = stats.total_frames()
+        metrics.inc("frames_seen_total", packets)
+        metrics.inc("frames_accepted_total", accepted)
+        metrics.set("frames_seen_per_second", packets / max(duration, 1e-9))
+        metrics.set("frames_accepted_per_second", accepted / max(duration, 1e-9))
+        metrics.set("devices_in_window", len(stats))
+        kernel_drops = getattr(self._sniffer, "kernel_drops", None)
+        if kernel_drops is not None:
+            metrics.inc("kernel_dropped_frames_total", kernel_drops())
@@ -0,0 +1,102 @@
+import sqlite3
+import threading
+
+from utils import COLUMNS
+
+
+class Spool:
+    """
+    Append-only on-disk spool (SQLite) for rows waiting to be uploaded.
+
+    Every completed window is appended before it is uploaded, so a failed upload or a restart
+    of the service costs latency, not data. Rows are removed only after they have been written,
+    or moved to the `quarantine` table if the sink keeps rejecting them.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, device_name TEXT, timestamp TEXT, crowd_data TEXT)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS quarantine ("
+            "id INTEGER PRIMARY KEY, device_name TEXT, timestamp TEXT, crowd_data TEXT, error TEXT, quarantined_at TEXT)"
+        )
+
+    def append(self, rows: list[dict]) -> None:
+        with self._not_empty:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO spool (device_name, timestamp, crowd_data) VALUES (?, ?, ?)",
+                    [tuple(row[col] for col in COLUMNS) for row in rows],
+                )
+            self._not_empty.notify_all()
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def peek(self, max_rows: int, timeout: float | None = None) -> tuple[list[int], list[dict]]:
+        """
+        Return the ids and the oldest `max_rows` rows in the spool without removing them.
+        The rows of the last window are always returned together, even beyond `max_rows`,
+        so a window is never split across uploads (deltas are applied per window).
+        Waits up to `timeout` seconds for rows if the spool is empty.
+        """
+        with self._not_empty:
+            self._not_empty.wait_for(self._has_rows, timeout=timeout)
+            result = self._conn.execute(
+                f"SELECT id, {', '.join(COLUMNS)} FROM spool ORDER BY id LIMIT ?", (max_rows,)
+            ).fetchall()
+            if result and len(result) == max_rows:
+                # the rows of a window are appended together, so they have consecutive ids
+                last_id, device_name, timestamp = result[-1][:3]
+                result += self._conn.execute(
+                    f"SELECT id, {', '.join(COLUMNS)} FROM spool "
+                    "WHERE id > ? AND device_name = ? AND timestamp = ? ORDER BY id",
+                    (last_id, device_name, timestamp),
+                ).fetchall()
+
+        ids = [row[0] for row in result]
+        rows = [dict(zip(COLUMNS, row[1:])) for row in result]
+        return ids, rows
+
+    def remove(self, ids: list[int]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM spool WHERE id = ?", [(i,) for i in ids])
+
+    def quarantine(self, ids: list[int], error: str) -> None:
+        """Move rows the sink keeps rejecting out of the spool, with the error, for inspection."""
+        with self._lock, self._conn:
+            placeholders = ", ".join("?" * len(ids))
+            self._conn.execute(
+                f"INSERT INTO quarantine SELECT id, {', '.join(COLUMNS)}, ?, datetime('now') "
+                f"FROM spool WHERE id IN ({placeholders})",
+                (error, *ids),
+            )
+            self._conn.execute(f"DELETE FROM spool WHERE id IN ({placeholders})", ids)
+
+    def requeue(self) -> int:
+        """
+        Move the quarantined rows back into the spool, e.g. after the sink was fixed.
+        They keep their ids, so they are uploaded before the rows spooled since. Returns their number.
+        """
+        with self._not_empty:
+            with self._conn:
+                count = self._conn.execute(
+                    f"INSERT INTO spool (id, {', '.join(COLUMNS)}) SELECT id, {', '.join(COLUMNS)} FROM quarantine"
+                ).rowcount
+                self._conn.execute("DELETE FROM quarantine")
+            self._not_empty.notify_all()
+        return count
+
+    def quarantined(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM quarantine").fetchone()[0]
+
+    def _has_rows(self) -> bool:
+        return self._conn.execute("SELECT 1 FROM spool LIMIT 1").fetchone() is not None
@@ -0,0 +1,152 @@
+import os
+import queue
+import subprocess
+import time
+from datetime import datetime
+
+from device_table import WindowStats
+from metrics import Metrics
+from sniff import ContinuousSniffer
+
+# Recovery of the capture inside the sensor process (see raspberry.py).
+# Before, every capture fault ended the process and systemd reran start_wifi_sniffer.sh, which
+# re-imported scapy and reran the self-test, losing tens of seconds of frames. Now the interface
+# is put back into monitor mode and only the capture thread is replaced; the imported modules,
+# the device table, the spool and the upload worker are kept.
+
+# seconds without a frame after which the capture is considered broken
+STALL_TIMEOUT = 15
+MIN_RECOVERY_DELAY = 1
+MAX_RECOVERY_DELAY = 60
+POLL_INTERVAL = 1
+COMMAND_TIMEOUT = 10
+
+
+def ensure_monitor_mode(interface: str) -> None:
+    """
+    Put `interface` into monitor mode, with the same commands as pi/start_wifi_sniffer.sh.
+    Raises OSError if it is not in monitor mode afterwards.
+    """
+    for command in (
+        ["ip", "link", "set", interface, "down"],
+        ["iw", "dev", interface, "set", "power_save", "off"],
+        ["iw", "dev", interface, "set", "type", "monitor"],
+        ["ip", "link", "set", interface, "up"],
+    ):
+        # like the script, failures are only judged by the check below
+        subprocess.run(command, capture_output=True, timeout=COMMAND_TIMEOUT)
+
+    info = subprocess.run(["iw", "dev", interface, "info"], capture_output=True, text=True, timeout=COMMAND_TIMEOUT)
+    if "type monitor" not in info.stdout:
+        raise OSError(f"{interface} is not in monitor mode: {(info.stderr or info.stdout).strip()}")
+
+
+def process_age() -> float:
+    """Seconds since this process was started (Linux), including the time to import its modules."""
+    with open("/proc/self/stat") as f:
+        # the fields after the command name, which may contain spaces; starttime is field 22
+        fields = f.read().rsplit(")", 1)[1].split()
+    started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    return time.clock_gettime(time.CLOCK_BOOTTIME) - started
+
+
+class CaptureSupervisor:
+    """
+    Hands out the windows of `sniffer` and recovers its capture in place: if the capture thread
+    dies, no frame arrives for `stall_timeout` seconds or a window has no devices (the interface
+    is most likely not in monitor mode), `reset_interface` is called and the capture restarted.
+    Failed recoveries are retried with exponential backoff.
+
+    Recorded in `metrics`: `capture_recoveries_total`, `interface_reset_failures_total`,
+    `recovery_downtime_seconds` (from the last frame before a fault to the first frame after it)
+    and `startup_seconds` (from the start of the process to its first frame).
+    `time_to_first_frame_seconds` of every capture is recorded by the sniffer.
+    """
+
+    def __init__(
+        self,
+        sniffer: ContinuousSniffer,
+        metrics: Metrics,
+        stall_timeout: float = STALL_TIMEOUT,
+        reset_interface=ensure_monitor_mode,
+    ):
+        self.sniffer = sniffer
+        self.metrics = metrics
+        self.stall_timeout = stall_timeout
+        self.reset_interface = reset_interface
+        self.recoveries = 0
+
+        self._recovery_delay = MIN_RECOVERY_DELAY
+        self._next_attempt = 0.0
+        # monotonic time of the last frame before the current fault, None while the capture works
+        self._fault_at: float | None = None
+        self._reported_capture: float | None = None
+
+        metrics.describe("time_to_first_frame_seconds", "Time from starting a capture to its first frame")
+        metrics.describe("recovery_downtime_seconds", "Time without frames around a recovered capture fault")
+        metrics.describe("startup_seconds", "Time from the start of the process to the first frame")
+
+    def get_window(self) -> tuple[datetime, WindowStats]:
+        """Block until the next completed window with devices, recovering the capture while waiting."""
+        while True:
+            self.check()
+            try:
+                window_start, stats = self.sniffer.windows.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if len(stats) == 0:
+                self.recover(f"no devices in the window of {window_start:%H:%M}")
+                continue
+            return window_start, stats
+
+    def check(self) -> None:
+        """Report a capture that got its first frame, recover one that failed or stalled."""
+        sniffer = self.sniffer
+        if sniffer.first_frame_at is not None and self._reported_capture != sniffer.capture_started:
+            self._reported_capture = sniffer.capture_started
+            self._report_first_frame()
+
+        error = sniffer.capture_error()
+        silent = time.monotonic() - (sniffer.last_frame_at or sniffer.capture_started)
+        if error is not None:
+            self.recover(f"capture failed ({error})")
+        elif silent > self.stall_timeout:
+            self.recover(f"no frames for {silent:.0f} s")
+
+    def recover(self, reason: str) -> None:
+        """Re-assert monitor mode and restart the capture, unless the last attempt is too recent."""
+        now = time.monotonic()
+        if now < self._next_attempt:
+            return
+        sniffer = self.sniffer
+        if self._fault_at is None:
+            self._fault_at = sniffer.last_frame_at or sniffer.capture_started
+
+        print(f"Capture on {sniffer.interface}: {reason}, recovering...", flush=True)
+        self.recoveries += 1
+        self.metrics.inc("capture_recoveries_total")
+        try:
+            self.reset_interface(sniffer.interface)
+        except (OSError, subprocess.SubprocessError) as e:
+            # restart the capture anyway, the interface may come back on its own
+            print(f"Could not reset {sniffer.interface}: {e}", flush=True)
+            self.metrics.inc("interface_reset_failures_total")
+        sniffer.restart_capture()
+
+        self._next_attempt = time.monotonic() + self._recovery_delay
+        self._recovery_delay = min(2 * self._recovery_delay, MAX_RECOVERY_DELAY)
+
+    def _report_first_frame(self) -> None:
+        sniffer = self.sniffer
+        first_frame = sniffer.first_frame_at - sniffer.capture_started
+        if self._fault_at is not None:
+            downtime = sniffer.first_frame_at - self._fault_at
+            self._fault_at = None
+            self._recovery_delay = MIN_RECOVERY_DELAY
+            self._next_attempt = 0.0
+            self.metrics.observe("recovery_downtime_seconds", downtime)
+            print(f"Capture recovered: first frame {first_frame:.2f} s after the restart, {downtime:.1f} s without frames", flush=True)
+        elif self.recoveries == 0:
+            startup = process_age() - (time.monotonic() - sniffer.first_frame_at)
+            self.metrics.set("startup_seconds", startup)
+            print(f"First frame {first_frame:.2f} s after starting the capture, {startup:.1f} s after starting the process", flush=True)
@@ -0,0 +1,196 @@
+import re
+import struct
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from typing import Callable, Iterator
+
+import numpy as np
+import pandas as pd
+
+from encoding import encode_crowd_data
+from utils import COLUMNS
+
+# Synthetic data for benchmarks and offline runs: radiotap frames for the sniffer,
+# crowd data rows for the dashboard and a fake worksheet in place of gspread.
+
+DEVICES = ["census1", "census2", "census3"]
+DEVICE_LL = {
+    "census1": (55.6180, 12.0800),
+    "census2": (55.6190, 12.0820),
+    "census3": (55.6175, 12.0830),
+}
+START = datetime(2025, 6, 29)
+SCAN_DURATION = 300
+MAX_LENGTH = 49_000
+SEEN_FRACTION = 0.05
+
+# radiotap header with Flags, Channel and dBm_AntSignal, as written by the rtl8812au driver
+_RADIOTAP = struct.Struct("<BBHIBxHHb")
+_RADIOTAP_PRESENT = (1 << 1) | (1 << 3) | (1 << 5)
+# probe request from addr2 to broadcast
+_PROBE_REQUEST = struct.Struct("<BBH6s6s6sH")
+
+
+def synthetic_frames(num_frames: int, num_devices: int, seed: int = 0) -> list[bytes]:
+    """
+    Make radiotap + 802.11 frames from `num_devices` different senders.
+    Every fourth frame is a data frame, which the sniffer must ignore.
+    """
+    rng = np.random.default_rng(seed)
+    macs = [bytes(mac) for mac in rng.integers(0, 256, size=(num_devices, 6), dtype=np.uint8)]
+    senders = rng.integers(0, num_devices, size=num_frames)
+    rssi = rng.integers(-95, -30, size=num_frames)
+
+    frames = []
+    for i, (sender, signal) in enumerate(zip(senders.tolist(), rssi.tolist())):
+        # frame control: management/probe request (0x40) or data (0x08)
+        frame_control = 0x08 if i % 4 == 3 else 0x40
+        header = _RADIOTAP.pack(0, 0, _RADIOTAP.size, _RADIOTAP_PRESENT, 0, 2412, 0x00A0, signal)
+        body = _PROBE_REQUEST.pack(frame_control, 0, 0, b"\xff" * 6, macs[sender], b"\xff" * 6, 0)
+        frames.append(header + body)
+    return frames
+
+
+def feed_frames(frames: list, handler: Callable, packet_rate: float | None = None) -> float:
+    """
+    Feed frames to `handler`, paced at `packet_rate` frames per second if given.
+    Returns the achieved rate in frames per second.
+    """
+    start = time.perf_counter()
+    for i, frame in enumerate(frames):
+        if packet_rate:
+            # only sleep when more than a millisecond ahead of schedule
+            ahead = start + i / packet_rate - time.perf_counter()
+            if ahead > 1e-3:
+                time.sleep(ahead)
+        handler(frame)
+    return len(frames) / (time.perf_counter() - start)
+
+
+def write_pcap(frames: list[bytes], path: str) -> None:
+    """Write frames to a pcap file with radiotap link type, e.g. for `replay.py`."""
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 127))
+        for i, frame in enumerate(frames):
+            f.write(struct.pack("<IIII", i // 1000, (i % 1000) * 1000, len(frame), len(frame)))
+            f.write(frame)
+
+
+def synthetic_scan(num_devices: int, seed: int = 0) -> dict[str, int]:
+    """Make the device -> RSSI dict of a single scan (see `WindowStats.to_dict`)."""
+    rng = np.random.default_rng(seed)
+    hashes = rng.choice(2**24, size=num_devices, replace=False)
+    rssi = rng.integers(-95, -30, size=num_devices)
+    return {f"{h:06x}": int(r) for h, r in zip(hashes, rssi)}
+
+
+def synthetic_window(num_visitors: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Make a 10 minute window of crowd data where every visitor is seen by all devices.
+    Returns observations in long format, as held by `Rollups.observations`.
+    """
+    rng = np.random.default_rng(seed)
+    mac_ids = rng.choice(2**24, size=num_visitors, replace=False).astype(np.int32)
+    return pd.DataFrame({
+        "timestamp": np.full(num_visitors * len(DEVICES), np.datetime64("2025-07-03T20:00", "ns")),
+        "device_name": pd.Categorical(np.repeat(DEVICES, num_visitors)),
+        "mac_id": np.tile(mac_ids, len(DEVICES)),
+        "rssi": rng.integers(-95, -30, size=num_visitors * len(DEVICES)).astype(np.int8),
+    })
+
+
+def synthetic_sheet_rows(
+    num_visitors: int,
+    days: float = 1,
+    seen_fraction: float = SEEN_FRACTION,
+    legacy_format: bool = False,
+    seed: int = 0,
+) -> Iterator[list[str]]:
+    """
+    Yield sheet rows (see `COLUMNS`) as uploaded by the sensors over `days` days.
+    Every scan, each device sees `seen_fraction` of a population of `num_visitors` visitors.
+    """
+    rng = np.random.default_rng(seed)
+    population = rng.choice(2**24, size=num_visitors, replace=False)
+    seen = max(1, int(num_visitors * seen_fraction))
+
+    for scan in range(int(days * 24 * 3600 / SCAN_DURATION)):
+        timestamp = (START + timedelta(seconds=scan * SCAN_DURATION)).strftime("%Y-%m-%d %H:%M")
+        for dev in DEVICES:
+            hashes = rng.choice(population, size=seen, replace=False)
+            rssi = rng.integers(-95, -30, size=seen)
+            crowd_data = {f"{h:06x}": int(r) for h, r in zip(hashes, rssi)}
+            if legacy_format:
+                cells = [str(crowd_data)]
+            else:
+                cells = encode_crowd_data(crowd_data, MAX_LENGTH)
+            for cell in cells:
+                yield [dev, timestamp, cell]
+
+
+def synthetic_crowd_windows(
+    num_visitors: int,
+    num_windows: int,
+    stay_probability: float = 0.9,
+    rssi_jitter: float = 2.0,
+    seed: int = 0,
+) -> Iterator[dict[int, int]]:
+    """
+    Yield the mac hash -> RSSI of consecutive windows of one sensor with a persistent crowd:
+    every visitor stays to the next window with `stay_probability` and is replaced by a new one
+    otherwise. Visitors that stay keep their RSSI up to a jitter of `rssi_jitter` dB.
+    """
+    rng = np.random.default_rng(seed)
+    hashes = rng.choice(2**24, size=num_visitors, replace=False)
+    base_rssi = rng.integers(-95, -30, size=num_visitors)
+    for _ in range(num_windows):
+        rssi = np.clip(np.round(base_rssi + rng.normal(0, rssi_jitter, size=num_visitors)), -100, -1)
+        yield dict(zip(hashes.tolist(), rssi.astype(int).tolist()))
+
+        leaving = rng.random(num_visitors) > stay_probability
+        hashes[leaving] = rng.integers(0, 2**24, size=leaving.sum())
+        base_rssi[leaving] = rng.integers(-95, -30, size=leaving.sum())
+
+
+class FakeWorksheet:
+    """
+    In-memory stand-in for a gspread `Worksheet`, with the methods used in this project.
+    Only ranges of the form "A<row>:C" are supported by `get_values`.
+    """
+
+    def __init__(self, rows: list[list[str]] | None = None):
+        self.rows = [list(COLUMNS)] + [list(row) for row in rows or []]
+
+    def row_values(self, row: int) -> list[str]:
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def append_row(self, values: list, value_input_option: str = "RAW") -> None:
+        self.rows.append([str(v) for v in values])
+
+    def append_rows(self, values: list[list], value_input_option: str = "RAW") -> None:
+        self.rows.extend([str(v) for v in row] for row in values)
+
+    def get_all_records(self) -> list[dict]:
+        header = self.rows[0]
+        return [dict(zip(header, row)) for row in self.rows[1:]]
+
+    def get_values(self, range_name: str) -> list[list[str]]:
+        start = int(re.fullmatch(r"A(\d+):C", range_name).group(1))
+        return [list(row) for row in self.rows[start - 1:]]
+
+
+def main():
+    parser = ArgumentParser(description="Write synthetic radiotap frames to a pcap file")
+    parser.add_argument("output", type=str)
+    parser.add_argument("--frames", type=int, default=100_000)
+    parser.add_argument("--devices", type=int, default=5_000)
+
+    args = parser.parse_args()
+
+    write_pcap(synthetic_frames(args.frames, args.devices), args.output)
+    print(f"Wrote {args.frames} frames from {args.devices} devices to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
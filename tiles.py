@@ -0,0 +1,144 @@
+import json
+import math
+import os
+import shutil
+from argparse import ArgumentParser
+
+import numpy as np
+from PIL import Image
+
+from utils import parameters_key
+
+# The festival map as a pyramid of XYZ tiles (256 x 256 Web Mercator tiles, `<z>/<x>/<y>.webp`)
+# in the static folder of the app, so the browser only loads the tiles in view and caches them,
+# instead of the whole image being embedded in the page on every rerun.
+# The image is warped onto the tiles through its four georeferenced corners, tiles outside
+# the map are not written and the area around the map is transparent.
+
+MAP_IMAGE = "festival_map.jpg"
+# (lat, lon) of the upper-left, lower-left, lower-right and upper-right corner of the image
+MAP_CORNERS = (
+    (55.631644, 12.053289),
+    (55.606569, 12.049529),
+    (55.605214, 12.112965),
+    (55.630122, 12.115078),
+)
+# Streamlit serves ./static at /app/static when `server.enableStaticServing` is set
+TILE_DIR = os.path.join("static", "tiles")
+TILE_SIZE = 256
+MIN_ZOOM = 12
+# one zoom level above the resolution of the image; the map enlarges these tiles beyond it
+MAX_ZOOM = 17
+QUALITY = 80
+# changes whenever the way tiles are cut changes, so old pyramids are rebuilt
+_VERSION = 1
+
+
+def lat_lon_to_pixels(lat: float, lon: float, zoom: int) -> tuple[float, float]:
+    """Global Web Mercator pixel coordinates of (lat, lon) at `zoom`."""
+    size = TILE_SIZE * 2**zoom
+    x = (lon + 180) / 360 * size
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * size
+    return x, y
+
+
+def _homography(source: np.ndarray, target: np.ndarray) -> np.ndarray:
+    """3 x 3 projective transform mapping the 4 `source` points onto the 4 `target` points."""
+    rows, rhs = [], []
+    for (x, y), (u, v) in zip(source, target):
+        rows.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        rows.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+        rhs += [u, v]
+    return np.append(np.linalg.solve(np.array(rows), np.array(rhs)), 1).reshape(3, 3)
+
+
+def pyramid_key(image_path: str = MAP_IMAGE, corners=MAP_CORNERS, min_zoom: int = MIN_ZOOM, max_zoom: int = MAX_ZOOM) -> str:
+    """Changes whenever the image, its corners or the zoom levels change."""
+    stat = os.stat(image_path)
+    return parameters_key(_VERSION, stat.st_size, stat.st_mtime_ns, corners, min_zoom, max_zoom, QUALITY)
+
+
+def pyramid_is_current(directory: str = TILE_DIR, key: str | None = None) -> bool:
+    manifest = os.path.join(directory, "tiles.json")
+    if not os.path.exists(manifest):
+        return False
+    with open(manifest) as f:
+        return json.load(f)["key"] == (key or pyramid_key())
+
+
+def build_pyramid(
+    image_path: str = MAP_IMAGE,
+    corners=MAP_CORNERS,
+    directory: str = TILE_DIR,
+    min_zoom: int = MIN_ZOOM,
+    max_zoom: int = MAX_ZOOM,
+) -> int:
+    """
+    Cut the image at `image_path` into tiles for the zoom levels `min_zoom` to `max_zoom`.
+    The pyramid is built next to `directory` and then moved in place, so the app never
+    serves half a pyramid. Returns the number of tiles written.
+    """
+    image = Image.open(image_path).convert("RGB")
+    # warped separately: PIL premultiplies the whole of an RGBA image for every warp
+    footprint = Image.new("L", image.size, 255)
+    width, height = image.size
+    image_corners = np.array([(0, 0), (0, height), (width, height), (width, 0)], dtype=float)
+    # pixels at `max_zoom` relative to the upper-left corner, to keep the system well conditioned
+    origin = lat_lon_to_pixels(*corners[0], max_zoom)
+    map_corners = np.array([lat_lon_to_pixels(lat, lon, max_zoom) for lat, lon in corners]) - origin
+    to_image = _homography(map_corners, image_corners)
+
+    staging = directory.rstrip(os.sep) + ".building"
+    shutil.rmtree(staging, ignore_errors=True)
+    written = 0
+    for zoom in range(max_zoom, min_zoom - 1, -1):
+        scale = 2 ** (max_zoom - zoom)
+        # image pixels per tile pixel: low zoom levels are cut from a reduced image,
+        # the perspective warp samples pixels without averaging them
+        reduction = max(1, int(width * scale / np.ptp(map_corners[:, 0])))
+        source = image.reduce(reduction) if reduction > 1 else image
+        mask = footprint.reduce(reduction) if reduction > 1 else footprint
+
+        xs, ys = zip(*(lat_lon_to_pixels(lat, lon, zoom) for lat, lon in corners))
+        for tile_x in range(int(min(xs)) // TILE_SIZE, int(max(xs)) // TILE_SIZE + 1):
+            for tile_y in range(int(min(ys)) // TILE_SIZE, int(max(ys)) // TILE_SIZE + 1):
+                # tile pixel -> pixel at max_zoom relative to the origin -> pixel of the (reduced) image
+                to_max_zoom = np.array([
+                    [scale, 0, tile_x * TILE_SIZE * scale - origin[0]],
+                    [0, scale, tile_y * TILE_SIZE * scale - origin[1]],
+                    [0, 0, 1],
+                ])
+                transform = np.diag([1 / reduction, 1 / reduction, 1]) @ to_image @ to_max_zoom
+                transform /= transform[2, 2]
+                warp = ((TILE_SIZE, TILE_SIZE), Image.Transform.PERSPECTIVE, tuple(transform.flatten()[:8]), Image.Resampling.BILINEAR)
+                alpha = mask.transform(*warp)
+                if alpha.getbbox() is None:
+                    continue
+                tile = source.transform(*warp)
+                tile.putalpha(alpha)
+                path = os.path.join(staging, str(zoom), str(tile_x))
+                os.makedirs(path, exist_ok=True)
+                tile.save(os.path.join(path, f"{tile_y}.webp"), quality=QUALITY)
+                written += 1
+
+    with open(os.path.join(staging, "tiles.json"), "w") as f:
+        json.dump({"key": pyramid_key(image_path, corners, min_zoom, max_zoom), "min_zoom": min_zoom, "max_zoom": max_zoom, "tiles": written}, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(staging, directory)
+    return written
+
+
+def main():
+    parser = ArgumentParser(description="Cut the festival map into XYZ tiles for the website")
+    parser.add_argument("--image", type=str, default=MAP_IMAGE)
+    parser.add_argument("--out", type=str, default=TILE_DIR)
+    parser.add_argument("--min_zoom", type=int, default=MIN_ZOOM)
+    parser.add_argument("--max_zoom", type=int, default=MAX_ZOOM)
+
+    args = parser.parse_args()
+    written = build_pyramid(args.image, MAP_CORNERS, args.out, args.min_zoom, args.max_zoom)
+    print(f"Wrote {written} tiles to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from heatmap import MAX_CELLS
+from utils import ll_to_xy, parameters_key, xy_to_ll
+
+# Time-lapse of the heat-map: the whole period is triangulated once and binned into a
+# (time step x grid y x grid x) density cube, stored as a memory-mapped .npy file.
+# Every frame of the time-lapse is then a slice of the cube instead of a new triangulation.
+
+CUBE_DIR = "cubes"
+# cell size of the cube's grid in metres
+CELL_SIZE = 25.0
+# cubes kept on disk, the least recently built ones are removed first
+MAX_CUBES = 8
+
+
+def cube_key(*parts) -> str:
+    """Stable file name for a cube built from `parts` (window, devices, markers, calibration, …)."""
+    return parameters_key(*parts)
+
+
+class DensityCube:
+    """
+    Counts of triangulated positions per time step and grid cell.
+
+    `counts[t, iy, ix]` is the number of positions in time step `times[t]` and the cell whose
+    south-west corner is `cell_size * (ix, iy)` metres east/north of the south-west corner
+    `origin_ll` of the grid. `counts` is memory-mapped, so only the frames that are looked at
+    are read from disk.
+    """
+
+    def __init__(self, path: str):
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        self.origin_ll = tuple(meta["origin_ll"])
+        self.cell_size = meta["cell_size"]
+        self.max_count = meta["max_count"]
+        self.times = pd.date_range(meta["start"], periods=meta["num_steps"], freq=meta["step"])
+        self.counts = np.load(path + ".npy", mmap_mode="r")
+
+    @classmethod
+    def build(
+        cls,
+        path: str,
+        timestamps: np.ndarray,
+        lats: np.ndarray,
+        lons: np.ndarray,
+        bounds: list[list[float]],
+        start: pd.Timestamp,
+        end: pd.Timestamp,
+        step: str,
+        cell_size: float = CELL_SIZE,
+    ) -> "DensityCube":
+        """
+        Bin positions into a cube covering `bounds` ([[south, west], [north, east]]) from
+        `start` to `end` in steps of `step`, write it to `path` and open it.
+        Positions outside the bounds or the period are dropped.
+        """
+        (south, west), (north, east) = bounds
+        width, height = ll_to_xy(north, east, south, west)
+        nx, ny = int(width // cell_size) + 1, int(height // cell_size) + 1
+        start = pd.Timestamp(start).floor(step)
+        num_steps = int((pd.Timestamp(end) - start) // pd.Timedelta(step)) + 1
+
+        x, y = ll_to_xy(np.asarray(lats), np.asarray(lons), south, west)
+        it = ((pd.DatetimeIndex(timestamps) - start) // pd.Timedelta(step)).to_numpy()
+        ix = np.floor(x / cell_size).astype(np.int64)
+        iy = np.floor(y / cell_size).astype(np.int64)
+        inside = (it >= 0) & (it < num_steps) & (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+
+        counts = np.lib.format.open_memmap(path + ".npy", mode="w+", dtype=np.uint32, shape=(num_steps, ny, nx))
+        counts[:] = 0
+        np.add.at(counts.reshape(-1), (it[inside] * ny + iy[inside]) * nx + ix[inside], 1)
+        max_count = int(counts.max()) if counts.size else 0
+        counts.flush()
+        del counts
+
+        with open(path + ".json", "w") as f:
+            json.dump({
+                "origin_ll": [south, west],
+                "cell_size": cell_size,
+                "max_count": max_count,
+                "start": start.isoformat(),
+                "step": step,
+                "num_steps": num_steps,
+            }, f)
+        return cls(path)
+
+    def frame_cells(self, t: int, max_cells: int = MAX_CELLS) -> list[list[float]]:
+        """
+        [lat, lon, weight] of the centre of every non-empty cell in time step `t`, heaviest
+        `max_cells` only. Weights are scaled by the fullest cell of the whole cube, so frames
+        are comparable while scrubbing.
+        """
+        frame = self.counts[t]
+        iy, ix = np.nonzero(frame)
+        weights = frame[iy, ix]
+        if len(weights) > max_cells:
+            keep = np.argpartition(weights, -max_cells)[-max_cells:]
+            iy, ix, weights = iy[keep], ix[keep], weights[keep]
+
+        lat, lon = xy_to_ll((ix + 0.5) * self.cell_size, (iy + 0.5) * self.cell_size, *self.origin_ll)
+        return np.column_stack([lat, lon, weights / max(self.max_count, 1)]).tolist()
+
+
+def prune_cubes(directory: str = CUBE_DIR, keep: int = MAX_CUBES) -> None:
+    """Remove all but the `keep` most recently built cubes in `directory`."""
+    if not os.path.isdir(directory):
+        return
+    paths = sorted(
+        (os.path.join(directory, name[:-len(".json")]) for name in os.listdir(directory) if name.endswith(".json")),
+        key=lambda path: os.path.getmtime(path + ".json"),
+    )
+    for path in paths[:-keep] if keep else paths:
+        for suffix in (".npy", ".json"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
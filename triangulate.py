@@ -1,48 +1,242 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+
 import numpy as np
+import pandas as pd
+
+from processing import TIME_BIN
+from utils import rssi_to_distance, xy_to_ll
 
-def triangulate_positions(D, x1, x2, x3):
+# points need distances to at least this many devices to be located in 2D
+MIN_SENSORS = 3
+# Gauss-Newton steps after the linear estimate
+MAX_ITERATIONS = 5
+
+def multilaterate(
+    D: np.ndarray,
+    anchors: np.ndarray,
+    weights: np.ndarray | None = None,
+    iterations: int = MAX_ITERATIONS,
+) -> np.ndarray:
     """
-    Fast, vectorized triangulation from distances to 3 known devices.
-    
+    Batched, weighted multilateration from distances to any number of known devices.
+
     Parameters:
-    - D: (N, 3) array of distances from each point to the 3 devices
-    - x1, x2, x3: tuples or arrays with (x, y) positions of the 3 devices
+    - D: (N, K) array of distances from each point to the K devices, NaN where a device
+      did not see the point. Missing distances are masked out, not substituted.
+    - anchors: (K, 2) array with the (x, y) positions of the devices
+    - weights: optional (N, K) array of observation weights, e.g. `distance_weights(D)`
+    - iterations: number of Gauss-Newton steps refining the linear estimate
 
     Returns:
-    - positions: (N, 2) array of estimated (x, y) positions
-    """
-    
-    # D can contain NaNs. We handle them by substituting them with the largest number in that column
-    max_distances = np.nanmax(D, axis=0)
-    D = np.where(np.isnan(D), max_distances, D) 
-    
-    p1 = np.array(x1)
-    p2 = np.array(x2)
-    p3 = np.array(x3)
-
-    # Differences in coordinates
-    ex = p2 - p1  # (2,)
-    ey = p3 - p1  # (2,)
-
-    # Coefficient matrix A (2x2)
-    A = np.vstack([ex, ey])  # (2, 2)
-
-    # Precompute squared distances
-    d1_sq = D[:, 0] ** 2
-    d2_sq = D[:, 1] ** 2
-    d3_sq = D[:, 2] ** 2
-
-    # Precompute constants
-    p1_sq = np.dot(p1, p1)
-    p2_sq = np.dot(p2, p2)
-    p3_sq = np.dot(p3, p3)
-
-    b1 = 0.5 * (d1_sq - d2_sq + p2_sq - p1_sq)
-    b2 = 0.5 * (d1_sq - d3_sq + p3_sq - p1_sq)
-    B = np.stack([b1, b2], axis=1)  # (N, 2)
-
-    # Solve for positions
-    A_inv = np.linalg.pinv(A)  # (2, 2)
-    positions = B @ A_inv.T  # (N, 2)
-
-    return positions
\ No newline at end of file
+    - positions: (N, 2) array of estimated (x, y) positions. Points with fewer than
+      `MIN_SENSORS` distances, or only collinear devices, are NaN.
+    """
+    D = np.asarray(D, dtype=float)
+    anchors = np.asarray(anchors, dtype=float)
+    observed = ~np.isnan(D)
+    W = np.where(observed, 1.0 if weights is None else weights, 0.0)
+    d = np.where(observed, D, 0.0)
+
+    # points need MIN_SENSORS devices that are not all on one line
+    counts = observed.sum(axis=1)
+    ax, ay = anchors[:, 0], anchors[:, 1]
+    moments = observed @ np.column_stack([ax, ay, ax * ax, ax * ay, ay * ay])       # (N, 5)
+    n = np.maximum(counts, 1)
+    sxx = moments[:, 2] - moments[:, 0] ** 2 / n
+    sxy = moments[:, 3] - moments[:, 0] * moments[:, 1] / n
+    syy = moments[:, 4] - moments[:, 1] ** 2 / n
+    solvable = (counts >= MIN_SENSORS) & (sxx * syy - sxy**2 > 1e-6 * (sxx + syy) ** 2)
+
+    # 1. Linear estimate: |p|^2 - 2 a.p = d^2 - |a|^2 is linear in (x, y, |p|^2).
+    #    Solve the weighted normal equations of all points at once.
+    A = np.column_stack([-2 * anchors, np.ones(len(anchors))])                    # (K, 3)
+    b = d**2 - np.sum(anchors**2, axis=1)                                         # (N, K)
+    M = (W @ (A[:, :, None] * A[:, None, :]).reshape(len(A), 9)).reshape(-1, 3, 3)
+    v = (W * b) @ A                                                               # (N, 3)
+    M[~solvable] = np.eye(3)
+    p = np.linalg.solve(M, v[..., None])[:, :2, 0]                               # (N, 2)
+
+    # 2. Gauss-Newton on the range residuals |p - a| - d
+    for _ in range(iterations):
+        dx = p[:, 0, None] - anchors[None, :, 0]                                  # (N, K)
+        dy = p[:, 1, None] - anchors[None, :, 1]
+        ranges = np.maximum(np.hypot(dx, dy), 1e-6)
+        jx, jy = dx / ranges, dy / ranges
+        wr = W * (ranges - d)
+        # explicit 2x2 solve of the normal equations, lightly damped
+        a, bc, c = (W * jx * jx).sum(1) + 1e-9, (W * jx * jy).sum(1), (W * jy * jy).sum(1) + 1e-9
+        gx, gy = (wr * jx).sum(1), (wr * jy).sum(1)
+        det = a * c - bc**2
+        p = p - np.column_stack([c * gx - bc * gy, a * gy - bc * gx]) / det[:, None]
+
+    p[~solvable] = np.nan
+    return p
+
+
+def distance_weights(D: np.ndarray) -> np.ndarray:
+    """
+    Observation weights from RSSI confidence. Log-normal shadowing makes the error of a
+    distance estimate grow proportionally to the distance, so weights are 1 / d^2.
+    """
+    return 1.0 / np.maximum(D, 1.0) ** 2
+
+
+def distance_matrix(
+    df: pd.DataFrame,
+    devices: list[str],
+    N: float,
+    measured_power: float,
+    resolution: str = TIME_BIN,
+) -> pd.DataFrame:
+    """
+    Build the distance matrix for a span of crowd data.
+
+    Parameters:
+    - df: observations in long format, see `processing.OBSERVATION_DTYPES`
+    - devices: device names, in the column order of the returned matrix
+    - N, measured_power: RSSI calibration, see `rssi_to_distance`
+    - resolution: observations of a visitor within a time bin are averaged
+
+    Returns:
+    - DataFrame indexed by (timestamp, mac_id) with one distance column per device.
+      Visitors not seen by a device have NaN in that column.
+    """
+    # column of every observation, -1 for devices that are not used
+    columns = pd.Index(devices).get_indexer(df["device_name"].cat.categories)
+    column = columns[df["device_name"].cat.codes.to_numpy()]
+    used = column >= 0
+    column = column[used]
+
+    # pivot (time bin, mac) x device by summing into a dense matrix
+    step = pd.Timedelta(resolution).value
+    bins = df["timestamp"].to_numpy()[used].astype(np.int64) // step
+    keys, row = np.unique((bins << 24) | df["mac_id"].to_numpy()[used], return_inverse=True)
+    cells = row * len(devices) + column
+    size = len(keys) * len(devices)
+    total = np.bincount(cells, weights=df["rssi"].to_numpy()[used], minlength=size)
+    count = np.bincount(cells, minlength=size)
+    with np.errstate(invalid="ignore"):
+        rssi = (total / count).reshape(len(keys), len(devices))
+
+    index = pd.MultiIndex.from_arrays(
+        [pd.to_datetime((keys >> 24) * step), keys & 0xFFFFFF], names=["timestamp", "mac_id"]
+    )
+    return pd.DataFrame(rssi_to_distance(rssi, N=N, measured_power=measured_power), index=index, columns=devices)
+
+
+def triangulate_visitors(
+    df: pd.DataFrame,
+    device_xy: dict[str, tuple[float, float]],
+    N: float,
+    measured_power: float,
+) -> pd.DataFrame:
+    """
+    Triangulate every visitor in a span of crowd data, in local (x, y) metres.
+
+    Parameters:
+    - df: observations in long format, see `processing.OBSERVATION_DTYPES`
+    - device_xy: the devices used for triangulation (at least 3) and their (x, y) positions
+    - N, measured_power: RSSI calibration, see `rssi_to_distance`
+
+    Returns:
+    - DataFrame with the columns `timestamp` (time bin), `mac_id`, `x`, `y` and `sensors`
+      (number of devices that saw the visitor), one row per visitor and time bin seen by
+      at least `MIN_SENSORS` devices, sorted by timestamp and mac id
+    """
+    devices = list(device_xy)
+    D = distance_matrix(df, devices, N, measured_power)
+    sensors = D.notna().sum(axis=1).to_numpy()
+    D = D[sensors >= MIN_SENSORS]
+    sensors = sensors[sensors >= MIN_SENSORS]
+    if D.empty:
+        positions = np.empty((0, 2))
+    else:
+        distances = D.to_numpy()
+        positions = multilaterate(distances, np.array(list(device_xy.values())), distance_weights(distances))
+
+    # visitors only seen by devices on one line cannot be located
+    located = ~np.isnan(positions[:, 0])
+    return pd.DataFrame({
+        "timestamp": D.index.get_level_values("timestamp")[located],
+        "mac_id": D.index.get_level_values("mac_id")[located].astype(np.int32),
+        "x": positions[located, 0],
+        "y": positions[located, 1],
+        "sensors": sensors[located].astype(np.int8),
+    })
+
+
+def triangulate_xy(
+    df: pd.DataFrame,
+    device_xy: dict[str, tuple[float, float]],
+    N: float,
+    measured_power: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """`triangulate_visitors` reduced to the (timestamps, positions) arrays of the visitors."""
+    visitors = triangulate_visitors(df, device_xy, N, measured_power)
+    return visitors["timestamp"].to_numpy(), visitors[["x", "y"]].to_numpy()
+
+
+def triangulate_window(
+    df: pd.DataFrame,
+    device_xy: dict[str, tuple[float, float]],
+    origin_ll: tuple[float, float],
+    N: float,
+    measured_power: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Triangulate every visitor in a window of crowd data in one call.
+
+    Parameters:
+    - df: observations in long format, see `processing.OBSERVATION_DTYPES`
+    - device_xy: the devices used for triangulation (at least 3) and their (x, y) positions
+    - origin_ll: (lat, lon) of the origin the (x, y) positions are relative to
+    - N, measured_power: RSSI calibration, see `rssi_to_distance`
+
+    Returns:
+    - lat, lon: arrays with one entry per visitor seen by at least `MIN_SENSORS` devices
+    """
+    _, positions = triangulate_xy(df, device_xy, N, measured_power)
+    if len(positions) == 0:
+        return np.empty(0), np.empty(0)
+    return xy_to_ll(positions[:, 0], positions[:, 1], origin_ll[0], origin_ll[1])
+
+
+def window_fingerprint(df: pd.DataFrame) -> tuple:
+    """Cheap fingerprint of a window of observations, which changes when new data lands in the window."""
+    return len(df), df["timestamp"].max()
+
+
+class TriangulationCache:
+    """
+    Bounded LRU cache for triangulation results.
+
+    Keys should hold everything the result depends on: the window, the selected devices,
+    the marker positions and assignments, the RSSI calibration and a `window_fingerprint`
+    of the data, so an entry is only invalidated when new data lands in the window.
+    """
+
+    def __init__(self, max_size: int = 32):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: Hashable, compute: Callable):
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+
+        value = compute()
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
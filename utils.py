@@ -1,13 +1,23 @@
-from bs4 import BeautifulSoup
 import requests
-from datetime import datetime, timedelta
 import gspread
 from gspread import Worksheet
+from gspread.exceptions import APIError
 from oauth2client.service_account import ServiceAccountCredentials
+import hashlib
 import math
 
+from encoding import cell_to_payload, pack_batch, payload_to_cell, unpack_batch
+
 COLUMNS = ["device_name", "timestamp", "crowd_data"]
 SHEET_NAME = "data" #"data" #"synthetic_data"
+# URL of the collector (see collector.py) on the festival LAN, e.g. "http://192.168.1.10:8000";
+# None reads from the Google Sheet
+COLLECTOR_URL = None
+# HTTP statuses of failed writes that are retried besides server errors: timeouts and rate limits
+TRANSIENT_STATUS = {408, 429}
+# HTTP statuses of failed writes that no write can get past until the sink is set up again:
+# bad credentials, no access to the sheet or a wrong collector URL
+CONFIG_STATUS = {401, 403, 404}
 DEVICE_POSITIONS = {
     "census1": (55.84697864064483, 12.527829569730192),
     "census2": (55.84698202870734, 12.527924788142869),
@@ -15,52 +25,6 @@ DEVICE_POSITIONS = {
 }
 
 
-day_to_datetime = {
-    'Sunday':       datetime(2025, 6, 29),
-    'Monday':       datetime(2025, 6, 30),
-    'Tuesday':      datetime(2025, 7, 1),
-    'Wednesday':    datetime(2025, 7, 2),
-    'Thursday':     datetime(2025, 7, 3),
-    'Friday':       datetime(2025, 7, 4),
-    'Saturday':     datetime(2025, 7, 5)
-}
-
-def scrape_schedule() -> list[dict]:
-    """
-    Scrapes the schedule for the festival and returns it as a dictionary.
-    The schedule is a list of dictionaries, each containing the title, time, and location of an event.
-    """
-    schedule = []
-
-    for day in day_to_datetime.keys():
-        url = f"https://www.roskilde-festival.dk/en/lineup/schedule?filter={day}"
-        response = requests.get(url)
-            
-        soup = BeautifulSoup(response.content, 'html.parser')
-        class_name = "schedule-item_component__3xy_9"
-        time_slots = soup.find_all('a', class_=class_name)
-
-        # each timeslot have the following:
-        # <h2 class="typography_component__Z0rR8 typography_headlineXSmallHeavy__rAHbS schedule-item_title__Ifafr">Hatha yoga</h2>
-        # <p class="typography_component__Z0rR8 typography_bodySmall__p_2To schedule-item_timeSlot__tuJvO">09.00, Stadion</p>
-        # extract the title, time and location
-        for time_slot in time_slots:
-            title = time_slot.find('h2').text.strip()
-            time_location = time_slot.find('p').text.strip().split(',')
-            time = time_location[0].strip()
-            location = time_location[1].strip() if len(time_location) > 1 else "Unknown Location"
-            hour, minute = map(int, time.split('.'))
-            
-            event_time = day_to_datetime[day] + timedelta(hours=hour, minutes=minute)
-            event = {
-                'title': title,
-                'time': event_time,
-                'location': location
-            }
-            schedule.append(event)
-
-    return schedule
-
 def get_sheet() -> Worksheet:
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
     creds = ServiceAccountCredentials.from_json_keyfile_name("excel_key.json", scope)
@@ -68,21 +32,149 @@ def get_sheet() -> Worksheet:
     sheet = client.open(SHEET_NAME).sheet1
     return sheet
 
+class Sink:
+    """
+    Where the sensors write their rows and the dashboard reads them back from.
+
+    Rows are written as dicts with the keys in `COLUMNS` and read back in the order they were
+    written, as [device_name, timestamp, crowd_data] lists of strings.
+    """
+
+    # names the local mirror of the sink, see `SheetMirror`
+    name = "sink"
+
+    def write(self, rows: list[dict]) -> None:
+        raise NotImplementedError
+
+    def read(self, start: int) -> list[list[str]]:
+        """All rows after the first `start` rows."""
+        raise NotImplementedError
+
+
+class SinkConfigError(ValueError):
+    """The sink is set up wrong, so it rejects every write, whatever the rows are."""
+
+
+class SheetsSink(Sink):
+    """
+    The Google Sheet `SHEET_NAME`. The sheet is opened and its header checked once, not per write.
+    `sheet` can be any object with the methods of a gspread `Worksheet` used here.
+    """
+
+    def __init__(self, sheet: Worksheet | None = None):
+        self.sheet = sheet
+        self.header_checked = False
+        self.name = SHEET_NAME
+
+    def _get_sheet(self) -> Worksheet:
+        if self.sheet is None:
+            self.sheet = get_sheet()
+        return self.sheet
+
+    def write(self, rows: list[dict]) -> None:
+        sheet = self._get_sheet()
+        if not self.header_checked:
+            header = sheet.row_values(1)
+            if len(header) == 0:
+                sheet.append_row(COLUMNS)
+            elif header != COLUMNS:
+                raise SinkConfigError(f"Header mismatch: {header} != {COLUMNS}")
+            self.header_checked = True
+
+        # convert data to a list of lists
+        data = [[row[col] for col in COLUMNS] for row in rows]
+        sheet.append_rows(data, value_input_option='USER_ENTERED')
+
+    def read(self, start: int) -> list[list[str]]:
+        # sheet rows are 1-indexed and the first row is the header
+        try:
+            values = self._get_sheet().get_values(f"A{start + 2}:C")
+        except APIError as e:
+            # the sheet has no rows beyond `start` yet
+            if "exceeds grid limits" in str(e):
+                return []
+            raise
+
+        # the API trims trailing empty cells and rows
+        rows = [list(row) + [""] * (len(COLUMNS) - len(row)) for row in values]
+        while rows and not any(rows[-1]):
+            rows.pop()
+        return rows
+
+
+class CollectorSink(Sink):
+    """
+    A collector on the local network (see collector.py). Rows travel as binary batches
+    (see `encoding.pack_batch`) over one persistent HTTP connection.
+    """
+
+    name = "collector"
+    # rows per request when reading
+    page_rows = 10_000
+
+    def __init__(self, url: str, timeout: float = 30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def write(self, rows: list[dict]) -> None:
+        batch = pack_batch(
+            (row["device_name"], row["timestamp"], *cell_to_payload(row["crowd_data"])) for row in rows
+        )
+        response = self.session.post(
+            f"{self.url}/windows", data=batch,
+            headers={"Content-Type": "application/octet-stream"}, timeout=self.timeout,
+        )
+        response.raise_for_status()
+
+    def read(self, start: int) -> list[list[str]]:
+        rows = []
+        while True:
+            response = self.session.get(
+                f"{self.url}/rows", params={"start": start + len(rows), "limit": self.page_rows},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            page = unpack_batch(response.content)
+            rows.extend([device_name, timestamp, payload_to_cell(kind, payload)]
+                        for device_name, timestamp, kind, payload in page)
+            if len(page) < self.page_rows:
+                return rows
+
+
+def is_transient_error(error: Exception) -> bool:
+    """
+    Whether a write that failed with `error` may succeed when retried unchanged: network errors,
+    timeouts, rate limits (e.g. the quota of the Sheets API) and server errors. A rejected request
+    (HTTP 4xx), a header mismatch or rows that cannot be sent fail the same way every time.
+    """
+    # requests.HTTPError and gspread's APIError carry the response
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status in TRANSIENT_STATUS or status >= 500
+    return not isinstance(error, (ValueError, TypeError, KeyError))
+
+
+def is_config_error(error: Exception) -> bool:
+    """
+    Whether a write failed with `error` because of the setup of the sink (e.g. a header mismatch
+    or bad credentials) rather than the rows, so every other write fails the same way.
+    """
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return isinstance(error, SinkConfigError) or status in CONFIG_STATUS
+
+
+def get_sink(collector_url: str | None = COLLECTOR_URL) -> Sink:
+    """The collector at `collector_url`, or the Google Sheet if it is None."""
+    if collector_url:
+        return CollectorSink(collector_url)
+    return SheetsSink()
+
+
 def write_data(data : dict | list[dict]) -> None:
     if isinstance(data, dict):
         data = [data]
-    
-    sheet = get_sheet()
-    header = sheet.row_values(1)
-    
-    if len(header) == 0:
-        sheet.append_row(COLUMNS)
-    elif header != COLUMNS:
-        raise ValueError(f"Header mismatch: {header} != {COLUMNS}")
-        
-    # convert data to a list of lists
-    data = [list(item.values()) for item in data]
-    sheet.append_rows(data, value_input_option='USER_ENTERED')
+    SheetsSink().write(data)
 
 
 
@@ -93,19 +185,31 @@ _ORIGIN_LAT, _ORIGIN_LON = DEVICE_POSITIONS["census1"]
 _cos_lat0 = math.cos(math.radians(_ORIGIN_LAT))
 
 
+def parameters_key(*parts) -> str:
+    """
+    Stable 16 hex character key of `parts` (their `repr`), to name files and directories
+    derived from these parameters, e.g. density cubes and positions datasets.
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+
+
 def ll_to_xy(lat: float, lon: float, origin_lat: float, origin_lon: float) -> tuple[float, float]:
-    """Approx. equirectangular projection, metres east/north of a dynamic origin."""
+    """
+    Approx. equirectangular projection, metres east/north of a dynamic origin.
+    `lat` and `lon` may also be NumPy arrays, in which case arrays are returned.
+    """
     # Calculate cosine of the origin latitude inside the function
     cos_lat0 = math.cos(math.radians(origin_lat))
     
     # Calculate distance based on the provided origin
-    dx = _EARTH_R * math.radians(lon - origin_lon) * cos_lat0
-    dy = _EARTH_R * math.radians(lat - origin_lat)
+    # (plain arithmetic instead of math.radians so that arrays broadcast)
+    dx = _EARTH_R * (lon - origin_lon) * (math.pi / 180) * cos_lat0
+    dy = _EARTH_R * (lat - origin_lat) * (math.pi / 180)
     return dx, dy
 
 
 def xy_to_ll(x: float, y: float, origin_lat: float, origin_lon: float) -> tuple[float, float]:
-    """Inverse of the dynamic `ll_to_xy`."""
+    """Inverse of the dynamic `ll_to_xy`. Works element-wise on NumPy arrays."""
     # Calculate cosine of the origin latitude inside the function
     cos_lat0 = math.cos(math.radians(origin_lat))
     
@@ -122,4 +226,5 @@ def rssi_to_distance(rssi : float, N : float, measured_power : float) -> float:
     # rssi = Received Signal Strength Indicator
     # N = device constat, usually between 2 and 4, 2 for free space, 3 for urban areas, 4 for indoor
     # measured_power = RSSI at 1 meter distance, needs to be calibrated for each device, around -16
+    # rssi may also be a NumPy array or pandas object, the formula is applied element-wise
     return 10 ** ((measured_power - rssi) / (10 * N))